@@ -26,6 +26,7 @@ __email__ = "dashawn@gmail.com"
 __license__ = "MIT"
 
 import logging
+import pathlib
 import sqlite3
 import threading
 import uuid
@@ -38,6 +39,50 @@ except ImportError:
 LOGGER = logging.getLogger("sqlite3worker")
 
 
+def query_cursor(cursor, query, values):
+    """Run a query on a cursor.
+
+    Args:
+        cursor: The cursor to run the query on.
+        query: A sql query with ? placeholders for values.
+        values: A tuple of values to replace "?" in query.
+
+    Returns:
+        The same result Sqlite3Worker.execute() returns for the query.
+    """
+    try:
+        cursor.execute(query, values)
+        if query.lower().strip().startswith("select"):
+            return cursor.fetchall()
+        elif query.lower().strip().startswith("insert"):
+            return cursor.lastrowid
+    except sqlite3.Error as err:
+        LOGGER.error("Query returned error: %s: %s: %s", query, values, err)
+        # Return the error since a response is required.
+        if query.lower().strip().startswith(("select", "insert")):
+            return "Query returned error: %s: %s: %s" % (query, values, err)
+
+
+def run_job(cursor, job, callback):
+    """Run a job queued by submit() and hand its result to the callback.
+
+    Args:
+        cursor: The cursor to run the job on.
+        job: A callable taking the cursor.
+        callback: Called with the return value of the job, or with the
+            exception the job raised.
+    """
+    try:
+        result = job(cursor)
+    except Exception as err:  # pylint:disable=W0703
+        LOGGER.error("Job returned error: %s: %s", job, err)
+        result = err
+    try:
+        callback(result)
+    except Exception as err:  # pylint:disable=W0703
+        LOGGER.error("Job callback failed: %s: %s", job, err)
+
+
 class Sqlite3Worker(threading.Thread):
     """Sqlite thread safe object.
 
@@ -52,20 +97,53 @@ class Sqlite3Worker(threading.Thread):
             "INSERT into tester values (?, ?)", ("2011-02-02 14:14:14", "dog"))
         sql_worker.execute("SELECT * from tester")
         sql_worker.close()
+
+    WAL mode:
+        With wal_mode=True the database uses write-ahead logging with
+        synchronous=NORMAL, and read_pool_size read-only connections run
+        SELECTs in parallel with the single writer. Readers only see
+        committed data, so a read waits until the writes queued before it
+        have been committed.
     """
 
-    def __init__(self, file_name, max_queue_size=100, row_factory=None):
+    def __init__(
+        self,
+        file_name,
+        max_queue_size=100,
+        row_factory=None,
+        wal_mode=False,
+        mmap_size=0,
+        cache_size=0,
+        read_pool_size=0,
+    ):
         """Automatically starts the thread.
 
         Args:
             file_name: The name of the file.
             max_queue_size: The max queries that will be queued.
+            row_factory: The row factory of the connection cursors.
+            wal_mode: Use write-ahead logging with synchronous=NORMAL.
+            mmap_size: Bytes of the database to memory map, 0 to disable.
+            cache_size: Bytes of page cache per connection, 0 for the default.
+            read_pool_size: Read-only connections to run SELECTs on, only
+                used in WAL mode.
         """
         threading.Thread.__init__(self, name=__name__)
         self.daemon = True
         self._sqlite3_conn = sqlite3.connect(
             file_name, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES
         )
+        self._pragmas = []
+        if mmap_size:
+            self._pragmas.append("PRAGMA mmap_size = %d" % int(mmap_size))
+        if cache_size:
+            # A negative cache_size is in KiB
+            self._pragmas.append("PRAGMA cache_size = -%d" % (int(cache_size) // 1024))
+        if wal_mode:
+            self._sqlite3_conn.execute("PRAGMA journal_mode = WAL")
+            self._sqlite3_conn.execute("PRAGMA synchronous = NORMAL")
+        for pragma in self._pragmas:
+            self._sqlite3_conn.execute(pragma)
         self._sqlite3_cursor = self._sqlite3_conn.cursor()
         self._sqlite3_cursor.row_factory = row_factory
         self._sql_queue = Queue.Queue(maxsize=max_queue_size)
@@ -77,6 +155,18 @@ class Sqlite3Worker(threading.Thread):
         self._close_event = threading.Event()
         # Event that closes out the threads.
         self._close_lock = threading.Lock()
+        # Count of queued and committed writes, reads wait for the writes
+        # queued before them to be committed.
+        self._commit_cond = threading.Condition()
+        self._writes_queued = 0
+        self._writes_committed = 0
+        self._read_queue = Queue.Queue(maxsize=max_queue_size)
+        self._readers = []
+        if wal_mode and file_name != ":memory:":
+            for _ in range(read_pool_size):
+                self._readers.append(
+                    Sqlite3Reader(self, file_name, row_factory, self._pragmas)
+                )
         self.start()
 
     def run(self):
@@ -92,25 +182,62 @@ class Sqlite3Worker(threading.Thread):
         """
         LOGGER.debug("run: Thread started")
         execute_count = 0
-        for token, query, values in iter(self._sql_queue.get, None):
+        write_count = 0
+        for token, query, values, callback in iter(self._sql_queue.get, None):
             if query:
                 LOGGER.debug("_sql_queue: %s", self._sql_queue.qsize())
                 LOGGER.debug("run: %s", query)
-                self._run_query(token, query, values)
+                if callback is None:
+                    self._run_query(token, query, values)
+                else:
+                    self._run_job(query, callback)
                 execute_count += 1
+                write_count += 1
                 # Let the executes build up a little before committing to disk
                 # to speed things up.
                 if self._sql_queue.empty() or execute_count == self._max_queue_size:
                     LOGGER.debug("run: commit")
                     self._sqlite3_conn.commit()
+                    self._committed(write_count)
                     execute_count = 0
             # Only close if the queue is empty.  Otherwise keep getting
             # through the queue until it's empty.
             if self._close_event.is_set() and self._sql_queue.empty():
                 self._sqlite3_conn.commit()
+                self._committed(write_count)
                 self._sqlite3_conn.close()
                 return
 
+    def _committed(self, write_count):
+        """Let the reads waiting on the committed writes run."""
+        with self._commit_cond:
+            self._writes_committed = write_count
+            self._commit_cond.notify_all()
+
+    def _wait_committed(self, writes_queued):
+        """Wait until the given number of writes have been committed."""
+        with self._commit_cond:
+            self._commit_cond.wait_for(
+                lambda: self._writes_committed >= writes_queued
+                or not self.is_alive()
+            )
+
+    def _put_write(self, item, block=True):
+        """Queue an item on the writer."""
+        self._sql_queue.put(item, block, timeout=5)
+        with self._commit_cond:
+            self._writes_queued += 1
+
+    def _put_read(self, item, block=True):
+        """Queue an item on the read pool."""
+        self._read_queue.put(item + (self._writes_queued,), block, timeout=5)
+
+    def _set_result(self, token, result):
+        """Store the result for a token and wake up the waiting thread."""
+        self._results[token] = result
+        self._select_events.setdefault(token, threading.Event())
+        self._select_events[token].set()
+
     def _run_query(self, token, query, values):
         """Run a query.
 
@@ -120,31 +247,25 @@ class Sqlite3Worker(threading.Thread):
             values: A tuple of values to replace "?" in query.
         """
         if query.lower().strip().startswith(("select", "insert")):
+            result = None
             try:
-                self._sqlite3_cursor.execute(query, values)
-                if query.lower().strip().startswith("select"):
-                    self._results[token] = self._sqlite3_cursor.fetchall()
-                else:
-                    self._results[token] = self._sqlite3_cursor.lastrowid
-            except sqlite3.Error as err:
-                # Put the error into the output queue since a response
-                # is required.
-                self._results[token] = "Query returned error: %s: %s: %s" % (
-                    query,
-                    values,
-                    err,
-                )
-                LOGGER.error("Query returned error: %s: %s: %s", query, values, err)
+                result = query_cursor(self._sqlite3_cursor, query, values)
             finally:
                 # Wake up the thread waiting on the execution of the select
                 # query.
-                self._select_events.setdefault(token, threading.Event())
-                self._select_events[token].set()     
+                self._set_result(token, result)
         else:
-            try:
-                self._sqlite3_cursor.execute(query, values)
-            except sqlite3.Error as err:
-                LOGGER.error("Query returned error: %s: %s: %s", query, values, err)
+            query_cursor(self._sqlite3_cursor, query, values)
+
+    def _run_job(self, job, callback):
+        """Run a job queued by submit().
+
+        Args:
+            job: A callable taking the worker cursor.
+            callback: Called with the return value of the job, or with the
+                exception the job raised.
+        """
+        run_job(self._sqlite3_cursor, job, callback)
 
     def close(self):
         """Close down the thread."""
@@ -155,9 +276,13 @@ class Sqlite3Worker(threading.Thread):
             self._close_event.set()
             # Put a value in the queue to push through the block waiting for
             # items in the queue.
-            self._sql_queue.put(("", "", ""), timeout=5)
+            self._sql_queue.put(("", "", "", None), timeout=5)
             # Check that the thread is done before returning.
             self.join()
+            for _ in self._readers:
+                self._read_queue.put(None, timeout=5)
+            for reader in self._readers:
+                reader.join()
 
     @property
     def queue_size(self):
@@ -200,8 +325,101 @@ class Sqlite3Worker(threading.Thread):
         values = values or []
         # A token to track this query with.
         token = str(uuid.uuid4())
-        self._sql_queue.put((token, query, values), timeout=5)
+        if self._readers and query.lower().strip().startswith("select"):
+            self._put_read((token, query, values, None))
+        else:
+            self._put_write((token, query, values, None))
         # If it's a select we queue it up with a token to mark the results
         # into the output queue so we know what results are ours.
         if query.lower().strip().startswith(("select", "insert")):
             return self._query_results(token)
+
+    def submit(self, job, callback, block=True, read_only=False):
+        """Queue a job without waiting for it to run.
+
+        The job and the callback are called on a worker thread, so the
+        callback must hand the result over to the waiting thread itself.
+        Jobs share the batched commits of execute().
+
+        Args:
+            job: A callable taking a cursor.
+            callback: Called with the return value of the job, or with the
+                exception the job raised.
+            block: Wait up to 5 seconds for space in the queue, otherwise
+                raise Queue.Full straight away.
+            read_only: The job only reads, run it on the read pool if there
+                is one.
+        """
+        if self._close_event.is_set():
+            LOGGER.debug("Close set, not running: %s", job)
+            callback(sqlite3.ProgrammingError("Close Called"))
+            return
+        LOGGER.debug("submit: %s", job)
+        if read_only and self._readers:
+            self._put_read((None, job, None, callback), block)
+        else:
+            self._put_write((None, job, None, callback), block)
+
+    def submit_query(self, query, values, callback, block=True):
+        """Queue a query without waiting for it to run.
+
+        Args:
+            query: The sql string using ? for placeholders of dynamic values.
+            values: A tuple of values to be replaced into the ? of the query.
+            callback: Called with the result execute() would return.
+            block: Wait up to 5 seconds for space in the queue, otherwise
+                raise Queue.Full straight away.
+        """
+        values = values or []
+        self.submit(
+            lambda cursor: query_cursor(cursor, query, values),
+            callback,
+            block,
+            read_only=query.lower().strip().startswith("select"),
+        )
+
+
+class Sqlite3Reader(threading.Thread):
+    """Read-only connection of the Sqlite3Worker read pool."""
+
+    def __init__(self, worker, file_name, row_factory, pragmas):
+        """Automatically starts the thread.
+
+        Args:
+            worker: The Sqlite3Worker the reader belongs to.
+            file_name: The name of the file.
+            row_factory: The row factory of the connection cursor.
+            pragmas: The PRAGMA statements to run on the connection.
+        """
+        threading.Thread.__init__(self, name=__name__ + ".reader")
+        self.daemon = True
+        self._worker = worker
+        self._sqlite3_conn = sqlite3.connect(
+            pathlib.Path(file_name).absolute().as_uri() + "?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+        )
+        for pragma in pragmas:
+            self._sqlite3_conn.execute(pragma)
+        self._sqlite3_cursor = self._sqlite3_conn.cursor()
+        self._sqlite3_cursor.row_factory = row_factory
+        self.start()
+
+    def run(self):
+        """Thread loop, runs SELECTs until a None is queued."""
+        for token, query, values, callback, writes_queued in iter(
+            self._worker._read_queue.get, None
+        ):
+            self._worker._wait_committed(writes_queued)
+            if callback is None:
+                result = None
+                try:
+                    result = query_cursor(self._sqlite3_cursor, query, values)
+                finally:
+                    self._worker._set_result(token, result)
+            else:
+                run_job(self._sqlite3_cursor, query, callback)
+            # End the read transaction so the next query sees new commits.
+            self._sqlite3_conn.commit()
+        self._sqlite3_conn.close()
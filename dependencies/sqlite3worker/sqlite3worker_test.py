@@ -27,6 +27,7 @@ __email__ = "dashawn@gmail.com"
 __license__ = "MIT"
 
 import os
+import sqlite3
 import tempfile
 import threading
 import time
@@ -116,6 +117,51 @@ class Sqlite3WorkerTests(unittest.TestCase):  # pylint:disable=R0904
         with self.assertRaises(self.sqlite3worker._sqlite3_conn.ProgrammingError):
             self.sqlite3worker._sqlite3_conn.total_changes
 
+    def test_submit_job(self):
+        """Test a job queued with submit()."""
+        done = threading.Event()
+        results = []
+
+        def job(cursor):
+            cursor.execute(
+                "INSERT into tester values (?, ?)", ("2010-01-01 13:00:00", "bow")
+            )
+            return cursor.lastrowid
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        self.sqlite3worker.submit(job, callback)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [1])
+        self.assertEqual(
+            self.sqlite3worker.execute("SELECT * from tester"),
+            [("2010-01-01 13:00:00", "bow")],
+        )
+
+    def test_submit_bad_job(self):
+        """Test that the error of a failed job is handed to the callback."""
+        done = threading.Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        self.sqlite3worker.submit(
+            lambda cursor: cursor.execute("select THIS IS BAD SQL"), callback
+        )
+        self.assertTrue(done.wait(5))
+        self.assertIsInstance(results[0], sqlite3.OperationalError)
+
+    def test_submit_after_close(self):
+        """Test that a job submitted after close is failed straight away."""
+        results = []
+        self.sqlite3worker.close()
+        self.sqlite3worker.submit(lambda cursor: None, results.append)
+        self.assertIsInstance(results[0], sqlite3.ProgrammingError)
+
     def test_many_threads(self):
         """Make sure lots of threads work together."""
 
@@ -154,5 +200,73 @@ class Sqlite3WorkerTests(unittest.TestCase):  # pylint:disable=R0904
             threads[i].join()
 
 
+class Sqlite3WorkerWalTests(Sqlite3WorkerTests):  # pylint:disable=R0904
+    """Run the tests again in WAL mode with a read pool."""
+
+    def setUp(self):  # pylint:disable=D0102
+        self.tmp_file = tempfile.NamedTemporaryFile(
+            suffix="pytest", prefix="sqlite"
+        ).name
+        self.sqlite3worker = sqlite3worker.Sqlite3Worker(
+            self.tmp_file,
+            wal_mode=True,
+            mmap_size=1024 * 1024,
+            cache_size=1024 * 1024,
+            read_pool_size=2,
+        )
+        # Create sql db.
+        self.sqlite3worker.execute(
+            "CREATE TABLE tester (timestamp DATETIME, uuid TEXT)"
+        )
+
+    def tearDown(self):  # pylint:disable=D0102
+        self.sqlite3worker.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.tmp_file + suffix):
+                os.unlink(self.tmp_file + suffix)
+
+    def test_wal_mode(self):
+        """Make sure the database is in WAL mode."""
+        self.assertEqual(
+            self.sqlite3worker.execute("SELECT * from pragma_journal_mode"),
+            [("wal",)],
+        )
+
+    def test_read_only(self):
+        """Make sure read only jobs can not write through the read pool."""
+        done = threading.Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        self.sqlite3worker.submit(
+            lambda cursor: cursor.execute("INSERT into tester values (1, 2)"),
+            callback,
+            read_only=True,
+        )
+        self.assertTrue(done.wait(5))
+        self.assertIsInstance(results[0], sqlite3.OperationalError)
+        self.assertEqual(self.sqlite3worker.execute("SELECT * from tester"), [])
+
+    def test_submit_query(self):
+        """Test a SELECT queued with submit_query() sees earlier writes."""
+        done = threading.Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        self.sqlite3worker.execute(
+            "INSERT into tester values (?, ?)", ("2010-01-01 13:00:00", "bow")
+        )
+        self.sqlite3worker.execute("UPDATE tester set uuid = ?", ("dog",))
+        self.sqlite3worker.submit_query("SELECT uuid from tester", None, callback)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [[("dog",)]])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,11 @@
-import os, cv2, string, re, random, time, asyncio, functools, logging.handlers#, threading, sys
+import os, cv2, string, re, random, time, asyncio, functools, queue, logging.handlers#, threading, sys
+import io, shutil, tempfile, binascii, threading, collections
+import multiprocessing, concurrent.futures
 from numpy import frombuffer
+try:
+    from multiprocessing import shared_memory, resource_tracker #Python 3.8+
+except ImportError:
+    shared_memory = None
 from email.utils import parseaddr as ParseEmailAddress
 
 
@@ -93,6 +99,183 @@ class LocalQueueHandler(logging.handlers.QueueHandler):
 class TermToken(object): pass
 
 
+class StageQueue():
+    '''
+    Bounded, thread safe queue between two pipeline stages (SMTP -> Recorder
+    -> Notifier), a drop-in replacement for queue.SimpleQueue.
+    
+    What put() does when the queue holds maxsize items depends on policy:
+      -> 'block'       wait for space, raises queue.Full after put_timeout
+                       seconds (None waits forever)
+      -> 'drop_oldest' drop the oldest queued item of the same camera (or the
+                       oldest item when the camera has nothing queued)
+      -> 'reject'      raise queue.Full straight away, the SMTP server then
+                       answers 421 so the camera retries later
+    TermToken items are always accepted. maxsize=0 makes the queue unbounded.
+    
+    aget() and aput() are the asyncio versions of get() and put(). They wait
+    on a future of the calling event loop instead of parking an executor 
+    thread, the other side wakes them with loop.call_soon_threadsafe().
+    '''
+    POLICIES = ('block', 'drop_oldest', 'reject')
+    
+    def __init__(self, name, maxsize=0, policy='block', put_timeout=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f'invalid queue policy: {policy}')
+        self.name        = name
+        self.maxsize     = maxsize
+        self.policy      = policy
+        self.put_timeout = put_timeout
+        self._items      = collections.deque()
+        self._mutex      = threading.Lock()
+        self._not_empty  = threading.Condition(self._mutex)
+        self._not_full   = threading.Condition(self._mutex)
+        self._get_waiters = [] #List of (loop, future) of aget() calls waiting for an item
+        self._put_waiters = [] #List of (loop, future) of aput() calls waiting for space
+        self._stats      = {'PUT':0, 'GET':0, 'DROPPED':0, 'REJECTED':0, 'HIGH_WATER':0}
+    
+    @staticmethod
+    def _camera_key(item):
+        if isinstance(item, dict):
+            return item.get('CAMERA_ID') or item.get('CAMERA_NAME') or item.get('IPC_NAME')
+        return None
+    
+    def _full(self):
+        return 0 < self.maxsize <= len(self._items)
+    
+    def _drop_oldest(self, item):
+        camera_key = self._camera_key(item)
+        for i, queued in enumerate(self._items):
+            if camera_key is not None and self._camera_key(queued) == camera_key:
+                break
+        else:
+            i = next((i for i, queued in enumerate(self._items) if not isinstance(queued, TermToken)), None)
+        if i is None:
+            return None
+        dropped = self._items[i]
+        del self._items[i]
+        self._stats['DROPPED'] += 1
+        return dropped
+    
+    @staticmethod
+    def _wake(waiters):
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_set_future_result, future, None)
+            except RuntimeError:
+                pass #Event loop already closed
+        waiters.clear()
+    
+    def _try_put(self, item, block):
+        '''
+        Called with the mutex held. Returns (queued, dropped item), queued is
+        False when the caller has to wait for space.
+        '''
+        dropped = None
+        if not isinstance(item, TermToken) and self._full():
+            if self.policy == 'reject' or not block:
+                self._stats['REJECTED'] += 1
+                raise queue.Full
+            elif self.policy == 'drop_oldest':
+                dropped = self._drop_oldest(item)
+            else:
+                return False, None
+        self._items.append(item)
+        self._stats['PUT'] += 1
+        self._stats['HIGH_WATER'] = max(self._stats['HIGH_WATER'], len(self._items))
+        self._not_empty.notify()
+        self._wake(self._get_waiters)
+        return True, dropped
+    
+    def _try_get(self):
+        '''Called with the mutex held'''
+        item = self._items.popleft()
+        self._stats['GET'] += 1
+        self._not_full.notify()
+        self._wake(self._put_waiters)
+        return item
+    
+    def _log_dropped(self, dropped):
+        if dropped is not None:
+            logging.getLogger('on_patrol_server').warning(f'[{self.name}] queue full, dropped oldest notification of {self._camera_key(dropped)}')
+    
+    def put(self, item, block=True, timeout=None):
+        with self._not_full:
+            queued, dropped = self._try_put(item, block)
+            if not queued:
+                timeout = self.put_timeout if timeout is None else timeout
+                if not self._not_full.wait_for(lambda: not self._full(), timeout):
+                    self._stats['REJECTED'] += 1
+                    raise queue.Full
+                queued, dropped = self._try_put(item, block)
+        self._log_dropped(dropped)
+    
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+    
+    async def aput(self, item, timeout=None):
+        loop = asyncio.get_running_loop()
+        timeout = self.put_timeout if timeout is None else timeout
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self._mutex:
+                queued, dropped = self._try_put(item, True)
+                if not queued:
+                    future = loop.create_future()
+                    self._put_waiters.append((loop, future))
+            if queued:
+                self._log_dropped(dropped)
+                return
+            try:
+                await asyncio.wait_for(future, None if deadline is None else max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                with self._mutex:
+                    self._stats['REJECTED'] += 1
+                raise queue.Full
+            finally:
+                with self._mutex:
+                    if (loop, future) in self._put_waiters:
+                        self._put_waiters.remove((loop, future))
+    
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                if not self._items:
+                    raise queue.Empty
+            elif not self._not_empty.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            return self._try_get()
+    
+    def get_nowait(self):
+        return self.get(block=False)
+    
+    async def aget(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._mutex:
+                if self._items:
+                    return self._try_get()
+                future = loop.create_future()
+                self._get_waiters.append((loop, future))
+            try:
+                await future
+            finally:
+                with self._mutex:
+                    if (loop, future) in self._get_waiters:
+                        self._get_waiters.remove((loop, future))
+    
+    def qsize(self):
+        return len(self._items)
+    
+    def empty(self):
+        return not self._items
+    
+    def stats(self):
+        '''Returns a dict with the queue DEPTH, MAXSIZE, POLICY and the PUT, GET, DROPPED, REJECTED and HIGH_WATER counters'''
+        with self._mutex:
+            return dict(self._stats, DEPTH=len(self._items), MAXSIZE=self.maxsize, POLICY=self.policy)
+
+
 class aioEvent_ts(asyncio.Event):
     #A thread safe asyncio.Event
     def set(self):
@@ -104,70 +287,363 @@ def make_valid_filename(filename):
 
 
 class TelegramFloodController():
-    def __init__(self, group_time_limit=60, group_burst_limit=20, chat_time_limit=1, chat_burst_limit=1, token_time_limit=1, token_burst_limit=30):
+    '''
+    Rate limits for the telegram bot API, per bot token, per chat and per 
+    group. Each limit allows at most burst_limit calls in any time_limit 
+    seconds. A bucket keeps the times of its last burst_limit calls in a 
+    bounded deque, so a check only compares its oldest call with now.
+    
+    A bucket whose calls all left the time window is the same as a new one, 
+    these idle buckets are evicted least recently used first once there are 
+    more than max_buckets.
+    
+    Calls have a priority. HOUSEKEEPING calls (e.g. deleting expired 
+    messages) only take leftover capacity: they leave housekeeping_reserve 
+    of each burst free for ALERT and RETRY calls and do not reserve a slot 
+    while waiting for one.
+    '''
+    ALERT        = 0
+    RETRY        = 1
+    HOUSEKEEPING = 2
+    
+    def __init__(self, group_time_limit=60, group_burst_limit=20, chat_time_limit=1, chat_burst_limit=1, token_time_limit=1, token_burst_limit=30, max_buckets=4096, housekeeping_reserve=0.5):
         self.group_time_limit  = group_time_limit
         self.group_burst_limit = group_burst_limit
         self.chat_time_limit   = chat_time_limit
         self.chat_burst_limit  = chat_burst_limit
         self.token_time_limit  = token_time_limit
         self.token_burst_limit = token_burst_limit
-        self.history           = {}
+        self.max_buckets       = max_buckets
+        self.housekeeping_reserve = housekeeping_reserve
+        self._buckets          = collections.OrderedDict() #(kind, token, chat_id) -> deque of call times
+        self._limits           = {'group' : (group_time_limit, group_burst_limit),
+                                  'chat'  : (chat_time_limit , chat_burst_limit),
+                                  'token' : (token_time_limit, token_burst_limit)}
 
-    async def delay(self, token, chat_id='', is_group=False, api_only=False):
-        if token not in self.history:
-            self.history.update({token:{'token':[], 'chats':{}, 'groups':{}}})
-        
+    def _keys(self, token, chat_id, is_group, api_only):
+        keys = []
         if not api_only:
-            #Limit group message rate if applicable
             if is_group:
-                if chat_id not in self.history[token]['groups']:
-                    self.history[token]['groups'].update({chat_id:[]})
-                await self._group_delay(token, chat_id)
-    
-            #Limit chat message rate
-            if chat_id not in self.history[token]['chats']:
-                self.history[token]['chats'].update({chat_id:[]})
-            await self._chat_delay(token, chat_id)    
-        
-        #Limit token API calls
-        await self._token_delay(token, chat_id)
+                keys.append(('group', token, chat_id))
+            keys.append(('chat', token, chat_id))
+        keys.append(('token', token, ''))
+        return keys
 
+    def _wait_time(self, key, now, priority=ALERT):
+        '''Seconds until the bucket allows the next call'''
+        time_limit, burst_limit = self._limits[key[0]]
+        calls = self._buckets.get(key)
+        burst = burst_limit
+        if priority >= self.HOUSEKEEPING:
+            burst -= min(burst_limit - 1, int(burst_limit * self.housekeeping_reserve))
+        if calls is None or len(calls) < burst:
+            return 0
+        return max(0, calls[-burst] + time_limit - now)
 
-    async def _group_delay(self, token, chat_id):
-        now = time.time()
-        sleep_time = self._filter(self.history[token]['groups'][chat_id], now, self.group_time_limit, self.group_burst_limit)
-        if sleep_time > 0:
-            await asyncio.sleep(sleep_time)
+    def _reserve(self, key, now, priority=ALERT):
+        '''Take the next slot of the bucket and return the seconds until it'''
+        time_limit, burst_limit = self._limits[key[0]]
+        wait_time = self._wait_time(key, now, priority)
+        if key not in self._buckets:
+            self._buckets[key] = collections.deque(maxlen=burst_limit)
+        self._buckets[key].append(now + wait_time)
+        self._buckets.move_to_end(key)
+        self._evict(now)
+        return wait_time
 
-    async def _chat_delay(self, token, chat_id):
-        now = time.time()
-        sleep_time = self._filter(self.history[token]['chats'][chat_id], now, self.chat_time_limit, self.chat_burst_limit)
-        if sleep_time > 0:
-            await asyncio.sleep(sleep_time)        
+    def _evict(self, now):
+        while len(self._buckets) > self.max_buckets:
+            key, calls = next(iter(self._buckets.items()))
+            if calls[-1] + self._limits[key[0]][0] > now:
+                break
+            del self._buckets[key]
+
+    async def delay(self, token, chat_id='', is_group=False, api_only=False, priority=ALERT):
+        '''Wait for a slot in each bucket, group and chat first and then the token'''
+        if priority >= self.HOUSEKEEPING:
+            #Wait without holding a slot, so alerts sent meanwhile go first
+            while True:
+                sleep_time = self.try_acquire(token, chat_id, is_group, api_only, priority)
+                if sleep_time <= 0:
+                    return
+                await asyncio.sleep(sleep_time)
+        for key in self._keys(token, chat_id, is_group, api_only):
+            sleep_time = self._reserve(key, time.time(), priority)
+            if sleep_time > 0:
+                await asyncio.sleep(sleep_time)
 
-    async def _token_delay(self, token, chat_id):
+    def try_acquire(self, token, chat_id='', is_group=False, api_only=False, priority=ALERT):
+        '''
+        Take a slot in each bucket if all have one now and return 0, else 
+        take nothing and return the seconds until the next slot.
+        '''
         now = time.time()
-        sleep_time = self._filter(self.history[token]['token'], now, self.token_time_limit, self.token_burst_limit)
-        if sleep_time > 0:
-            await asyncio.sleep(sleep_time)    
-
-    def _filter(self, buffer, now, time_limit, burst_limit):
-        t_window = now - time_limit
-        sleep_time = 0
-        if buffer and t_window > buffer[-1]:
-            buffer[:] = [now]
-        else:
-            buffer[:] = [t for t in buffer if t >= t_window]
-            if len(buffer) >= burst_limit:
-                idx = len(buffer) - burst_limit
-                time_to_action = buffer[idx] + time_limit
-                buffer.append(time_to_action)
-                sleep_time = time_to_action - now
-            else:
-                buffer.append(now)           
-        return sleep_time
+        keys = self._keys(token, chat_id, is_group, api_only)
+        wait_time = max(self._wait_time(key, now, priority) for key in keys)
+        if wait_time > 0:
+            return wait_time
+        for key in keys:
+            self._reserve(key, now, priority)
+        return 0
 
 
+class MediaUploadCache():
+    '''
+    Telegram file_ids of uploaded media files, keyed by (bot token, file 
+    path, file modification time). When one event is sent to several chats 
+    the file is uploaded once and the other chats get its file_id.
+    
+    send() runs on the notifier event loop. evict_paths() may be called 
+    from other threads, e.g. by the recorder when it deletes files.
+    '''
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries    = collections.OrderedDict()
+        self._uploading  = {}
+        self._lock       = threading.Lock()
+    
+    @staticmethod
+    def _key(token, path):
+        return (token, os.path.abspath(path), os.stat(path).st_mtime_ns)
+    
+    @staticmethod
+    def file_id_of(message):
+        '''The file_id of the media in a sent telegram message, or None'''
+        for attr in ('video', 'animation', 'document'):
+            media = getattr(message, attr, None)
+            if media:
+                return media.file_id
+        photo = getattr(message, 'photo', None)
+        if photo:
+            return photo[-1].file_id
+        return None
+    
+    async def send(self, token, path, send_media, invalid_file_id=(), before_reupload=None):
+        '''
+        Send the file at path with send_media(media), media being the cached 
+        file_id or else the open file, and return the sent message. If the 
+        same file is being uploaded already, wait for that upload first. 
+        Exceptions in invalid_file_id drop the cached file_id and upload, 
+        after awaiting before_reupload() (e.g. a flood control delay).
+        '''
+        key = self._key(token, path)
+        while True:
+            file_id = self._get(key)
+            if file_id is not None:
+                try:
+                    return await send_media(file_id)
+                except invalid_file_id:
+                    with self._lock:
+                        self._entries.pop(key, None)
+                    if before_reupload is not None:
+                        await before_reupload()
+            pending = self._uploading.get(key, None)
+            if pending is None:
+                break
+            await asyncio.wait([pending])
+        
+        pending = asyncio.get_event_loop().create_future()
+        self._uploading[key] = pending
+        try:
+            with open(path, 'rb') as media:
+                message = await send_media(media)
+            self._put(key, self.file_id_of(message))
+            return message
+        finally:
+            del self._uploading[key]
+            pending.set_result(None)
+    
+    def get(self, token, path):
+        '''The cached file_id of the file, or None'''
+        try:
+            return self._get(self._key(token, path))
+        except OSError:
+            return None
+    
+    def put(self, token, path, message):
+        '''Cache the file_id of the media in message, sent by token'''
+        try:
+            self._put(self._key(token, path), self.file_id_of(message))
+        except OSError:
+            pass
+    
+    def _get(self, key):
+        with self._lock:
+            file_id = self._entries.get(key, None)
+            if file_id is not None:
+                self._entries.move_to_end(key)
+        return file_id
+    
+    def _put(self, key, file_id):
+        if not file_id or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = file_id
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def evict_paths(self, paths):
+        paths = set(os.path.abspath(path) for path in paths)
+        with self._lock:
+            for key in [key for key in self._entries if key[1] in paths]:
+                del self._entries[key]
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+WEEKDAY_NAMES = ('MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY', 'SATURDAY', 'SUNDAY')
+
+
+class DeepStackProfileResolver():
+    '''
+    First-match DeepStack camera profile lookup, built once by 
+    load_DeepStackCameraProfiles() and shared by DeepStackClient and
+    NotificationRecorder.
+    
+    Rules are walked in the same order as before: profiles listed for the 
+    camera name first, then the wildcard (*) profiles. Profile days are 
+    stored as a weekday bitmask and the time slots as minute-of-day
+    intervals. Profile times have a resolution of one minute, so results 
+    are cached per (camera, channel, minute-of-week) in a bounded LRU cache.
+    '''
+    def __init__(self, camera_profiles, camera_name_index, all_cameras_index, cache_size=4096):
+        self._camera_name_rules = {}  #Key->Camera name:Value->tuple of rules
+        self._all_cameras_rules = []  #List of (rule, excluded camera names)
+        for name, keys in camera_name_index.items():
+            self._camera_name_rules[name] = tuple(self._compile_rule(key, camera_profiles[key]) for key in keys)
+        for key, excluded in all_cameras_index.items():
+            self._all_cameras_rules.append((self._compile_rule(key, camera_profiles[key]), frozenset(excluded)))
+        self._cached_resolve = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    @staticmethod
+    def _compile_rule(key, profile):
+        weekday_mask = 0
+        for bit, day in enumerate(WEEKDAY_NAMES):
+            if profile[day]:
+                weekday_mask |= 1 << bit
+        return (key,
+                profile,
+                frozenset(profile['CHANNEL_NAMES']) if profile['CHANNEL_NAMES'] else None,
+                frozenset(profile['CHANNEL_NUMBERS']) if profile['CHANNEL_NUMBERS'] else None,
+                weekday_mask,
+                profile['TIME_START'].hour*60 + profile['TIME_START'].minute,
+                profile['TIME_STOP'].hour*60 + profile['TIME_STOP'].minute)
+
+    @staticmethod
+    def _rule_matches(rule, channel_name, channel_number, weekday_bit, minute):
+        key, profile, channel_names, channel_numbers, weekday_mask, start, stop = rule
+        if channel_names is not None and channel_name not in channel_names:
+            return False
+        if channel_numbers is not None and channel_number not in channel_numbers:
+            return False
+        if not weekday_mask & weekday_bit:
+            return False
+        if start > stop:
+            return minute < stop or minute >= start
+        elif start < stop:
+            return minute < stop and minute >= start
+        return True
+
+    def _resolve(self, camera_name, channel_name, channel_number, minute_of_week):
+        camera_name    = camera_name.lower()
+        channel_name   = channel_name.lower()
+        channel_number = channel_number.lower()
+        weekday_bit    = 1 << (minute_of_week // 1440)
+        minute         = minute_of_week % 1440
+        
+        # Check for individual camera name rules
+        for rule in self._camera_name_rules.get(camera_name, ()):
+            if self._rule_matches(rule, channel_name, channel_number, weekday_bit, minute):
+                return rule[0], rule[1]
+
+        # Check for rules that apply to all camera (wildcard *)
+        for rule, excluded in self._all_cameras_rules:
+            if camera_name in excluded:
+                continue
+            if self._rule_matches(rule, channel_name, channel_number, weekday_bit, minute):
+                return rule[0], rule[1]
+        return None
+
+    def resolve(self, camera_name, channel_name, channel_number, event_time):
+        '''
+        Returns
+        -------
+        (profile key, profile dict) of the first matching profile, or None
+        '''
+        minute_of_week = event_time.weekday()*1440 + event_time.hour*60 + event_time.minute
+        return self._cached_resolve(camera_name, channel_name, channel_number, minute_of_week)
+
+
+class EmailTemplateExtractor():
+    '''
+    Email template regexes compiled once by load_email_templates().
+    
+    extract() finds the fields of the template in one pass over the email
+    text: the field patterns are combined into one alternation of 
+    lookaheads (?=(field_0))|(?=(field_1))|... that reports every position
+    where a field matches. Each field is then matched once at its first 
+    position with its own pattern, which gives the same match re.search()
+    would. Patterns that cannot be combined (backreferences, global inline
+    flags) are searched one by one. Invalid patterns never match.
+    '''
+    FIELDS = ('EVENT_TYPE', 'EVENT_DATETIME', 'CAMERA_NAME', 'SERIAL_NUMBER', 'CHANNEL_NAME', 'CHANNEL_NUMBER')
+    
+    def __init__(self, template):
+        self.patterns = {} #Key->field:Value->compiled pattern, None when not set or invalid
+        for field in self.FIELDS + ('TEST_MESSAGE', 'TEST_MESSAGE_CAMERA_NAME'):
+            self.patterns[field] = self._compile(template.get(f'{field}_RE', ''))
+        self._fields = [field for field in self.FIELDS if self.patterns[field] is not None]
+        self._combined = None
+        self._group_index = [] #Group number of each field in the combined pattern
+        if len(self._fields) > 1 and not any(re.search(r'\\[1-9]|\(\?P=', self.patterns[field].pattern) for field in self._fields):
+            try:
+                self._combined = re.compile('|'.join(f'(?=({self.patterns[field].pattern}))' for field in self._fields))
+                group = 1
+                for field in self._fields:
+                    self._group_index.append(group)
+                    group += 1 + self.patterns[field].groups
+            except re.error:
+                self._combined = None
+    
+    @staticmethod
+    def _compile(pattern):
+        if not pattern:
+            return None
+        try:
+            return re.compile(pattern)
+        except re.error as ex:
+            logging.getLogger('on_patrol_server').warning(f'Invalid email template regex "{pattern}": {str(ex)}')
+            return None
+    
+    def search(self, field, text):
+        '''re.search() with the compiled pattern of one field, None if not set'''
+        pattern = self.patterns.get(field)
+        return pattern.search(text) if pattern is not None else None
+    
+    def extract(self, text):
+        '''
+        Returns
+        -------
+        Dict of field->match object (None when not found) for all FIELDS
+        '''
+        results = dict.fromkeys(self.FIELDS)
+        if self._combined is None:
+            for field in self._fields:
+                results[field] = self.patterns[field].search(text)
+            return results
+        missing = list(range(len(self._fields)))
+        for found in self._combined.finditer(text):
+            pos = found.start()
+            first = next(i for i, group in enumerate(self._group_index) if found.group(group) is not None)
+            for i in [i for i in missing if i >= first]:
+                match = self.patterns[self._fields[i]].match(text, pos)
+                if match is not None:
+                    results[self._fields[i]] = match
+                    missing.remove(i)
+            if not missing:
+                break
+        return results
 
 
 def splitemails2list(str_in):
@@ -194,11 +670,285 @@ async def SyncCall(obj, method, *args, **kwargs):
                                                                             )
                                                           )                                                         
                                                           
+
+def default_media_workers():
+    '''One worker per CPU core, leaving one core for the event loops'''
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+def _attach_shared_memory(name):
+    '''
+    Attach to a block created by the parent without leaving it registered 
+    with the resource tracker (bpo-39959), only the parent unlinks it.
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) #Python 3.13+
+    except TypeError:
+        pass
+    shm = shared_memory.SharedMemory(name=name)
+    if getattr(shared_memory, '_USE_POSIX', False):
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+def _call_with_shared_images(func, shm_name, spans, args, kwargs):
+    shm = _attach_shared_memory(shm_name)
+    images = [shm.buf[offset:offset+length] for offset, length in spans]
+    try:
+        return func(images, *args, **kwargs)
+    finally:
+        for image in images:
+            try:
+                image.release()
+            except BufferError:
+                pass
+        del images
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+class MediaProcessPool():
+    '''
+    Runs CPU-bound media functions (video encoding, image decoding) in 
+    worker processes, so they do not compete for the GIL with the event 
+    loops of the SMTP, recorder and notifier threads.
+    
+    run_with_images() hands the image payloads to the worker in one shared 
+    memory block instead of pickling them. With workers=0 the functions run 
+    on the default thread pool, like SyncCall.
+    '''
+    def __init__(self, workers=0):
+        self.workers = workers
+        self._executor = None
+        if workers > 0:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers = workers,
+                                                                    mp_context  = multiprocessing.get_context('spawn'))
+    
+    async def run(self, func, *args, **kwargs):
+        '''func and its arguments must be picklable when workers > 0'''
+        return await asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    async def run_with_images(self, func, images, *args, **kwargs):
+        '''
+        Call func(images, *args, **kwargs), images being a list of 
+        bytes-like objects. The worker gets them as memoryviews.
+        '''
+        if self._executor is None or shared_memory is None:
+            return await self.run(func, list(images), *args, **kwargs)
+        images = [memoryview(image).cast('B') for image in images]
+        shm = shared_memory.SharedMemory(create=True, size=max(1, sum(image.nbytes for image in images)))
+        try:
+            spans = []
+            offset = 0
+            for image in images:
+                shm.buf[offset:offset+image.nbytes] = image
+                spans.append((offset, image.nbytes))
+                offset += image.nbytes
+            return await self.run(_call_with_shared_images, func, shm.name, spans, args, kwargs)
+        finally:
+            shm.close()
+            if getattr(shared_memory, '_USE_POSIX', False):
+                #Spawned workers share our resource tracker, their unregister 
+                #dropped our entry too, register it again for unlink()
+                resource_tracker.register(shm._name, 'shared_memory')
+            shm.unlink()
+    
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def _set_future_result(future, result):
+    if future.done():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class aioSqlite3Worker():
+    '''
+    asyncio front-end for a Sqlite3Worker shared between threads.
+    
+    Jobs are queued on the worker thread without parking an executor thread,
+    the worker hands each result back to the event loop with 
+    call_soon_threadsafe. Must be created in the thread of the event loop
+    that will use it.
+      -> execute()     has the same contract as Sqlite3Worker.execute()
+      -> insert()      INSERTs queued during the same loop iteration are 
+                       coalesced into one executemany() per statement
+      -> insert_many() runs one executemany() 
+      -> executemany() the same for other statements, e.g. UPDATEs
+      -> transaction() runs several statements as one job (one round trip)
+    insert(), insert_many(), executemany() and transaction() run inside a 
+    SAVEPOINT, so either all of their rows are written or none, and errors 
+    are raised.
+    '''
+    def __init__(self, db_conn):
+        self._db_conn = db_conn
+        self._loop = asyncio.get_running_loop()
+        self._pending_inserts = {} #Key->statement:Value->list of (args, future)
+        
+    def _result_callback(self, future):
+        loop = self._loop
+        def callback(result):
+            try:
+                loop.call_soon_threadsafe(_set_future_result, future, result)
+            except RuntimeError:
+                pass #Event loop already closed
+        return callback
+
+    def _queue_job(self, job, future):
+        callback = self._result_callback(future)
+        try:
+            self._db_conn.submit(job, callback, block=False)
+        except queue.Full:
+            #Only park an executor thread while the worker queue is full
+            self._submit_blocking(future, self._db_conn.submit, job, callback)
+
+    def _submit_blocking(self, future, submit, *args):
+        task = self._loop.create_task(SyncCall(submit, None, *args))
+        task.add_done_callback(functools.partial(self._submit_done, future))
+
+    @staticmethod
+    def _submit_done(future, task):
+        #The job never reached the worker, e.g. the queue stayed full
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+
+    async def _run(self, job):
+        future = self._loop.create_future()
+        self._queue_job(job, future)
+        return await future
+
+    @staticmethod
+    def _in_savepoint(func, *args):
+        def job(cursor):
+            cursor.execute('SAVEPOINT aio_job')
+            try:
+                result = func(cursor, *args)
+            except BaseException:
+                cursor.execute('ROLLBACK TO aio_job')
+                cursor.execute('RELEASE aio_job')
+                raise
+            cursor.execute('RELEASE aio_job')
+            return result
+        return job
+
+    @staticmethod
+    def _executemany(cursor, stmt, rows):
+        cursor.executemany(stmt, rows)
+        return cursor.rowcount
+
+    async def execute(self, stmt, args=()):
+        #SELECTs run on the read pool of the worker when it has one
+        future = self._loop.create_future()
+        callback = self._result_callback(future)
+        try:
+            self._db_conn.submit_query(stmt, args, callback, block=False)
+        except queue.Full:
+            self._submit_blocking(future, self._db_conn.submit_query, stmt, args, callback)
+        return await future
+
+    async def insert(self, stmt, args):
+        future = self._loop.create_future()
+        if not self._pending_inserts:
+            self._loop.call_soon(self._flush_inserts)
+        self._pending_inserts.setdefault(stmt, []).append((args, future))
+        await future
+
+    def _flush_inserts(self):
+        pending, self._pending_inserts = self._pending_inserts, {}
+        for stmt, items in pending.items():
+            batch_future = self._loop.create_future()
+            batch_future.add_done_callback(functools.partial(self._batch_done, [future for args, future in items]))
+            self._queue_job(self._in_savepoint(self._executemany, stmt, [args for args, future in items]), batch_future)
+
+    @staticmethod
+    def _batch_done(futures, batch_future):
+        for future in futures:
+            if future.done():
+                continue
+            if batch_future.cancelled():
+                future.cancel()
+            elif batch_future.exception() is not None:
+                future.set_exception(batch_future.exception())
+            else:
+                future.set_result(None)
+
+    async def insert_many(self, stmt, rows):
+        '''Returns the number of rows inserted'''
+        return await self.executemany(stmt, rows)
+
+    async def executemany(self, stmt, rows):
+        '''Returns the number of rows changed'''
+        return await self._run(self._in_savepoint(self._executemany, stmt, list(rows)))
+
+    async def transaction(self, func, *args):
+        '''Run func(cursor, *args) on the worker thread and return its result'''
+        return await self._run(self._in_savepoint(func, *args))
+
             
-def create_mp4(images, framerate, out_file_path, scaleF=0.4):
+JPEG_SOF_MARKERS = frozenset([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+def jpeg_dimensions(image):
+    '''
+    Returns (width, height) read from the JPEG header without decoding 
+    the image, or None if image is not a JPEG.
+    '''
+    data = memoryview(image)
+    if bytes(data[0:2]) != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i+1]
+        if marker == 0xFF:
+            i += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+        elif marker in JPEG_SOF_MARKERS:
+            height = int.from_bytes(data[i+5:i+7], 'big')
+            width  = int.from_bytes(data[i+7:i+9], 'big')
+            return width, height
+        else:
+            i += 2 + int.from_bytes(data[i+2:i+4], 'big')
+    return None
+
+def decode_image_for_size(image, width, height):
+    '''
+    Decode image at the smallest JPEG reduced size (1/2, 1/4 or 1/8) that 
+    is still at least width x height, then resize it to width x height.
+    Returns None if the image cannot be decoded.
+    '''
+    flag = cv2.IMREAD_COLOR
+    dimensions = jpeg_dimensions(image)
+    if dimensions is not None:
+        for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                     (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                     (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if dimensions[0] // factor >= width and dimensions[1] // factor >= height:
+                flag = reduced_flag
+                break
+    frame = cv2.imdecode(frombuffer(image, dtype='uint8'), flag)
+    if frame is None:
+        return None
+    if frame.shape[1] != width or frame.shape[0] != height:
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    return frame
+
+def create_mp4(images, framerate, out_file_path, scaleF=0.4, width=768, height=432, loops=3):
     '''
     Convert is list of images in bytearray to mp4 video and save it to file
-    with a random filename. 
+    with a random filename. Images are decoded, resized and written one at 
+    a time, so only one frame is held in memory.
 
     Parameters
     ----------
@@ -207,7 +957,12 @@ def create_mp4(images, framerate, out_file_path, scaleF=0.4):
     framerate : FLOAT
         1/frame_duration.
     scaleF : FLOAT, optional
-        Scale original image. The default is 0.4.
+        Unused, frames are scaled to width x height.
+    width, height : INT, optional
+        Video frame size. The default is 768x432.
+    loops : INT, optional
+        Number of times the images are written. The default is 3. Use 1 
+        and loop_video_file() to repeat the video without re-encoding.
 
     Returns
     -------
@@ -218,32 +973,34 @@ def create_mp4(images, framerate, out_file_path, scaleF=0.4):
     if len(images) < 2:
         raise RuntimeError('cannot create video, less than 2 images supplied')
     
-    #Load frames
-    frames = []
-    for image in images:
+    #Decode, resize and write frames one at a time
+    video = None
+    frames_written = 0
+    try:
+        for i in range(max(1, loops)):
+            for image in images:
+                try:
+                    frame = decode_image_for_size(image, width, height)
+                except:
+                    frame = None
+                if frame is None:
+                    continue
+                if video is None:
+                    video = cv2.VideoWriter(out_file_path, cv2.VideoWriter_fourcc(*'mp4v'), framerate, (width, height))  
+                video.write(frame)
+                frames_written += 1
+            if frames_written < 2:
+                break
+    finally:
+        if video is not None:
+            video.release()   
+
+    if frames_written < 2:
         try:
-            frame = cv2.imdecode( frombuffer(image, dtype='uint8'), cv2.IMREAD_COLOR )
-            if frame is not None:
-                frames.append(frame)
+            os.remove(out_file_path)
         except:
             pass
-    
-    if len(frames) < 2:
         raise RuntimeError('cannot create video, less than 2 frames successfully loaded')
-    
-    #Resize frames
-    height = 432 #int(frames[0].shape[0]*scaleF)  
-    width  = 768 #int(frames[0].shape[1]*scaleF)
-    for i in range(len(frames)):
-        frames[i] = cv2.resize(frames[i],(width,height))
-   
-    #Write video
-    video = cv2.VideoWriter(out_file_path, cv2.VideoWriter_fourcc(*'mp4v'), framerate, (width, height))  
-    for i in range(3):
-        for frame in frames:
-            video.write(frame)
-    cv2.destroyAllWindows()
-    video.release()   
 
     #Check that image is not empty
     if os.path.isfile(out_file_path):
@@ -258,6 +1015,98 @@ def create_mp4(images, framerate, out_file_path, scaleF=0.4):
     
 
 
+def frame_thumbnail(gray_frame):
+    return cv2.resize(gray_frame, (32, 32), interpolation=cv2.INTER_AREA)
+
+
+def is_near_duplicate(thumbnail, last_thumbnail, dedup_threshold):
+    '''True if the mean absolute difference (0-255) of the thumbnails is below dedup_threshold'''
+    if last_thumbnail is None:
+        return False
+    return cv2.norm(thumbnail, last_thumbnail, cv2.NORM_L1)/thumbnail.size < dedup_threshold
+
+
+def read_image_files(dir_path, dedup_threshold=0, max_frames=0):
+    '''
+    Read the image files in dir_path in file name order, dropping near 
+    duplicate images the same way read_video_frames() does.
+
+    Returns
+    -------
+    LIST
+        The kept images (bytes).
+    '''
+    images = []
+    last_thumbnail = None
+    for file_name in sorted(os.listdir(dir_path)):
+        if max_frames and len(images) >= max_frames:
+            break
+        with open(os.path.join(dir_path, file_name), 'rb') as f:
+            image = f.read()
+        if dedup_threshold:
+            gray_frame = cv2.imdecode(frombuffer(image, dtype='uint8'), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+            if gray_frame is None:
+                continue
+            thumbnail = frame_thumbnail(gray_frame)
+            if is_near_duplicate(thumbnail, last_thumbnail, dedup_threshold):
+                continue
+            last_thumbnail = thumbnail
+        images.append(image)
+    return images
+
+
+def read_video_frames(video_path, image_format='.jpg', sample_fps=0, dedup_threshold=0, max_frames=0):
+    '''
+    Read the frames of a video file in one pass.
+
+    Parameters
+    ----------
+    sample_fps : FLOAT, optional
+        Frames per second of video to keep, 0 keeps all frames. Skipped 
+        frames are grabbed but not decoded.
+    dedup_threshold : FLOAT, optional
+        Drop a frame when the mean absolute difference (0-255) between its 
+        32x32 grayscale thumbnail and the one of the last kept frame is 
+        below the threshold. 0 keeps duplicate frames.
+    max_frames : INT, optional
+        Stop after this many frames are kept, 0 for no limit.
+
+    Returns
+    -------
+    LIST
+        The kept frames encoded as image_format (bytes).
+    '''
+    frames = []
+    last_thumbnail = None
+    video = cv2.VideoCapture(str(video_path))
+    try:
+        video_fps = video.get(cv2.CAP_PROP_FPS) or 0
+        step = max(video_fps/sample_fps, 1) if sample_fps and video_fps > 0 else 1
+        next_frame = 0.0
+        frame_number = 0
+        while not max_frames or len(frames) < max_frames:
+            if not video.grab():
+                break
+            frame_number += 1
+            if frame_number - 1 < next_frame:
+                continue
+            next_frame += step
+            success, frame = video.retrieve()
+            if not success:
+                continue
+            if dedup_threshold:
+                thumbnail = frame_thumbnail(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+                if is_near_duplicate(thumbnail, last_thumbnail, dedup_threshold):
+                    continue
+                last_thumbnail = thumbnail
+            success, encoded = cv2.imencode(image_format, frame)
+            if success:
+                frames.append(encoded.tobytes())
+    finally:
+        video.release()
+    return frames
+
+
 def csv2list(str_in, lower=True):
     try:
         if lower:
@@ -323,11 +1172,112 @@ def xstr(s):
 def get_ctype_file_extension(ctype):
     return {'image/jpeg': '.jpg', 'image/png':'.png', 'image/jpg':'.jpg'}.get(ctype, f'.{ctype.split("/")[-1]}')
 
+
+class MediaAttachment():
+    '''
+    Handle to the payload of an image or video attachment. 
+    
+    The payload is kept in memory until it grows past spool_size bytes, then
+    it is moved to a temporary file. spool_size=0 keeps it in memory.
+      -> getbuffer() returns a memoryview of the in memory payload without 
+         copying it (the file is read for spooled payloads)
+      -> getvalue()  returns the payload as bytes
+      -> save()      writes the payload to a file
+    The payload is not changed once written, so copies share the handle.
+    '''
+    def __init__(self, data=None, spool_size=0):
+        self._file = io.BytesIO()
+        self._spool_size = spool_size
+        self.size = 0
+        if data:
+            self.write(data)
+    
+    @property
+    def spooled(self):
+        return not isinstance(self._file, io.BytesIO)
+    
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+        if self._spool_size and not self.spooled and self.size > self._spool_size:
+            spool_file = tempfile.TemporaryFile()
+            spool_file.write(self._file.getbuffer())
+            self._file = spool_file
+    
+    def write_base64(self, data, chunk_size=65536):
+        '''Decode base64 data (bytes or memoryview) in chunks and write it'''
+        data = memoryview(data)
+        remainder = b''
+        for i in range(0, len(data), chunk_size):
+            chunk = remainder + bytes(data[i:i+chunk_size]).translate(None, b' \t\r\n')
+            n = len(chunk) - len(chunk) % 4
+            self.write(binascii.a2b_base64(chunk[:n]))
+            remainder = chunk[n:]
+        if remainder.strip(b'='):
+            self.write(binascii.a2b_base64(remainder + b'=' * (-len(remainder) % 4)))
+    
+    def getbuffer(self):
+        if self.spooled:
+            self._file.seek(0)
+            return memoryview(self._file.read())
+        return self._file.getbuffer()
+    
+    def getvalue(self):
+        if self.spooled:
+            self._file.seek(0)
+            return self._file.read()
+        return self._file.getvalue()
+    
+    def save(self, file_path):
+        with open(file_path, 'wb') as f:
+            if self.spooled:
+                self._file.seek(0)
+                shutil.copyfileobj(self._file, f)
+            else:
+                f.write(self._file.getbuffer())
+    
+    def close(self):
+        try:
+            self._file.close()
+        except BufferError:
+            pass #A memoryview from getbuffer() is still in use
+    
+    def __len__(self):
+        return self.size
+    
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return self
+
+def remove_files(paths):
+    '''
+    Delete the files, ignoring the ones already gone.
+    Returns (files removed, bytes reclaimed).
+    '''
+    files = 0
+    size  = 0
+    for path in paths:
+        try:
+            file_size = os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        except OSError:
+            logging.getLogger('on_patrol_server').debug(f'Failed to remove {path}', exc_info=True)
+            continue
+        files += 1
+        size  += file_size
+    return files, size
+
+
 def create_sqlite3_table(DBconn, TableName, SetColumns, SetIndexes):
     '''
     TableName:     The table name to create
     SetColumns:    The list of columns to create ['col name', 'data type' [, False]]
-    SetIndexs:     A list of indexs to create
+    SetIndexs:     A list of indexs to create, a list of column names for 
+                   a composite index
     
     Automatically adds a GUID primary key column to every table
     
@@ -352,7 +1302,7 @@ def create_sqlite3_table(DBconn, TableName, SetColumns, SetIndexes):
         if len(column) > 1: ActualColumns.append(column[1])            
     
     #  Add any column that is not yet in the table
-    init_var_types = {'text':'', 'integer':0, 'real':0.}
+    init_var_types = {'text':"''", 'integer':0, 'real':0.}
     for col in SetColumns:
         if col[0] not in ActualColumns and col[0].strip().lower()!='guid':
             stmt = f'ALTER TABLE {TableName} ADD COLUMN {col[0]} {col[1]}'
@@ -362,7 +1312,10 @@ def create_sqlite3_table(DBconn, TableName, SetColumns, SetIndexes):
            
     #Create Indexes for table
     for idx in SetIndexes:
-        DBconn.execute(f'CREATE INDEX IF NOT EXISTS {idx}Index ON {TableName} ({idx} ASC)')
+        if isinstance(idx, (list, tuple)):
+            DBconn.execute(f'CREATE INDEX IF NOT EXISTS {TableName}_{"_".join(idx)}Index ON {TableName} ({", ".join(col+" ASC" for col in idx)})')
+        else:
+            DBconn.execute(f'CREATE INDEX IF NOT EXISTS {idx}Index ON {TableName} ({idx} ASC)')
     
     if hasattr(DBconn,'commit'):
         DBconn.commit() 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Common test routines."""
+
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from Common import EmailTemplateExtractor, TelegramFloodController, \
+    DeepStackProfileResolver, time2seconds
+
+
+HIKVISION_TEMPLATE = {
+    'EVENT_TYPE_RE'               : r'EVENT TYPE:\s*([A-Za-z0-9_\-\s\.]*)\s*[\r|\n]',
+    'EVENT_DATETIME_RE'           : r'EVENT TIME:\s*([0-9]{4}\-[0-9]{2}\-[0-9]{2}),([0-9]{2}\:[0-9]{2}\:[0-9]{2})[\.\s]*[\r|\n]',
+    'CAMERA_NAME_RE'              : r'([N|D]VR|IP[T|C]|IPDOME) NAME:\s*([A-Za-z0-9_\-\s\.]*)\s*[\r|\n]',
+    'SERIAL_NUMBER_RE'            : r'([N|D]VR|IP[T|C]|IPDOME) S/N:\s*([A-Za-z0-9_\-\s\.]*)\s*[\r|\n]',
+    'CHANNEL_NAME_RE'             : r'CHANNEL NAME:\s*([A-Za-z0-9_\-\s\.]*)\s*[\r|\n]',
+    'CHANNEL_NUMBER_RE'           : r'CHANNEL NUMBER:\s*([0-9\-\_]*)\s*[\r|\n]',
+    'TEST_MESSAGE_RE'             : r'^((This e-mail is used to test)|(this is a test mail from))',
+    'TEST_MESSAGE_CAMERA_NAME_RE' : r'this is a test mail from\s*([A-Za-z0-9_\-\s\.]*)\s*[\r|\n]'}
+
+HIKVISION_EMAIL = ('This is an automatically generated e-mail from your DVR.\r\n\r\n'
+                   'EVENT TYPE:    Intrusion Detection\r\n'
+                   'EVENT TIME:    2023-04-01,21:15:42\r\n'
+                   'DVR NAME:      Garden\r\n'
+                   'DVR S/N:       DS-7608NI0120190101\r\n'
+                   'CHANNEL NAME:  Back Gate\r\n'
+                   'CHANNEL NUMBER: 3\r\n')
+
+
+class EmailTemplateExtractorTests(unittest.TestCase):
+    """Test out the one pass email template extraction."""
+
+    def assertSameMatches(self, extractor, text):
+        results = extractor.extract(text)
+        self.assertEqual(set(results.keys()), set(EmailTemplateExtractor.FIELDS))
+        for field in EmailTemplateExtractor.FIELDS:
+            expected = extractor.search(field, text)
+            if expected is None:
+                self.assertIsNone(results[field], field)
+            else:
+                self.assertEqual(results[field].span(), expected.span(), field)
+                self.assertEqual(results[field].groups(), expected.groups(), field)
+
+    def test_extract_hikvision_email(self):
+        """Test the fields of a Hikvision alarm email."""
+        extractor = EmailTemplateExtractor(HIKVISION_TEMPLATE)
+        self.assertIsNotNone(extractor._combined)
+        results = extractor.extract(HIKVISION_EMAIL)
+        self.assertEqual(results['EVENT_TYPE'].group(1).strip(), 'Intrusion Detection')
+        self.assertEqual(results['EVENT_DATETIME'].groups(), ('2023-04-01', '21:15:42'))
+        self.assertEqual(results['CAMERA_NAME'].group(2).strip(), 'Garden')
+        self.assertEqual(results['SERIAL_NUMBER'].group(2).strip(), 'DS-7608NI0120190101')
+        self.assertEqual(results['CHANNEL_NAME'].group(1).strip(), 'Back Gate')
+        self.assertEqual(results['CHANNEL_NUMBER'].group(1).strip(), '3')
+        self.assertSameMatches(extractor, HIKVISION_EMAIL)
+
+    def test_extract_same_as_search(self):
+        """Test that extract() finds the same match as re.search() per field."""
+        extractor = EmailTemplateExtractor(HIKVISION_TEMPLATE)
+        for text in (HIKVISION_EMAIL,
+                     HIKVISION_EMAIL.replace('CHANNEL NAME:  Back Gate\r\n', ''),
+                     'CHANNEL NUMBER: 1\r\nCHANNEL NUMBER: 2\r\nEVENT TYPE: Motion\r\n',
+                     'EVENT TYPE: \r\n',
+                     ''):
+            self.assertSameMatches(extractor, text)
+
+    def test_missing_and_invalid_patterns(self):
+        """Test that fields without a valid pattern never match."""
+        template = dict(HIKVISION_TEMPLATE, CHANNEL_NAME_RE='', SERIAL_NUMBER_RE='([unclosed')
+        with self.assertLogs('on_patrol_server', level='WARNING'):
+            extractor = EmailTemplateExtractor(template)
+        self.assertIsNone(extractor.patterns['CHANNEL_NAME'])
+        self.assertIsNone(extractor.patterns['SERIAL_NUMBER'])
+        results = extractor.extract(HIKVISION_EMAIL)
+        self.assertIsNone(results['CHANNEL_NAME'])
+        self.assertIsNone(results['SERIAL_NUMBER'])
+        self.assertEqual(results['CAMERA_NAME'].group(2).strip(), 'Garden')
+
+    def test_backreference_patterns_searched_one_by_one(self):
+        """Test the fallback for patterns that cannot be combined."""
+        template = dict(HIKVISION_TEMPLATE, CAMERA_NAME_RE=r'(DVR) NAME:\s*(\w+)\s*[\r|\n]\1 S/N')
+        extractor = EmailTemplateExtractor(template)
+        self.assertIsNone(extractor._combined)
+        results = extractor.extract(HIKVISION_EMAIL)
+        self.assertEqual(results['CAMERA_NAME'].group(2), 'Garden')
+        self.assertSameMatches(extractor, HIKVISION_EMAIL)
+
+    def test_search_test_message(self):
+        """Test the fields that are only searched on their own."""
+        extractor = EmailTemplateExtractor(HIKVISION_TEMPLATE)
+        text = 'this is a test mail from Garden\r\n'
+        self.assertIsNotNone(extractor.search('TEST_MESSAGE', text))
+        self.assertEqual(extractor.search('TEST_MESSAGE_CAMERA_NAME', text).group(1).strip(), 'Garden')
+        self.assertIsNone(extractor.search('TEST_MESSAGE', HIKVISION_EMAIL))
+        self.assertIsNone(extractor.search('UNKNOWN_FIELD', text))
+
+
+class TelegramFloodControllerTests(unittest.TestCase):
+    """Test out the telegram rate limits with a fixed clock."""
+
+    def setUp(self):  # pylint:disable=D0102
+        self.now = 1000.0
+        patcher = mock.patch('Common.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_chat_limit(self):
+        """Test one call per second per chat."""
+        flood_controller = TelegramFloodController(chat_time_limit=1, chat_burst_limit=1)
+        self.assertEqual(flood_controller.try_acquire('token', 'chat_1'), 0)
+        self.assertAlmostEqual(flood_controller.try_acquire('token', 'chat_1'), 1)
+        self.assertEqual(flood_controller.try_acquire('token', 'chat_2'), 0)
+        self.now += 0.5
+        self.assertAlmostEqual(flood_controller.try_acquire('token', 'chat_1'), 0.5)
+        self.now += 0.5
+        self.assertEqual(flood_controller.try_acquire('token', 'chat_1'), 0)
+
+    def test_group_limit(self):
+        """Test the group limit on top of the chat limit."""
+        flood_controller = TelegramFloodController(group_time_limit=60, group_burst_limit=2, chat_time_limit=1, chat_burst_limit=1)
+        for i in range(2):
+            self.assertEqual(flood_controller.try_acquire('token', 'group', is_group=True), 0)
+            self.now += 1
+        self.assertAlmostEqual(flood_controller.try_acquire('token', 'group', is_group=True), 58)
+        self.now += 58
+        self.assertEqual(flood_controller.try_acquire('token', 'group', is_group=True), 0)
+
+    def test_token_limit(self):
+        """Test the sliding window of the bot token bucket."""
+        flood_controller = TelegramFloodController(token_time_limit=1, token_burst_limit=3)
+        for chat_id in ('chat_1', 'chat_2', 'chat_3'):
+            self.assertEqual(flood_controller.try_acquire('token', chat_id), 0)
+            self.now += 0.25
+        self.assertAlmostEqual(flood_controller.try_acquire('token', 'chat_4'), 0.25)
+        self.assertEqual(flood_controller.try_acquire('other_token', 'chat_4'), 0)
+        self.now += 0.25
+        self.assertEqual(flood_controller.try_acquire('token', 'chat_4'), 0)
+        self.assertAlmostEqual(flood_controller.try_acquire('token', 'chat_5', api_only=True), 0.25)
+
+    def test_try_acquire_takes_nothing_when_limited(self):
+        """Test that a refused call does not use a slot."""
+        flood_controller = TelegramFloodController(token_time_limit=1, token_burst_limit=2)
+        flood_controller.try_acquire('token', 'chat_1')
+        self.assertGreater(flood_controller.try_acquire('token', 'chat_1'), 0)
+        self.assertEqual(len(flood_controller._buckets[('chat', 'token', 'chat_1')]), 1)
+        self.assertEqual(len(flood_controller._buckets[('token', 'token', '')]), 1)
+
+    def test_housekeeping_reserve(self):
+        """Test that housekeeping calls leave part of the burst to alerts."""
+        flood_controller = TelegramFloodController(token_time_limit=1, token_burst_limit=4, housekeeping_reserve=0.5)
+        housekeeping = TelegramFloodController.HOUSEKEEPING
+        self.assertEqual(flood_controller.try_acquire('token', api_only=True, priority=housekeeping), 0)
+        self.assertEqual(flood_controller.try_acquire('token', api_only=True, priority=housekeeping), 0)
+        self.assertGreater(flood_controller.try_acquire('token', api_only=True, priority=housekeeping), 0)
+        self.assertEqual(flood_controller.try_acquire('token', api_only=True, priority=TelegramFloodController.RETRY), 0)
+        self.assertEqual(flood_controller.try_acquire('token', api_only=True), 0)
+        self.assertGreater(flood_controller.try_acquire('token', api_only=True), 0)
+
+    def test_delay(self):
+        """Test that delay() reserves the next slot and sleeps until it."""
+        flood_controller = TelegramFloodController(chat_time_limit=1, chat_burst_limit=1)
+        sleeps = []
+        async def sleep(seconds):
+            sleeps.append(seconds)
+        async def send_three():
+            with mock.patch('Common.asyncio.sleep', side_effect=sleep):
+                for i in range(3):
+                    await flood_controller.delay('token', 'chat_1')
+        asyncio.run(send_three())
+        self.assertEqual(len(sleeps), 2)
+        self.assertAlmostEqual(sleeps[0], 1)
+        self.assertAlmostEqual(sleeps[1], 2)
+
+    def test_idle_buckets_evicted(self):
+        """Test the least recently used eviction of idle buckets."""
+        flood_controller = TelegramFloodController(chat_time_limit=1, token_time_limit=1, max_buckets=2)
+        flood_controller.try_acquire('token', 'chat_1')
+        flood_controller.try_acquire('token', 'chat_2')
+        #Busy buckets are kept
+        self.assertEqual(len(flood_controller._buckets), 3)
+        self.now += 5
+        flood_controller.try_acquire('token', 'chat_3')
+        self.assertEqual(len(flood_controller._buckets), 2)
+        self.assertNotIn(('chat', 'token', 'chat_1'), flood_controller._buckets)
+        self.assertNotIn(('chat', 'token', 'chat_2'), flood_controller._buckets)
+        self.assertIn(('chat', 'token', 'chat_3'), flood_controller._buckets)
+
+
+class DeepStackProfileResolverTests(unittest.TestCase):
+    """Test out the first match DeepStack camera profile lookup."""
+
+    @staticmethod
+    def profile(min_confidence, start='00:00', stop='00:00', channel_names=[], channel_numbers=[], days=None):
+        profile = {'MIN_CONFIDENCE'  : min_confidence,
+                   'CHANNEL_NAMES'   : channel_names,
+                   'CHANNEL_NUMBERS' : channel_numbers,
+                   'TIME_START'      : datetime.datetime.strptime(start, '%H:%M').time(),
+                   'TIME_STOP'       : datetime.datetime.strptime(stop, '%H:%M').time()}
+        for day in ('MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY', 'SATURDAY', 'SUNDAY'):
+            profile[day] = days is None or day in days
+        return profile
+
+    def test_resolve(self):
+        """Test camera name rules first, then the wildcard rules."""
+        profiles = {'night'  : self.profile(0.6, start='21:00', stop='06:00'),
+                    'gate'   : self.profile(0.7, channel_names=['back gate']),
+                    'sunday' : self.profile(0.8, days=('SUNDAY',)),
+                    'all'    : self.profile(0.5)}
+        resolver = DeepStackProfileResolver(profiles,
+                                            camera_name_index = {'garden': ['night', 'gate']},
+                                            all_cameras_index = {'sunday': ['garden'], 'all': []})
+        monday_night = datetime.datetime(2023, 4, 3, 23, 30)
+        monday_noon  = datetime.datetime(2023, 4, 3, 12, 0)
+        sunday_noon  = datetime.datetime(2023, 4, 9, 12, 0)
+        self.assertEqual(resolver.resolve('Garden', 'Front', '1', monday_night)[0], 'night')
+        self.assertEqual(resolver.resolve('Garden', 'Back Gate', '2', monday_noon)[0], 'gate')
+        self.assertEqual(resolver.resolve('Garden', 'Front', '1', sunday_noon)[0], 'all')
+        self.assertEqual(resolver.resolve('Street', 'Front', '1', sunday_noon)[0], 'sunday')
+        self.assertEqual(resolver.resolve('Street', 'Front', '1', monday_noon)[0], 'all')
+
+    def test_no_match(self):
+        """Test that None is returned when no rule matches."""
+        resolver = DeepStackProfileResolver({'weekend': self.profile(0.5, days=('SATURDAY', 'SUNDAY'))},
+                                            camera_name_index = {},
+                                            all_cameras_index = {'weekend': []})
+        self.assertIsNone(resolver.resolve('Garden', '', '1', datetime.datetime(2023, 4, 3, 12, 0)))
+
+
+class Time2SecondsTests(unittest.TestCase):
+    """Test out the D:H:M keep time parsing."""
+
+    def test_time2seconds(self):
+        self.assertEqual(time2seconds('00:00:05'), 300)
+        self.assertEqual(time2seconds('00:01:00'), 3600)
+        self.assertEqual(time2seconds('01:00:00'), 86400)
+
+
+if __name__ == "__main__":
+    unittest.main()
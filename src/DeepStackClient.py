@@ -1,14 +1,211 @@
-import os
+import os, abc
 import asyncio, threading, aiohttp
-from calendar import day_name
-from Common import SyncCall, TermToken
+from Common import TermToken
 from aiofiles import os as aio_os
 aio_isdir  = aio_os.wrap(os.path.isdir)
 aio_isfile = aio_os.wrap(os.path.isfile)
 
 import logging
 logger = logging.getLogger('on_patrol_server')
-   
+
+
+class DeepStackAPI():
+    '''
+    Long-lived connection to the DeepStack server, create one per event loop.
+      -> One aiohttp session, the TCPConnector keeps up to CONNECTION_POOL_SIZE
+         connections alive for KEEPALIVE_TIMEOUT_SEC between requests
+      -> At most MAX_CONCURRENT_REQUESTS requests run at the same time, the
+         rest wait their turn
+      -> Requests time out after REQUEST_TIMEOUT_SEC (CONNECT_TIMEOUT_SEC to
+         connect)
+    '''
+    DETECTION_PATH = '/v1/vision/detection'
+    
+    def __init__(self, config):
+        self.config = config
+        self._session = None
+        self._semaphore = asyncio.Semaphore(max(config['DEEPSTACK']['MAX_CONCURRENT_REQUESTS'], 1))
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit             = self.config['DEEPSTACK']['CONNECTION_POOL_SIZE'],
+                                             keepalive_timeout = self.config['DEEPSTACK']['KEEPALIVE_TIMEOUT_SEC'])
+            timeout = aiohttp.ClientTimeout(total   = self.config['DEEPSTACK']['REQUEST_TIMEOUT_SEC'] or None,
+                                            connect = self.config['DEEPSTACK']['CONNECT_TIMEOUT_SEC'] or None)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def detect(self, image_data, min_confidence, detection_zones = [], name=''):
+        '''
+        Returns
+        -------
+        List of detected object labels, ['DeepStackFailed'] if the detection failed
+        '''
+        data={'min_confidence': str(min_confidence),
+              'image'         : image_data}
+        if self.config['DEEPSTACK']['API_KEY']:
+            data['api_key'] = self.config['DEEPSTACK']['API_KEY']
+        labels = []
+        
+        async with self._semaphore:
+            try:
+                async with self._get_session().post(self.config['DEEPSTACK']['URL'] + self.DETECTION_PATH, data=data) as resp:
+                    if resp.ok:
+                        result = await resp.json()
+                        if result['success']:
+                            if detection_zones:
+                                # TODO: can add a check to make sure object is in detection zone
+                                labels = [obj['label'] for obj in result['predictions']] # REPLACE TODO
+                            else:
+                                labels = [obj['label'] for obj in result['predictions']]
+                        else:
+                            labels.append('DeepStackFailed')
+                            logger.debug(f'[DeepStackQuery]   {name}: Detection failed: {result["error"]}')
+                    else:
+                        labels.append('DeepStackFailed')
+                        logger.debug(f'[DeepStackQuery]   {name}: {resp.status} {await resp.text()}')
+            except Exception as ex:
+                labels.append('DeepStackFailed')
+                logger.error(f'[DeepStackQuery]   {name}: Failed: {str(ex)}')
+        return labels
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class InferenceBackend(abc.ABC):
+    '''
+    Interface of the InferenceScheduler backends. 
+    detect_batch() gets a list of (image_data, min_confidence, name) requests
+    and returns one list of detected labels per request, in the same order.
+    '''
+    @abc.abstractmethod
+    async def detect_batch(self, requests):
+        pass
+    
+    async def close(self):
+        pass
+
+
+class DeepStackBackend(InferenceBackend):
+    '''Sends the requests of a batch concurrently through one DeepStackAPI client'''
+    def __init__(self, config):
+        self.api = DeepStackAPI(config)
+    
+    async def detect_batch(self, requests):
+        return await asyncio.gather(*[self.api.detect(image_data, min_confidence, name=name) for image_data, min_confidence, name in requests])
+    
+    async def close(self):
+        await self.api.close()
+
+
+class LocalBackend(InferenceBackend):
+    '''
+    Stand-in detector that never leaves the process, to benchmark the 
+    scheduler offline. Every image "detects" labels after latency_ms per 
+    batch plus image_latency_ms per image.
+    '''
+    def __init__(self, labels=[], latency_ms=20, image_latency_ms=5):
+        self.labels = list(labels)
+        self.latency_ms = latency_ms
+        self.image_latency_ms = image_latency_ms
+        self.batches = 0
+        self.images = 0
+    
+    async def detect_batch(self, requests):
+        self.batches += 1
+        self.images += len(requests)
+        await asyncio.sleep((self.latency_ms + self.image_latency_ms*len(requests))/1000)
+        return [list(self.labels) for request in requests]
+
+
+class InferenceScheduler():
+    '''
+    Collects the detection requests of all events into micro-batches and 
+    fans the results back out to the waiting events.
+      -> A batch is dispatched batch_window_ms after its first request, or 
+         as soon as it holds batch_max_images images
+      -> workers batches are processed at the same time by the backend, the
+         other batches wait their turn
+    detect() has the same contract as DeepStackAPI.detect(). Create one per 
+    event loop.
+    '''
+    def __init__(self, backend, batch_window_ms=20, batch_max_images=8, workers=4):
+        self.backend = backend
+        self.batch_window = max(batch_window_ms, 0)/1000
+        self.batch_max_images = max(batch_max_images, 1)
+        self.workers = max(workers, 1)
+        self._pending = []        #List of (request, future) of the open batch
+        self._flush_handle = None
+        self._batches = None      #asyncio.Queue of batches waiting for a worker
+        self._worker_tasks = []
+    
+    def _start_workers(self):
+        loop = asyncio.get_running_loop()
+        self._batches = asyncio.Queue()
+        self._worker_tasks = [loop.create_task(self._worker()) for i in range(self.workers)]
+    
+    async def detect(self, image_data, min_confidence, name=''):
+        if self._batches is None:
+            self._start_workers()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(((image_data, min_confidence, name), future))
+        if len(self._pending) >= self.batch_max_images:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush)
+        return await future
+    
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending:
+            batch, self._pending = self._pending, []
+            self._batches.put_nowait(batch)
+    
+    async def _worker(self):
+        while True:
+            batch = await self._batches.get()
+            try:
+                results = await self.backend.detect_batch([request for request, future in batch])
+            except Exception as ex:
+                logger.error(f'[InferenceScheduler] Batch of {len(batch)} images failed: {str(ex)}')
+                results = [['DeepStackFailed'] for request in batch]
+            finally:
+                self._batches.task_done()
+            for (request, future), labels in zip(batch, results):
+                if not future.done():
+                    future.set_result(labels)
+            if len(results) < len(batch):
+                logger.error(f'[InferenceScheduler] Backend returned {len(results)} results for a batch of {len(batch)} images')
+                for request, future in batch[len(results):]:
+                    if not future.done():
+                        future.set_exception(RuntimeError(f'No detection result for {request[2]}'))
+    
+    async def close(self):
+        if self._batches is not None:
+            self._flush()
+            await self._batches.join()
+            for task in self._worker_tasks:
+                task.cancel()
+        await self.backend.close()
+
+
+def create_inference_scheduler(config):
+    '''Create the InferenceScheduler for the DEEPSTACK INFERENCE_BACKEND in the config'''
+    if config['DEEPSTACK']['INFERENCE_BACKEND'] == 'local':
+        backend = LocalBackend()
+    else:
+        backend = DeepStackBackend(config)
+    return InferenceScheduler(backend          = backend,
+                              batch_window_ms  = config['DEEPSTACK']['BATCH_WINDOW_MS'],
+                              batch_max_images = config['DEEPSTACK']['BATCH_MAX_IMAGES'],
+                              workers          = config['DEEPSTACK']['INFERENCE_WORKERS'])
+
+
 class DeepStackClient(threading.Thread):
     def __init__(self, IncomingQueue, OutgoingQueues, Config):    
         threading.Thread.__init__(self)
@@ -36,17 +233,22 @@ class DeepStackClient(threading.Thread):
             self.loop=asyncio.get_running_loop()
         except:
             self.loop=asyncio.new_event_loop()
+        self.inference = create_inference_scheduler(self.config)
+        handlers = set()
         while(True):
             try:
-                item = await SyncCall(self.incoming_queue.get, None)
+                item = await self.incoming_queue.aget()
                 if isinstance(item, TermToken):
                     logger.debug('[DeepStackClient]  TERMINATION REQUEST RECEIVED, terminating service')
                     break
-                self.loop.create_task(self.IncomingHandler(item))   
+                task = self.loop.create_task(self.IncomingHandler(item))
+                handlers.add(task)
+                task.add_done_callback(handlers.discard)
             except Exception as ex:
                 logger.error(f'[DeepStackClientMain]  {str(ex)}', exc_info=True)
-        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-        await asyncio.gather(*tasks)
+        #Let the events in progress finish, the scheduler workers run until close()
+        await asyncio.gather(*handlers)
+        await self.inference.close()
 
     async def IncomingHandler(self, item):
         logger.debug(f'[DeepStackClient]  {str(item["IPC_NAME"])}: received {str(len(item["IMAGES"]))} images')
@@ -54,13 +256,11 @@ class DeepStackClient(threading.Thread):
             CameraProfile = self.GetCameraProfile(item)
             if item['IMAGES']:
                 if CameraProfile:
-                    async with aiohttp.ClientSession() as session:
-                        try:
-                            results = await asyncio.gather(*[self.DeepStackQuery(session, CameraProfile['MIN_CONFIDENCE'], img['payload'], name=str(item['IPC_NAME'])) for img in item['IMAGES']])
-                        except Exception as resultexp:
-                            logger.error('[DeepStackClient]  ' + str(item['IPC_NAME']) + ': Failed to perform object detection, ' +str(resultexp) )
-                        finally:
-                            await session.close()
+                    results = []
+                    try:
+                        results = await asyncio.gather(*[self.inference.detect(img['payload'].getbuffer(), CameraProfile['MIN_CONFIDENCE'], name=str(item['IPC_NAME'])) for img in item['IMAGES']])
+                    except Exception as resultexp:
+                        logger.error('[DeepStackClient]  ' + str(item['IPC_NAME']) + ': Failed to perform object detection, ' +str(resultexp) )
                     unique_objects = [obj.lower() for obj in set(sum(results, [])) if isinstance(obj, str)]
                     if unique_objects:
                         item['EVENT_TYPE'].extend(unique_objects) 
@@ -73,102 +273,15 @@ class DeepStackClient(threading.Thread):
             logger.error('[DeepStackClient]  ' + str(item['IPC_NAME']) + ': Failed to perform object detection, ' +str(ex) )
         
         for queue in self.outgoing_queues.values():
-            await SyncCall(queue.put, None, item)
-
-    async def DeepStackQuery(self, session, min_confidence, image_data, detection_zones = [], name=''):
-        data={'min_confidence': str(min_confidence),
-              'image'         : image_data}
-        if self.config['DEEPSTACK']['API_KEY']:
-            data['api_key'] = self.config['DEEPSTACK']['API_KEY']
-        labels = []
-        
-        try:
-            async with session.post(self.config['DEEPSTACK']['URL'], data=data, timeout=90) as resp:
-                result = await resp.json()
-                if resp.ok:
-                    if result['success']:
-                        if detection_zones:
-                            # TODO: can add a check to make sure object is in detection zone
-                            labels = [obj['label'] for obj in result['predictions']] # REPLACE TODO
-                        else:
-                            labels = [obj['label'] for obj in result['predictions']]
-                    else:
-                        labels.append('DeepStackFailed')
-                        logger.debug(f'[DeepStackQuery]   {name}: {str(id(session))}: Detection failed: {result["error"]}')
-                else:
-                    labels.append('DeepStackFailed')
-                    logger.debug(f'[DeepStackQuery]   {name}: {str(id(session))}: {resp.text}')
-        except Exception as ex:
-            labels.append('DeepStackFailed')
-            logger.error(f'[DeepStackQuery]   {name}: {str(id(session))}: Failed: {str(ex)}')
-        return labels
+            await queue.aput(item)
 
     def GetCameraProfile(self, item):
-        # Check for individual camera name rules
-        if item['IPC_NAME'].lower() in self.config['DEEPSTACK']['CAMERA_NAME_INDEX'].keys():
-            profile_keys = self.config['DEEPSTACK']['CAMERA_NAME_INDEX'][item['IPC_NAME'].lower()]
-            logger.debug(f'[DeepStackClient]  {str(item["IPC_NAME"])}: using profile {str(profile_keys)}')
-            for key in profile_keys:
-                profile = self.config['DEEPSTACK']['CAMERA_PROFILES'][key]
-                #Check channel names
-                if profile['CHANNEL_NAMES']:
-                    if item['CHANNEL_NAME'].lower() not in profile['CHANNEL_NAMES']:
-                        continue
-                #Check channel numbers
-                if profile['CHANNEL_NUMBERS']:
-                    if item['CHANNEL_NUMBER'].lower() not in profile['CHANNEL_NUMBERS']:
-                        continue
-                #Check weekday
-                if not profile[day_name[item['EVENT_TIME'].weekday()].upper()]:
-                    continue
-                #Check time slot
-                if profile['TIME_START'] > profile['TIME_STOP']:
-                    if item['EVENT_TIME'].time() < profile['TIME_STOP'] or item['EVENT_TIME'].time() >= profile['TIME_START']:
-                        return profile
-                elif profile['TIME_START'] < profile['TIME_STOP']:
-                    if item['EVENT_TIME'].time() < profile['TIME_STOP'] and item['EVENT_TIME'].time() >= profile['TIME_START']:
-                        return profile
-                else:
-                    return profile
-
-        # Check for rules that apply to all camera (wildcard *)
-        #   Note: keys in DEEPSTACK_ALL_CAMERAS_INDEX are also the keys in 
-        #   DEEPSTACK_CAMERA_PROFILES. The values in DEEPSTACK_ALL_CAMERAS_INDEX
-        #   are a list of camera names to ignore.
-        for key in self.config['DEEPSTACK']['ALL_CAMERAS_INDEX'].keys():
-            #Check if camera name is excluded from wildcard
-            if item['IPC_NAME'].lower() in self.config['DEEPSTACK']['ALL_CAMERAS_INDEX'][key]:
-                continue
-            
-            profile = self.config['DEEPSTACK']['CAMERA_PROFILES'][key]
-            #Check channel names
-            if profile['CHANNEL_NAMES']:
-                if item['CHANNEL_NAME'].lower() not in profile['CHANNEL_NAMES']:
-                    continue
-            #Check channel numbers
-            if profile['CHANNEL_NUMBERS']:
-                if item['CHANNEL_NUMBER'].lower() not in profile['CHANNEL_NUMBERS']:
-                    continue
-            #Check weekday
-            if not profile[day_name[item['EVENT_TIME'].weekday()].upper()]:
-                continue
-            #Check time slot
-            if profile['TIME_START'] > profile['TIME_STOP']:
-                if item['EVENT_TIME'].time() < profile['TIME_STOP'] or item['EVENT_TIME'].time() >= profile['TIME_START']:
-                    logger.debug('[DeepStackClient]  ' + str(item['IPC_NAME']) + ': using profile ' + str(key))
-                    return profile
-            elif profile['TIME_START'] < profile['TIME_STOP']:
-                if item['EVENT_TIME'].time() < profile['TIME_STOP'] and item['EVENT_TIME'].time() >= profile['TIME_START']:
-                    logger.debug('[DeepStackClient]  ' + str(item['IPC_NAME']) + ': using profile ' + str(key))
-                    return profile
-            else:
-                logger.debug('[DeepStackClient]  ' + str(item['IPC_NAME']) + ': using profile ' + str(key))
-                return profile
-            
-        return None
-        
-
-
-
-
-
+        resolved = self.config['DEEPSTACK']['PROFILE_RESOLVER'].resolve(camera_name    = item['IPC_NAME'],
+                                                                        channel_name   = item['CHANNEL_NAME'],
+                                                                        channel_number = item['CHANNEL_NUMBER'],
+                                                                        event_time     = item['EVENT_TIME'])
+        if resolved is None:
+            return None
+        key, profile = resolved
+        logger.debug('[DeepStackClient]  ' + str(item['IPC_NAME']) + ': using profile ' + str(key))
+        return profile
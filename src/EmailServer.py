@@ -1,11 +1,14 @@
 from email import message_from_bytes, message_from_string
+from email.parser import BytesHeaderParser
+import quopri
 import queue
 from aiosmtpd.controller import Controller as SMTPController
 import html2text
 import encodings.idna #Keep import, fixes an idna error that sometimes happen
-import datetime, re
+import datetime, binascii
 from dateutil.parser import parse as datetime_parser
-from Common import xstr, get_ctype_file_extension, SyncCall, csv2list
+from Common import xstr, get_ctype_file_extension, csv2list, MediaAttachment, \
+                   EmailTemplateExtractor
 import os
 import logging
 logger = logging.getLogger('on_patrol_server')
@@ -22,6 +25,9 @@ class SMTP_Controller_Handler:
          is parsed and alert details are stored as a new entry in the alert DB.
       -> Any attached images are saved to file and the file names are recorded 
          in the alert DB.
+      -> With SMTP STREAM_ATTACHMENTS enabled the MIME parts are located in 
+         the raw message data, only text parts are decoded eagerly and the
+         attachments are decoded straight into MediaAttachment handles.
     '''
     
     
@@ -45,12 +51,17 @@ class SMTP_Controller_Handler:
 
     async def handle_DATA(self, server, session, envelope):
         notification_item = None
-        envelope = self.prepare_message(session, envelope)
+        raw_content = None
+        if self.config['SMTP'].get('STREAM_ATTACHMENTS', False) and isinstance(envelope.content, bytes):
+            raw_content = envelope.content
+            envelope = self.prepare_message_headers(session, envelope)
+        else:
+            envelope = self.prepare_message(session, envelope)
         email_address = envelope['X-RcptTo'].strip().lower()
         if email_address in self.config['CAMERAS']['EMAIL_INDEX'].keys():
             template_key  = self.config['CAMERAS']['EMAIL_INDEX'][email_address]['EMAIL_TEMPLATE']
             logger.debug(f'[EmailServer]      {email_address} : parsing registered email with email template: {template_key}')
-            parsed_msg = self.parse_message(envelope, template_key)
+            parsed_msg = self.parse_message(envelope, template_key, raw_content)
             if parsed_msg:
                 camera_config_key = self.config['CAMERAS']['EMAIL_INDEX'][email_address]['CHANNEL'].get(parsed_msg['CHANNEL_NUMBER'],None)
                 if camera_config_key:
@@ -60,7 +71,7 @@ class SMTP_Controller_Handler:
         elif email_address in self.config['UNREGISTERED_CAMERAS']['EMAIL_INDEX'].keys():
             template_key = self.config['UNREGISTERED_CAMERAS']['EMAIL_INDEX'][email_address]
             logger.debug(f'[EmailServer]      {email_address} : parsing unregistered camera with email template: {template_key}')
-            parsed_msg = self.parse_message(envelope, template_key)
+            parsed_msg = self.parse_message(envelope, template_key, raw_content)
             if parsed_msg:
                 notification_item = self.handle_unregistered_camera(parsed_msg)           
         else:
@@ -72,7 +83,7 @@ class SMTP_Controller_Handler:
         else:
             try:
                 for q in self.OutgoingQueues.values():
-                    await SyncCall(q.put, None, notification_item)        
+                    await q.aput(notification_item)
             except queue.Full:
                 return '421 incoming queue full, try again later'
 
@@ -93,6 +104,15 @@ class SMTP_Controller_Handler:
         message['X-RcptTo'] = ', '.join(envelope.rcpt_tos)
         return message
     
+    def prepare_message_headers(self, session, envelope):
+        '''Same as prepare_message(), but only parses the headers of the message'''
+        data = envelope.content
+        message = BytesHeaderParser(self.message_class).parsebytes(data[:split_headers(data, 0, len(data))[1]])
+        message['X-Peer'] = xstr(session.peer)
+        message['X-MailFrom'] = envelope.mail_from
+        message['X-RcptTo'] = ', '.join(envelope.rcpt_tos)
+        return message
+    
     def handle_unregistered_camera(self, parsed_msg):
         parsed_msg.update({'CAMERA_ID'  : None})
         parsed_msg.update({'CAMERA_NAME': parsed_msg['IPC_NAME']})
@@ -127,25 +147,27 @@ class SMTP_Controller_Handler:
             
         return parsed_msg
     
-    def parse_message(self, Message, template_key):
+    def parse_message(self, Message, template_key, raw_content=None):
         template = self.config['SMTP']['EMAIL_TEMPLATES'].get(template_key.lower(), None)
         if template is None:
             logger.error(f'[EmailServer]      {Message["X-RcptTo"]} : Cannot parse email, invalid email template key: {template_key}')
             return None
         
         #Return the email body text and images
-        [msgtext,images,videos] = self.get_content_from_message(Message)
+        if raw_content is not None:
+            [msgtext,images,videos] = self.stream_content_from_message(raw_content)
+        else:
+            [msgtext,images,videos] = self.get_content_from_message(Message)
 
+        extractor = template.get('EXTRACTOR') or EmailTemplateExtractor(template)
+        
         #Check if test email
-        if template['TEST_MESSAGE_RE'] != '':
-            re_sult = re.search(template['TEST_MESSAGE_RE'], msgtext)
-        else:
-            re_sult = None
+        re_sult = extractor.search('TEST_MESSAGE', msgtext)
             
         if re_sult is not None:
             if template['TEST_MESSAGE_CAMERA_NAME_RE']:
                 try:
-                    re_sult = re.search(template['TEST_MESSAGE_CAMERA_NAME_RE'],msgtext)
+                    re_sult = extractor.search('TEST_MESSAGE_CAMERA_NAME', msgtext)
                     IPC_NAME = re_sult[template['TEST_MESSAGE_CAMERA_NAME_GROUP']].strip() if re_sult is not None else ''
                 except:
                     IPC_NAME = 'unkown_camera'
@@ -157,58 +179,45 @@ class SMTP_Controller_Handler:
             CHANNEL_NAME = 'test'
             CHANNEL_NUMBER = '1'
         else:
-            if template['EVENT_TYPE_RE']:
-                try:
-                    re_sult = re.search(template['EVENT_TYPE_RE'],msgtext)
+            fields = extractor.extract(msgtext)
+            
+            try:
+                re_sult = fields['EVENT_TYPE']
+                if template['EVENT_TYPE_RE']:
                     EVENT_TYPE = csv2list(re_sult[template['EVENT_TYPE_GROUP']].strip() if re_sult is not None else '')
-                except:
+                else:
                     EVENT_TYPE = ['']
-            else:
+            except:
                 EVENT_TYPE = ['']
             
-            if template['EVENT_DATETIME_RE']:
-                try:
-                    re_sult = re.search(template['EVENT_DATETIME_RE'],msgtext)
-                    EVENT_TIME = datetime_parser(re_sult[template['EVENT_DATE_GROUP']]+'T'+re_sult[template['EVENT_TIME_GROUP']]) if re_sult is not None else datetime.datetime.now()
-                except:
-                    EVENT_TIME =  datetime.datetime.now()
-            else:
+            try:
+                re_sult = fields['EVENT_DATETIME']
+                EVENT_TIME = parse_event_datetime(re_sult[template['EVENT_DATE_GROUP']], re_sult[template['EVENT_TIME_GROUP']], template.get('EVENT_DATETIME_FORMAT', '')) if re_sult is not None else datetime.datetime.now()
+            except:
                 EVENT_TIME =  datetime.datetime.now()
             
-            if template['CAMERA_NAME_RE']:
-                try:
-                    re_sult = re.search(template['CAMERA_NAME_RE'],msgtext)
-                    IPC_NAME = re_sult[template['CAMERA_NAME_GROUP']].strip() if re_sult is not None else 'unknown_camera'
-                except:
-                    IPC_NAME = 'unknown_camera'
-            else:
+            try:
+                re_sult = fields['CAMERA_NAME']
+                IPC_NAME = re_sult[template['CAMERA_NAME_GROUP']].strip() if re_sult is not None else 'unknown_camera'
+            except:
                 IPC_NAME = 'unknown_camera'
             
-            if template['SERIAL_NUMBER_RE']:
-                try:
-                    re_sult = re.search(template['SERIAL_NUMBER_RE'],msgtext)
-                    IPC_SN = re_sult[template['SERIAL_NUMBER_GROUP']].strip() if re_sult is not None else ''
-                except:
-                    IPC_SN = ''
-            else:
+            try:
+                re_sult = fields['SERIAL_NUMBER']
+                IPC_SN = re_sult[template['SERIAL_NUMBER_GROUP']].strip() if re_sult is not None else ''
+            except:
                 IPC_SN = ''
             
-            if template['CHANNEL_NAME_RE']:
-                try:
-                    re_sult = re.search(template['CHANNEL_NAME_RE'],msgtext)
-                    CHANNEL_NAME = re_sult[template['CHANNEL_NAME_GROUP']].strip() if re_sult is not None else IPC_NAME
-                except:
-                    CHANNEL_NAME = IPC_NAME
-            else:
+            try:
+                re_sult = fields['CHANNEL_NAME']
+                CHANNEL_NAME = re_sult[template['CHANNEL_NAME_GROUP']].strip() if re_sult is not None else IPC_NAME
+            except:
                 CHANNEL_NAME = IPC_NAME
             
-            if template['CHANNEL_NUMBER_RE']:
-                try:
-                    re_sult = re.search(template['CHANNEL_NUMBER_RE'],msgtext)            
-                    CHANNEL_NUMBER = re_sult[template['CHANNEL_NUMBER_GROUP']].strip() if re_sult is not None else '1'
-                except:
-                    CHANNEL_NUMBER = '1'
-            else:
+            try:
+                re_sult = fields['CHANNEL_NUMBER']
+                CHANNEL_NUMBER = re_sult[template['CHANNEL_NUMBER_GROUP']].strip() if re_sult is not None else '1'
+            except:
                 CHANNEL_NUMBER = '1'
 
                    
@@ -234,32 +243,141 @@ class SMTP_Controller_Handler:
                 text_parts.append( part.get_payload(decode=True).decode('utf-8') ) #decode and utf-8 must be there!
             elif ctype == 'text/html':
                 text_parts.append( html2text.html2text( part.get_payload(decode=True).decode('utf-8') ) )
-            elif ctype.lower().startswith('image/'):
-                part_filename = part.get_filename()
-                if part_filename:
-                    ext = os.path.splitext(part_filename)[1]
-                else:
-                    ext = ''
-                if not ext:
-                    ext = get_ctype_file_extension(ctype)
-                images.append({'type':ext, 'payload':part.get_payload(decode=True)})
-            elif ctype.lower().startswith('application/'):
-                part_filename = part.get_filename()
-                if part_filename:
-                    ext = os.path.splitext(part_filename)[1]
-                else:
-                    ext = ''
-                if str(ext).lower() in ['.jpg', '.jpeg', '.png','.bmp', '.gif']:
-                    images.append({'type':str(ext), 'payload':part.get_payload(decode=True)})
-                elif str(ext).lower() in ['.mp4', '.avi']:
-                    videos.append({'type':str(ext), 'payload':part.get_payload(decode=True)})
-                else:
-                    logger.debug(f'[EmailServer]      Unknown {ctype} email attachment: {ext}')
-            # else:
-            #     logger.debug(f'[EmailServer] Unknown email attachment: {ctype}')
+            else:
+                kind, ext = attachment_kind(ctype, part.get_filename())
+                if kind == 'image':
+                    images.append({'type':ext, 'payload':MediaAttachment(part.get_payload(decode=True))})
+                elif kind == 'video':
+                    videos.append({'type':ext, 'payload':MediaAttachment(part.get_payload(decode=True))})
+        return [''.join(text_parts), images, videos]
+
+    def stream_content_from_message(self, data):
+        '''
+        Extract the text body and attachments from the raw email data without 
+        building the whole message. Attachments are decoded into 
+        MediaAttachment handles, spooled to a temporary file when larger than 
+        SMTP ATTACHMENT_SPOOL_SIZE_KB.
+        '''
+        spool_size = self.config['SMTP'].get('ATTACHMENT_SPOOL_SIZE_KB', 0)*1024
+        text_parts = []
+        images = []
+        videos = []
+        for headers, start, end in iter_mime_parts(data):
+            ctype = headers.get_content_type()
+            if ctype in ('text/plain', 'text/html'):
+                text = decode_part_body(headers, data[start:end]).decode('utf-8') #decode and utf-8 must be there!
+                text_parts.append( html2text.html2text(text) if ctype == 'text/html' else text )
+                continue
+            kind, ext = attachment_kind(ctype, headers.get_filename())
+            if kind is None:
+                continue
+            payload = MediaAttachment(spool_size=spool_size)
+            body = memoryview(data)[start:end]
+            encoding = str(headers.get('Content-Transfer-Encoding', '')).strip().lower()
+            if encoding == 'base64':
+                payload.write_base64(body)
+            elif encoding == 'quoted-printable':
+                payload.write(quopri.decodestring(body))
+            else:
+                payload.write(body)
+            body.release()
+            if kind == 'image':
+                images.append({'type':ext, 'payload':payload})
+            else:
+                videos.append({'type':ext, 'payload':payload})
         return [''.join(text_parts), images, videos]
 
 
+def parse_event_datetime(date_str, time_str, datetime_format=''):
+    '''
+    Parse the event date and time found by the email template. Tries the 
+    template EVENT_DATETIME_FORMAT (strptime format of "date"T"time") or 
+    ISO 8601 first and falls back to dateutil.
+    '''
+    datetime_str = date_str+'T'+time_str
+    try:
+        if datetime_format:
+            return datetime.datetime.strptime(datetime_str, datetime_format)
+        return datetime.datetime.fromisoformat(datetime_str)
+    except ValueError:
+        return datetime_parser(datetime_str)
+
+
+def attachment_kind(ctype, filename):
+    '''Returns ('image'|'video'|None, file extension) for an email part'''
+    if filename:
+        ext = os.path.splitext(filename)[1]
+    else:
+        ext = ''
+    if ctype.lower().startswith('image/'):
+        if not ext:
+            ext = get_ctype_file_extension(ctype)
+        return 'image', ext
+    elif ctype.lower().startswith('application/'):
+        if str(ext).lower() in ['.jpg', '.jpeg', '.png','.bmp', '.gif']:
+            return 'image', str(ext)
+        elif str(ext).lower() in ['.mp4', '.avi']:
+            return 'video', str(ext)
+        else:
+            logger.debug(f'[EmailServer]      Unknown {ctype} email attachment: {ext}')
+    # else:
+    #     logger.debug(f'[EmailServer] Unknown email attachment: {ctype}')
+    return None, ext
+
+
+def split_headers(data, start, end):
+    '''Returns the (body start, header end) positions of the MIME entity in data[start:end]'''
+    for sep in (b'\r\n', b'\n'):
+        if data.startswith(sep, start):
+            return start + len(sep), start #No headers
+    for sep in (b'\r\n\r\n', b'\n\n'):
+        pos = data.find(sep, start, end)
+        if pos >= 0:
+            return pos + len(sep), pos + len(sep)//2
+    return end, end
+
+
+def iter_mime_parts(data, start=0, end=None, _depth=0):
+    '''
+    Yields (headers, body start, body end) for every non-multipart entity in 
+    the raw MIME message data. Only the headers are parsed, the bodies are 
+    left in data.
+    '''
+    if end is None:
+        end = len(data)
+    body_start, header_end = split_headers(data, start, end)
+    headers = BytesHeaderParser().parsebytes(data[start:header_end])
+    boundary = headers.get_boundary()
+    if headers.get_content_maintype() != 'multipart' or not boundary or _depth > 10:
+        yield headers, body_start, end
+        return
+    delimiter = b'--' + boundary.encode('ascii', 'replace')
+    pos = data.find(delimiter, body_start, end)
+    while pos >= 0:
+        part_start = pos + len(delimiter)
+        if data.startswith(b'--', part_start):
+            break #Closing delimiter
+        line_end = data.find(b'\n', part_start, end)
+        if line_end < 0:
+            break
+        next_pos = data.find(b'\n' + delimiter, line_end, end)
+        part_end = end if next_pos < 0 else next_pos
+        if part_end > line_end+1 and data[part_end-1:part_end] == b'\r':
+            part_end -= 1
+        yield from iter_mime_parts(data, line_end+1, part_end, _depth+1)
+        pos = -1 if next_pos < 0 else next_pos + 1
+
+
+def decode_part_body(headers, body):
+    '''Decode the Content-Transfer-Encoding of a MIME part body'''
+    encoding = str(headers.get('Content-Transfer-Encoding', '')).strip().lower()
+    if encoding == 'base64':
+        return binascii.a2b_base64(bytes(body))
+    elif encoding == 'quoted-printable':
+        return quopri.decodestring(body)
+    return bytes(body)
+
+
 def SMTPServer(Hostname, Port, OutgoingQueues, Config):
     server = SMTPController(SMTP_Controller_Handler(OutgoingQueues     = OutgoingQueues,
                                                     Config             = Config), 
@@ -1,11 +1,12 @@
-import json, time, datetime, queue, re
+import json, time, datetime, queue, re, tempfile, shutil, math, functools
 import os, threading, asyncio, aiofiles, aiohttp
 from pathlib import Path
 from Common import make_valid_filename, create_mp4, TermToken, \
-    create_sqlite3_table, SyncCall, csv2list, aioEvent_ts, generate_code
+    create_sqlite3_table, SyncCall, csv2list, aioEvent_ts, generate_code, \
+    aioSqlite3Worker, read_video_frames, read_image_files, MediaProcessPool, \
+    default_media_workers, remove_files, xstr
 from ffmpeg import FFmpeg #pypi.org/project/python-ffmpeg/
-from calendar import day_name
-from deepstack_sdk import ServerConfig, Detection
+from DeepStackClient import create_inference_scheduler
 import logging
 logger = logging.getLogger('on_patrol_server')
 
@@ -13,29 +14,81 @@ logger = logging.getLogger('on_patrol_server')
 class DataBaseManager():
     def __init__(self, DBconn):
         self._DBconn = DBconn
-        self._lock = asyncio.Lock()
+        self._db = aioSqlite3Worker(DBconn)
         
     async def _execute(self, stmt, args):
-        async with self._lock:
-            result = await SyncCall(self._DBconn.execute, None, stmt, args)
-        return result        
+        return await self._db.execute(stmt, args)
+    
+    @staticmethod
+    def image_dir(filename):
+        '''CAMERA_DIR of an image, '.' for the images folder itself as '' marks rows logged before CAMERA_DIR was tracked'''
+        return os.path.dirname(str(filename)) or '.'
     
     async def add_camera_log(self, camera_id, event_type, event_time, ipc_name, ipc_sn, channel_name, channel_number):
         stmt = 'INSERT INTO camera_log (CAMERA_ID, EVENT_TYPE, EVENT_TIME, IPC_NAME, IPC_SN, CHANNEL_NAME, CHANNEL_NUMBER) VALUES (?,?,?,?,?,?,?)'
         args = (camera_id, event_type, event_time, ipc_name, ipc_sn, channel_name, channel_number,)
         return await self._execute(stmt, args)
 
-    async def add_image(self, filename, time, log_guid=''):
+    async def add_image(self, filename, time, log_guid='', camera_id='', size=0):
         if str(filename).strip() == '':
             return       
-        stmt = 'INSERT INTO images (FILENAME, TIME, LOG_GUID) VALUES (?,?,?)'
-        args = (str(filename), int(time), log_guid,)
+        stmt = 'INSERT INTO images (FILENAME, TIME, LOG_GUID, CAMERA_ID, CAMERA_DIR, SIZE) VALUES (?,?,?,?,?,?)'
+        args = (str(filename), int(time), log_guid, xstr(camera_id), self.image_dir(filename), int(size),)
         return await self._execute(stmt, args)
 
-    async def get_images_older_than(self, exp_time):
-        stmt = 'SELECT * FROM images where time <= (?)'
-        args = (exp_time,)
+    async def add_camera_log_and_images(self, camera_id, event_type, event_time, ipc_name, ipc_sn, channel_name, channel_number, filenames, time, sizes=None):
+        '''
+        Insert the camera log entry and its images in one transaction.
+        filenames are relative to the images folder, sizes in bytes.
+        Returns the GUID of the camera log entry.
+        '''
+        sizes      = sizes or [0]*len(filenames)
+        log_args   = (camera_id, event_type, event_time, ipc_name, ipc_sn, channel_name, channel_number,)
+        image_rows = [(str(filename), int(time), xstr(camera_id), self.image_dir(filename), int(size),) 
+                      for filename, size in zip(filenames, sizes) if str(filename).strip() != '']
+        return await self._db.transaction(self._insert_camera_log_and_images, log_args, image_rows)
+
+    @staticmethod
+    def _insert_camera_log_and_images(cursor, log_args, image_rows):
+        cursor.execute('INSERT INTO camera_log (CAMERA_ID, EVENT_TYPE, EVENT_TIME, IPC_NAME, IPC_SN, CHANNEL_NAME, CHANNEL_NUMBER) VALUES (?,?,?,?,?,?,?)', log_args)
+        log_guid = cursor.lastrowid
+        if image_rows:
+            cursor.executemany('INSERT INTO images (FILENAME, TIME, CAMERA_ID, CAMERA_DIR, SIZE, LOG_GUID) VALUES (?,?,?,?,?,?)', [row + (log_guid,) for row in image_rows])
+        return log_guid
+
+    async def get_images_older_than(self, exp_time, limit=-1, exclude_camera_ids=[]):
+        '''Oldest first, at most limit rows (-1 for all)'''
+        stmt = 'SELECT GUID, FILENAME, SIZE FROM images WHERE TIME <= (?)'
+        if exclude_camera_ids:
+            stmt += f" AND IFNULL(CAMERA_ID, '') NOT IN ({','.join('?'*len(exclude_camera_ids))})"
+        stmt += ' ORDER BY TIME LIMIT (?)'
+        args = (exp_time,) + tuple(exclude_camera_ids) + (int(limit),)
+        return await self._execute(stmt,args)
+
+    async def get_camera_images_older_than(self, camera_id, exp_time, limit=-1):
+        '''Oldest first, at most limit rows (-1 for all)'''
+        stmt = 'SELECT GUID, FILENAME, SIZE FROM images WHERE CAMERA_ID = (?) AND TIME <= (?) ORDER BY TIME LIMIT (?)'
+        args = (xstr(camera_id), exp_time, int(limit),)
+        return await self._execute(stmt,args)
+
+    async def get_oldest_camera_dir_images(self, camera_dir, limit=-1):
+        stmt = 'SELECT GUID, FILENAME, SIZE FROM images WHERE CAMERA_DIR = (?) ORDER BY TIME LIMIT (?)'
+        args = (camera_dir, int(limit),)
         return await self._execute(stmt,args)
+
+    async def get_disk_usage(self):
+        '''Bytes used per camera folder, largest first'''
+        stmt = 'SELECT CAMERA_DIR, BYTES FROM image_dir_usage WHERE BYTES > 0 ORDER BY BYTES DESC'
+        return await self._execute(stmt, ())
+
+    async def get_images_without_camera_dir(self, limit=-1):
+        stmt = "SELECT GUID, FILENAME FROM images WHERE CAMERA_DIR = '' LIMIT (?)"
+        args = (int(limit),)
+        return await self._execute(stmt,args)
+
+    async def set_image_dirs_and_sizes(self, rows):
+        '''rows: [(camera_dir, size, guid)]'''
+        return await self._db.executemany('UPDATE images SET CAMERA_DIR = (?), SIZE = (?) WHERE GUID = (?)', rows)
     
     async def delete_image(self, filename):
         if str(filename).strip() == '':
@@ -49,6 +102,13 @@ class DataBaseManager():
         args = (guid,)
         await self._execute(stmt, args) 
 
+    async def delete_image_guids(self, guids):
+        guids = list(guids)
+        if not guids:
+            return
+        stmt = f"DELETE FROM images WHERE GUID IN ({','.join('?'*len(guids))})"
+        await self._execute(stmt, tuple(guids)) 
+
     async def setup_tables(self):  
         # create_sqlite3_table() automatically adds a GUID primary key column
         # create camera log table
@@ -62,24 +122,180 @@ class DataBaseManager():
         indexs = ['CAMERA_ID', 'EVENT_TYPE', 'EVENT_TIME', 'IPC_NAME','IPC_SN' ,'CHANNEL_NUMBER']
         await SyncCall(create_sqlite3_table, None, self._DBconn, 'camera_log', columns, indexs)
         # Create images table
-        columns = [['FILENAME', 'text'], 
-                   ['TIME'    , 'integer'], 
-                   ['LOG_GUID', 'integer']]
-        indexs  = ['FILENAME' , 'TIME', 'LOG_GUID']
+        columns = [['FILENAME'  , 'text'], 
+                   ['TIME'      , 'integer'], 
+                   ['LOG_GUID'  , 'integer'],
+                   ['CAMERA_ID' , 'text'],
+                   ['CAMERA_DIR', 'text'],
+                   ['SIZE'      , 'integer']]
+        indexs  = ['FILENAME' , 'TIME', 'LOG_GUID', ['CAMERA_ID', 'TIME'], ['CAMERA_DIR', 'TIME', 'SIZE']]
         await SyncCall(create_sqlite3_table, None, self._DBconn, 'images', columns, indexs)
+        await self._db.transaction(self._setup_image_dir_usage)
         logger.debug('[Recorder]         Tables set up')
 
+    @staticmethod
+    def _setup_image_dir_usage(cursor):
+        '''
+        Bytes per CAMERA_DIR of the images table, kept up to date by triggers
+        on every insert, delete and update of images, so the disk quota check
+        does not have to sum the images table.
+        '''
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'image_dir_usage'")
+        exists = cursor.fetchone() is not None
+        cursor.execute('CREATE TABLE IF NOT EXISTS image_dir_usage (CAMERA_DIR text NOT NULL PRIMARY KEY, BYTES integer NOT NULL DEFAULT 0)')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS images_dir_usage_insert AFTER INSERT ON images BEGIN
+                              INSERT OR IGNORE INTO image_dir_usage (CAMERA_DIR) VALUES (IFNULL(NEW.CAMERA_DIR, ''));
+                              UPDATE image_dir_usage SET BYTES = BYTES + IFNULL(NEW.SIZE, 0) WHERE CAMERA_DIR = IFNULL(NEW.CAMERA_DIR, '');
+                          END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS images_dir_usage_delete AFTER DELETE ON images BEGIN
+                              UPDATE image_dir_usage SET BYTES = BYTES - IFNULL(OLD.SIZE, 0) WHERE CAMERA_DIR = IFNULL(OLD.CAMERA_DIR, '');
+                          END''')
+        cursor.execute('''CREATE TRIGGER IF NOT EXISTS images_dir_usage_update AFTER UPDATE OF CAMERA_DIR, SIZE ON images BEGIN
+                              UPDATE image_dir_usage SET BYTES = BYTES - IFNULL(OLD.SIZE, 0) WHERE CAMERA_DIR = IFNULL(OLD.CAMERA_DIR, '');
+                              INSERT OR IGNORE INTO image_dir_usage (CAMERA_DIR) VALUES (IFNULL(NEW.CAMERA_DIR, ''));
+                              UPDATE image_dir_usage SET BYTES = BYTES + IFNULL(NEW.SIZE, 0) WHERE CAMERA_DIR = IFNULL(NEW.CAMERA_DIR, '');
+                          END''')
+        if not exists:
+            #Existing database, count the images logged so far once
+            cursor.execute('''INSERT INTO image_dir_usage (CAMERA_DIR, BYTES) 
+                              SELECT IFNULL(CAMERA_DIR, ''), SUM(IFNULL(SIZE, 0)) FROM images GROUP BY IFNULL(CAMERA_DIR, '')''')
+
+
+class RtspPreRollBuffer():
+    '''
+    Keeps the last seconds of a camera RTSP feed as a ring of short MPEG-TS 
+    segments in buffer_dir (stream copy, no re-encode), so an event clip can 
+    be cut from segments already on disk instead of opening a new RTSP 
+    session after the notification arrives.
+    '''
+    RESTART_DELAY_SEC = 5
+    
+    def __init__(self, name, url, buffer_dir, preroll_sec=2, max_length_sec=4, segment_sec=1):
+        self.name           = name
+        self.url            = url
+        self.buffer_dir     = buffer_dir
+        self.preroll_sec    = preroll_sec
+        self.max_length_sec = max_length_sec
+        self.segment_sec    = max(1, segment_sec)
+        # Segments are cut on keyframes so are never shorter than segment_sec. 
+        # Spares cover the segment being written and clips still being copied.
+        self.segment_count  = int(math.ceil((preroll_sec + max_length_sec) / self.segment_sec)) + 3
+        self.task           = None
+        self._ffmpeg        = None
+        self._running       = False
+        self._stop_event    = None
+    
+    def start(self, loop):
+        self._stop_event = asyncio.Event()
+        self.task = loop.create_task(self.run())
+    
+    def stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+        if self._running:
+            try:
+                self._ffmpeg.terminate()
+            except Exception:
+                pass
+    
+    def is_running(self):
+        return self._running
+    
+    async def run(self):
+        while not self._stop_event.is_set():
+            shutil.rmtree(self.buffer_dir, ignore_errors=True)
+            os.makedirs(self.buffer_dir, exist_ok=True)
+            self._ffmpeg = (FFmpeg()
+                            .option('y')
+                            .option('an')
+                            .input(str(self.url),
+                                   rtsp_transport='tcp',
+                                   timeout='5000000',
+                                   rtsp_flags='prefer_tcp')
+                            .output(os.path.join(self.buffer_dir, 'seg_%03d.ts'),
+                                    {'map' : '0:v', 'c:v' : 'copy', 'f' : 'segment'},
+                                    segment_time     = str(self.segment_sec),
+                                    segment_wrap     = str(self.segment_count),
+                                    reset_timestamps = '1'))
+            logger.debug(f'[Recorder]         {self.name} Pre-roll capture started')
+            self._running = True
+            try:
+                await self._ffmpeg.execute()
+            except Exception as ex:
+                if not self._stop_event.is_set():
+                    logger.warning(f'[Recorder]         {self.name} Pre-roll capture stopped. {str(ex)}')
+            finally:
+                self._running = False
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.RESTART_DELAY_SEC)
+            except asyncio.TimeoutError:
+                pass
+        shutil.rmtree(self.buffer_dir, ignore_errors=True)
+        logger.debug(f'[Recorder]         {self.name} Pre-roll capture stopped')
+    
+    def segments(self):
+        '''
+        Returns the buffered segments as [(start_time, end_time, path)], 
+        oldest first. The last one is still being written; its end_time is 
+        its latest modification time.
+        '''
+        try:
+            entries = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(self.buffer_dir)
+                             if entry.name.startswith('seg_') and entry.name.endswith('.ts'))
+        except FileNotFoundError:
+            return []
+        segments = []
+        for i, (end_time, path) in enumerate(entries):
+            start_time = entries[i-1][0] if i else end_time - self.segment_sec
+            segments.append((start_time, end_time, path))
+        return segments
+    
+    async def cut_clip(self, output, start_time, end_time):
+        '''
+        Concatenate the segments covering start_time to end_time (epoch 
+        seconds) into output without re-encoding. Waits until end_time if 
+        it is still in the future.
+        '''
+        delay = end_time - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if not self._running:
+            raise RuntimeError('pre-roll capture is not running')
+        clip = [path for seg_start, seg_end, path in self.segments() if seg_end > start_time and seg_start < end_time]
+        if not clip:
+            raise RuntimeError('no buffered segments for the requested time')
+        fd, list_path = tempfile.mkstemp(suffix='.txt', dir=self.buffer_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for path in clip:
+                    escaped_path = path.replace("'", "'\\''")
+                    f.write(f"file '{escaped_path}'\n")
+            ffmpeg = (FFmpeg()
+                        .option('y')
+                        .input(list_path, f='concat', safe='0')
+                        .output(str(output),
+                                {'c' : 'copy'},
+                                movflags='+faststart'))
+            await ffmpeg.execute()
+        finally:
+            try:
+                os.remove(list_path)
+            except OSError:
+                pass
+
 
 class NotificationRecorder(threading.Thread):
-    def __init__(self, incoming_queue, outgoing_queues, db_conn, config):    
+    def __init__(self, incoming_queue, outgoing_queues, db_conn, config, media_cache=None):    
         threading.Thread.__init__(self)
         self.name = 'NotificationRecorder'
         self.incoming_queue = incoming_queue
         self.outgoing_queues = outgoing_queues #A dict {'queuename':queue_obj}
+        self.media_cache = media_cache #MediaUploadCache of the notifier, evicted when files are deleted
         self.config = config
         self._db_conn = db_conn
         self.dbm = None
         self.exit_flag = None
+        self.preroll_buffers = {} #A dict {camera_id:RtspPreRollBuffer}
         self.loop = None
         
     def run(self):
@@ -102,47 +318,193 @@ class NotificationRecorder(threading.Thread):
         self.exit_flag = aioEvent_ts()
         self.dbm = DataBaseManager(self._db_conn)
         await self.dbm.setup_tables()
+        self.inference = create_inference_scheduler(self.config)
+        if self.config['RECORDER']['MEDIA_PROCESS_POOL']:
+            self.media_pool = MediaProcessPool(self.config['RECORDER']['MEDIA_WORKERS'] or default_media_workers())
+        else:
+            self.media_pool = MediaProcessPool(0)
     
         self.loop.create_task(self.ImagesDiskCleanUpWorker())
+        self.loop.create_task(self.PreRollBufferWorker())
         self.loop.create_task(self.NotificationRecorderScheduler())    
     
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         await asyncio.gather(*tasks)
+        await self.inference.close()
+        await SyncCall(self.media_pool.close, None)
     
     
     async def ImagesDiskCleanUpWorker(self):
+        try:
+            await self.backfill_image_sizes()
+        except Exception as ex:
+            logger.error(ex, exc_info=True)
         while not self.exit_flag.is_set():
             try:
-                expire_time = time.time()-self.config['RECORDER']['IMAGES_KEEP_TIME']
-                images = await self.dbm.get_images_older_than(expire_time)
-                for image in images:
-                    if self.exit_flag.is_set():
-                        break
-                    try:
-                        full_path = os.path.join(self.config['PATHS']['IMAGES_SAVE_PATH'], image['FILENAME'])
-                        if await aiofiles.os.path.exists(full_path):
-                            await aiofiles.os.remove(full_path)
-                    except:
-                        pass
-                    finally:
-                        try:
-                            await self.dbm.delete_image_guid(image['GUID'])
-                        except:
-                            pass
+                files, size = await self.sweep_expired_images()
+                if files:
+                    logger.info(f'[Recorder]         Retention sweep removed {files} files, {size/1048576:.1f} MB reclaimed')
+                files, size = await self.enforce_disk_quota()
+                if files:
+                    logger.info(f'[Recorder]         Disk quota exceeded, removed {files} oldest files, {size/1048576:.1f} MB reclaimed')
             except Exception as ex:
                 logger.error(ex, exc_info=True)
             try:
                 await asyncio.wait_for(self.exit_flag.wait(), timeout=60)
             except asyncio.TimeoutError:
                 pass
+    
+    async def remove_images(self, images):
+        '''
+        Remove the files of the image rows in parallel on the thread pool, 
+        then the rows with one DELETE. Returns (files removed, bytes reclaimed).
+        '''
+        unlink_batch_size = max(1, self.config['RECORDER']['RETENTION_UNLINK_BATCH_SIZE'])
+        paths = [os.path.join(self.config['PATHS']['IMAGES_SAVE_PATH'], image['FILENAME']) for image in images]
+        results = await asyncio.gather(*[SyncCall(remove_files, None, paths[i:i+unlink_batch_size]) 
+                                         for i in range(0, len(paths), unlink_batch_size)])
+        await self.dbm.delete_image_guids(image['GUID'] for image in images)
+        if self.media_cache is not None:
+            self.media_cache.evict_paths(paths)
+        return sum(files for files, size in results), sum(size for files, size in results)
+    
+    def retention_batch_size(self):
+        return min(max(1, self.config['RECORDER']['RETENTION_BATCH_SIZE']), 900) #SQLite host parameter limit
+    
+    async def sweep_expired_images(self):
+        '''
+        Delete the expired images, oldest first, in chunks of 
+        RETENTION_BATCH_SIZE rows. Cameras with their own IMAGES_KEEP_TIME 
+        are swept with it, all other images with the RECORDER one.
+        Returns (files removed, bytes reclaimed).
+        '''
+        now = time.time()
+        keep_times = {xstr(camera_id):camera['IMAGES_KEEP_TIME'] for camera_id, camera in self.config['CAMERAS']['CONFIGS'].items() 
+                      if camera['IMAGES_KEEP_TIME']}
+        sweeps = [functools.partial(self.dbm.get_camera_images_older_than, camera_id, now-keep_time) 
+                  for camera_id, keep_time in keep_times.items()]
+        sweeps.append(functools.partial(self.dbm.get_images_older_than, 
+                                        now-self.config['RECORDER']['IMAGES_KEEP_TIME'], 
+                                        exclude_camera_ids=list(keep_times.keys())))
+        batch_size  = self.retention_batch_size()
+        total_files = 0
+        total_size  = 0
+        for get_images in sweeps:
+            while not self.exit_flag.is_set():
+                images = await get_images(limit=batch_size)
+                if not images:
+                    break
+                files, size = await self.remove_images(images)
+                total_files += files
+                total_size  += size
+                if len(images) < batch_size:
+                    break
+        return total_files, total_size
+    
+    async def enforce_disk_quota(self):
+        '''
+        While the images use more than DISK_QUOTA_MB, delete the oldest 
+        images of the camera folder using the most space.
+        Returns (files removed, bytes reclaimed).
+        '''
+        quota = self.config['RECORDER']['DISK_QUOTA_MB'] * 1048576
+        total_files = 0
+        total_size  = 0
+        if quota <= 0:
+            return total_files, total_size
+        while not self.exit_flag.is_set():
+            usage = await self.dbm.get_disk_usage()
+            excess = sum(row['BYTES'] or 0 for row in usage) - quota
+            if excess <= 0:
+                break
+            images = await self.dbm.get_oldest_camera_dir_images(usage[0]['CAMERA_DIR'], limit=self.retention_batch_size())
+            if not images:
+                break
+            evict = []
+            for image in images:
+                evict.append(image)
+                excess -= image['SIZE'] or 0
+                if excess <= 0:
+                    break
+            files, size = await self.remove_images(evict)
+            total_files += files
+            total_size  += size
+        return total_files, total_size
+    
+    async def backfill_image_sizes(self):
+        '''Fill in CAMERA_DIR and SIZE of image rows logged before they were tracked'''
+        while not self.exit_flag.is_set():
+            images = await self.dbm.get_images_without_camera_dir(limit=self.retention_batch_size())
+            if not images:
+                break
+            rows = await SyncCall(self._image_dirs_and_sizes, None, images)
+            await self.dbm.set_image_dirs_and_sizes(rows)
+    
+    def _image_dirs_and_sizes(self, images):
+        rows = []
+        for image in images:
+            try:
+                size = os.stat(os.path.join(self.config['PATHS']['IMAGES_SAVE_PATH'], image['FILENAME'])).st_size
+            except OSError:
+                size = 0
+            rows.append((self.dbm.image_dir(image['FILENAME']), size, image['GUID'],))
+        return rows
+            
+    async def PreRollBufferWorker(self):
+        while not self.exit_flag.is_set():
+            try:
+                self.sync_preroll_buffers()
+            except Exception as ex:
+                logger.error(ex, exc_info=True)
+            try:
+                await asyncio.wait_for(self.exit_flag.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                pass
+        for preroll_buffer in self.preroll_buffers.values():
+            preroll_buffer.stop()
+        await asyncio.gather(*[b.task for b in self.preroll_buffers.values()], return_exceptions=True)
+        self.preroll_buffers = {}
+    
+    def sync_preroll_buffers(self):
+        '''
+        Start or stop the RTSP pre-roll buffers to match the camera configs, 
+        which may have been reloaded since the last call.
+        '''
+        buffers_root = os.path.join(self.config['PATHS']['FRAMES_TEMP_PATH'] or tempfile.gettempdir(), 'onpatrol_preroll')
+        cameras = {}
+        for camera_id, camera in self.config['CAMERAS']['CONFIGS'].items():
+            if camera['CAMERA_ENABLED'] and camera['RTSP_RECORDING_ENABLED'] and camera['RTSP_PREROLL_ENABLED']:
+                cameras.update({camera_id:camera})
+        
+        for camera_id, preroll_buffer in list(self.preroll_buffers.items()):
+            camera = cameras.get(camera_id, None)
+            if camera is None or \
+               preroll_buffer.url            != camera['RTSP_FULL_URL'] or \
+               preroll_buffer.preroll_sec    != camera['RTSP_PREROLL_SEC'] or \
+               preroll_buffer.max_length_sec != camera['RTSP_RECORDING_LENGTH_SEC'] or \
+               preroll_buffer.segment_sec    != max(1, self.config['RECORDER']['PREROLL_SEGMENT_SEC']):
+                preroll_buffer.stop()
+                del self.preroll_buffers[camera_id]
+        
+        for camera_id, camera in cameras.items():
+            if camera_id in self.preroll_buffers:
+                continue
+            preroll_buffer = RtspPreRollBuffer(name           = camera['CAMERA_NAME'],
+                                               url            = camera['RTSP_FULL_URL'],
+                                               buffer_dir     = os.path.join(buffers_root, make_valid_filename(str(camera_id))),
+                                               preroll_sec    = camera['RTSP_PREROLL_SEC'],
+                                               max_length_sec = camera['RTSP_RECORDING_LENGTH_SEC'],
+                                               segment_sec    = self.config['RECORDER']['PREROLL_SEGMENT_SEC'])
+            preroll_buffer.start(self.loop)
+            self.preroll_buffers.update({camera_id:preroll_buffer})
             
     async def NotificationRecorderScheduler(self):
         while not self.exit_flag.is_set():
             try:
-                notification = await SyncCall(self.incoming_queue.get, None)
+                notification = await self.incoming_queue.aget()
                 if isinstance(notification, TermToken):
                     for outgoing_queue in self.outgoing_queues.values():
-                        await SyncCall(outgoing_queue.put,None,notification)
+                        await outgoing_queue.aput(notification)
                     break
                 self.loop.create_task(self.NotificationRecorderWorker(notification))
             except Exception as ex:
@@ -151,39 +513,61 @@ class NotificationRecorder(threading.Thread):
         
     async def NotificationRecorderWorker(self, notification):
         if notification.get('RTSP_RECORDING_ENABLED', False):
+            trigger_time = time.time()
             file_subpath = await self.generate_file_subpath(notification['CAMERA_NAME'],
                                                             notification['CHANNEL_NUMBER'],
                                                             notification["EVENT_TIME"],
                                                             self.config['PATHS']['IMAGES_SAVE_PATH'],
                                                             '.mp4')
             file_fullpath = os.path.join(self.config['PATHS']['IMAGES_SAVE_PATH'], file_subpath)
-            if notification['DEEPSTACK_ENABLED']:
+            single_pass = notification.get('DEEPSTACK_ENABLED', False) and self.config['RECORDER']['SINGLE_PASS_CAPTURE']
+            frames_dir = None
+            preroll_buffer = self.preroll_buffers.get(notification.get('CAMERA_ID', None), None)
+            preroll_clip = False
+            if notification.get('DEEPSTACK_ENABLED', False) and not single_pass:
                 width = '1280'
             else:
                 width = '640'        
             try:
                 Path(file_fullpath).touch()
-                logger.debug(f'[Recorder]         {notification["CAMERA_NAME"]} Capturing RTSP feed')
-                await self.save_rtsp(url    = notification['RTSP_FULL_URL'], 
-                                     output = file_fullpath, 
-                                     length = notification['RTSP_RECORDING_LENGTH_SEC'], 
-                                     width  = width, 
-                                     height = '-1', 
-                                     fps    = '10')
+                if preroll_buffer is not None and preroll_buffer.is_running():
+                    start_time = trigger_time - preroll_buffer.preroll_sec
+                    try:
+                        await preroll_buffer.cut_clip(output     = file_fullpath,
+                                                      start_time = start_time,
+                                                      end_time   = trigger_time + notification['RTSP_RECORDING_LENGTH_SEC'])
+                        preroll_clip = True
+                        single_pass  = False
+                    except Exception as ex:
+                        logger.warning(f'[Recorder]         {notification["CAMERA_NAME"]} Pre-roll clip failed, capturing RTSP feed. {str(ex)}')
+                if preroll_clip:
+                    logger.debug(f'[Recorder]         {notification["CAMERA_NAME"]} Clip cut from pre-roll buffer')
+                elif single_pass:
+                    logger.debug(f'[Recorder]         {notification["CAMERA_NAME"]} Capturing RTSP feed')
+                    frames_dir = tempfile.mkdtemp(prefix='onpatrol_', dir=self.config['PATHS']['FRAMES_TEMP_PATH'] or None)
+                    await self.save_rtsp_with_frames(url         = notification['RTSP_FULL_URL'], 
+                                                     output      = file_fullpath, 
+                                                     frames_dir  = frames_dir,
+                                                     length      = notification['RTSP_RECORDING_LENGTH_SEC'], 
+                                                     width       = width, 
+                                                     frame_width = str(self.config['RECORDER']['DETECTION_FRAME_WIDTH']),
+                                                     fps         = '10',
+                                                     sample_fps  = self.config['RECORDER']['VIDEO_SAMPLE_FPS'])
+                else:
+                    logger.debug(f'[Recorder]         {notification["CAMERA_NAME"]} Capturing RTSP feed')
+                    await self.save_rtsp(url    = notification['RTSP_FULL_URL'], 
+                                         output = file_fullpath, 
+                                         length = notification['RTSP_RECORDING_LENGTH_SEC'], 
+                                         width  = width, 
+                                         height = '-1', 
+                                         fps    = '10')
             except Exception:
+                if frames_dir:
+                    shutil.rmtree(frames_dir, ignore_errors=True)
                 logger.error(f'[Recorder]         {notification["CAMERA_NAME"]} RTSP failed.',exc_info=True)
             else:
                 notification['MEDIA_FILENAMES'] = [file_fullpath]
-                log_guid = await self.dbm.add_camera_log(camera_id      = notification['CAMERA_ID'],
-                                                         event_type     = json.dumps(notification['EVENT_TYPE']),
-                                                         event_time     = notification['EVENT_TIME'].timestamp(),
-                                                         ipc_name       = notification['CAMERA_NAME'],
-                                                         ipc_sn         = notification['IPC_SN'],
-                                                         channel_name   = notification['CHANNEL_NAME'],
-                                                         channel_number = notification['CHANNEL_NUMBER'])
-                await self.dbm.add_image(filename = file_subpath, 
-                                         time     = time.time(), 
-                                         log_guid = log_guid) 
+                await self.log_camera_event(notification, [file_subpath])
             
                 if notification.get('DEEPSTACK_ENABLED', False):
                     if notification['DEEPSTACK_PREFILTER_ENABLED']:
@@ -191,20 +575,34 @@ class NotificationRecorder(threading.Thread):
                     else:
                         min_confidence = notification['DEEPSTACK_MIN_CONFIDENCE']
                     if min_confidence:
-                        detections = await SyncCall(self.DeepStackDetection, 
-                                                    None, 
-                                                    min_confidence = min_confidence, 
-                                                    videos         = [file_fullpath])
+                        if single_pass:
+                            try:
+                                frames = await self.media_pool.run(read_image_files, 
+                                                                   frames_dir, 
+                                                                   dedup_threshold = self.config['RECORDER']['VIDEO_DEDUP_THRESHOLD'],
+                                                                   max_frames      = self.config['RECORDER']['VIDEO_MAX_FRAMES'])
+                            except Exception as ex:
+                                frames = []
+                                logger.error(f'[Recorder]         {notification["CAMERA_NAME"]} Failed to read detection frames. {str(ex)}')
+                            detections = await self.DeepStackDetection(min_confidence = min_confidence, 
+                                                                       images         = frames,
+                                                                       name           = notification['CAMERA_NAME'])
+                        else:
+                            detections = await self.DeepStackDetection(min_confidence = min_confidence, 
+                                                                       videos         = [file_fullpath],
+                                                                       name           = notification['CAMERA_NAME'])
                         notification['EVENT_TYPE'].extend(detections)
                         logger.debug(f'[Recorder]         {notification["CAMERA_NAME"]} Objects detected: {detections}')
+                #Pre-roll clips are stream copies at camera resolution
+                if preroll_clip or (notification.get('DEEPSTACK_ENABLED', False) and not single_pass):
                     try:
                         await self.resize_video_file(file_fullpath, width='640')
                     except Exception as ex:
                         logger.error(f'[Recorder]         {notification["CAMERA_NAME"]} resize_video_file failed. {str(ex)}')
-                del notification['IMAGES']
-                del notification['VIDEOS']
-                for outgoing_queue in self.outgoing_queues.values():
-                    await SyncCall(outgoing_queue.put,None,notification)
+                if frames_dir:
+                    shutil.rmtree(frames_dir, ignore_errors=True)
+                self.release_attachments(notification)
+                await self.forward_notification(notification)
                 return
     
         if notification['VIDEOS']:
@@ -217,10 +615,9 @@ class NotificationRecorder(threading.Thread):
                 else:
                     min_confidence = notification['DEEPSTACK_MIN_CONFIDENCE']
                 if min_confidence:
-                    detections = await SyncCall(self.DeepStackDetection,
-                                                None,
-                                                min_confidence = min_confidence, 
-                                                images = [img['payload'] for img in notification['IMAGES']])
+                    detections = await self.DeepStackDetection(min_confidence = min_confidence, 
+                                                               images         = [img['payload'].getbuffer() for img in notification['IMAGES']],
+                                                               name           = notification['CAMERA_NAME'])
                     notification['EVENT_TYPE'].extend(detections)
                     logger.debug(f'[Recorder]         {notification["CAMERA_NAME"]} Objects detected: {detections}')
                     
@@ -233,30 +630,22 @@ class NotificationRecorder(threading.Thread):
                 file_fullpath = os.path.join(self.config['PATHS']['IMAGES_SAVE_PATH'], file_subpath)
                 try:
                     Path(file_fullpath).touch()
-                    await SyncCall(create_mp4, 
-                                   None, 
-                                   images        = [img['payload'] for img in notification['IMAGES']], 
-                                   framerate     = 1.25, 
-                                   out_file_path = file_fullpath)
+                    await self.media_pool.run_with_images(create_mp4, 
+                                                          [img['payload'].getbuffer() for img in notification['IMAGES']], 
+                                                          framerate     = 1.25, 
+                                                          out_file_path = file_fullpath,
+                                                          loops         = 1)
+                    await self.loop_video_file(file_fullpath, 
+                                               loops = self.config['RECORDER']['SLIDESHOW_LOOPS'],
+                                               codec = self.config['RECORDER']['SLIDESHOW_CODEC'])
                 except Exception as ex:
                     logger.error(f'[Recorder]         {str(notification["CAMERA_NAME"])}: create_mp4 from still images failed. {str(ex)}')
                 else:
                     notification['MEDIA_FILENAMES'] = [file_fullpath]
-                    log_guid = await self.dbm.add_camera_log(camera_id      = notification['CAMERA_ID'],
-                                                             event_type     = json.dumps(notification['EVENT_TYPE']),
-                                                             event_time     = notification['EVENT_TIME'].timestamp(),
-                                                             ipc_name       = notification['CAMERA_NAME'],
-                                                             ipc_sn         = notification['IPC_SN'],
-                                                             channel_name   = notification['CHANNEL_NAME'],
-                                                             channel_number = notification['CHANNEL_NUMBER'])
-                    await self.dbm.add_image(filename = file_subpath, 
-                                             time     = time.time(), 
-                                             log_guid = log_guid)
+                    await self.log_camera_event(notification, [file_subpath])
                 finally:
-                    del notification['IMAGES']
-                    del notification['VIDEOS']
-                    for outgoing_queue in self.outgoing_queues.values():
-                        await SyncCall(outgoing_queue.put,None,notification)
+                    self.release_attachments(notification)
+                    await self.forward_notification(notification)
                     return
             
             elif len(notification['IMAGES']) == 1:
@@ -269,59 +658,77 @@ class NotificationRecorder(threading.Thread):
                 try:
                     Path(file_fullpath).touch()
                     async with aiofiles.open(file_fullpath, 'wb') as out:
-                            await out.write(notification['IMAGES'][0]['payload'])
+                            await out.write(notification['IMAGES'][0]['payload'].getbuffer())
                             await out.flush()
                 except Exception as ex:
                     logger.error(f'[Recorder]         notification["CAMERA_NAME"] Failed to same image. {str(ex)}')
                 else:
                     notification['MEDIA_FILENAMES'] = [file_fullpath]
-                    log_guid = await self.dbm.add_camera_log(camera_id      = notification['CAMERA_ID'],
-                                                             event_type     = json.dumps(notification['EVENT_TYPE']),
-                                                             event_time     = notification['EVENT_TIME'].timestamp(),
-                                                             ipc_name       = notification['CAMERA_NAME'],
-                                                             ipc_sn         = notification['IPC_SN'],
-                                                             channel_name   = notification['CHANNEL_NAME'],
-                                                             channel_number = notification['CHANNEL_NUMBER'])
-                    await self.dbm.add_image(filename = file_subpath, 
-                                             time     = time.time(), 
-                                             log_guid = log_guid)
+                    await self.log_camera_event(notification, [file_subpath])
                 finally:
-                    del notification['IMAGES']
-                    del notification['VIDEOS']
-                    for outgoing_queue in self.outgoing_queues.values():
-                        await SyncCall(outgoing_queue.put,None,notification)
+                    self.release_attachments(notification)
+                    await self.forward_notification(notification)
                     return
+        self.release_attachments(notification)
         return
     
+    def release_attachments(self, notification):
+        '''
+        Close the image and video handles of the notification once they are
+        saved, the notifiers only get the MEDIA_FILENAMES
+        '''
+        for attachment in notification.pop('IMAGES', []) + notification.pop('VIDEOS', []):
+            attachment['payload'].close()
     
-    def DeepStackDetection(self, min_confidence=0.5, images=[], videos=[]):
-        detections = []
-        deepstack_srv = Detection(ServerConfig(server_url = self.config['DEEPSTACK']['URL'],
-                                               api_key    = self.config['DEEPSTACK']['API_KEY']))
-
-        for image in images:
+    async def forward_notification(self, notification):
+        for name, outgoing_queue in self.outgoing_queues.items():
             try:
-                response = deepstack_srv.detectObject(image           = image,
-                                                      min_confidence  = min_confidence,
-                                                      output          = None)
-            except Exception as ex:
-                logger.exception(ex)
-            else:
-                detections.extend([obj.label for obj in response.detections])
-        
+                await outgoing_queue.aput(notification)
+            except queue.Full:
+                logger.warning(f'[Recorder]         {str(notification["CAMERA_NAME"])}: {name} full, notification dropped')
+    
+    async def log_camera_event(self, notification, file_subpaths):
+        sizes = []
+        for file_subpath in file_subpaths:
+            try:
+                sizes.append((await aiofiles.os.stat(os.path.join(self.config['PATHS']['IMAGES_SAVE_PATH'], file_subpath))).st_size)
+            except OSError:
+                sizes.append(0)
+        try:
+            await self.dbm.add_camera_log_and_images(camera_id      = notification['CAMERA_ID'],
+                                                     event_type     = json.dumps(notification['EVENT_TYPE']),
+                                                     event_time     = notification['EVENT_TIME'].timestamp(),
+                                                     ipc_name       = notification['CAMERA_NAME'],
+                                                     ipc_sn         = notification['IPC_SN'],
+                                                     channel_name   = notification['CHANNEL_NAME'],
+                                                     channel_number = notification['CHANNEL_NUMBER'],
+                                                     filenames      = file_subpaths,
+                                                     time           = time.time(),
+                                                     sizes          = sizes)
+        except Exception as ex:
+            logger.error(f'[Recorder]         {str(notification["CAMERA_NAME"])}: Failed to log camera event. {str(ex)}')
+    
+    async def DeepStackDetection(self, min_confidence=0.5, images=[], videos=[], name=''):
+        '''
+        Run object detection on the images and on the frames of the videos. 
+        All requests go through the shared InferenceScheduler, which batches
+        them with the requests of other events.
+        '''
+        images = list(images)
         for video in videos:
             try:
-                response = deepstack_srv.detectObjectVideo(video             = video,
-                                                           min_confidence    = min_confidence,
-                                                           output            = None,
-                                                           continue_on_error = True)
+                images.extend(await self.media_pool.run(read_video_frames, 
+                                                        video, 
+                                                        sample_fps      = self.config['RECORDER']['VIDEO_SAMPLE_FPS'],
+                                                        dedup_threshold = self.config['RECORDER']['VIDEO_DEDUP_THRESHOLD'],
+                                                        max_frames      = self.config['RECORDER']['VIDEO_MAX_FRAMES']))
             except Exception as ex:
-                logger.exception(ex)
-            else:
-                detections.extend([obj.label for obj in sum([x.detections for x in response.values()], []) ])
+                logger.error(f'[Recorder]         {name}: Failed to read video frames. {str(ex)}')
+        
+        results = await asyncio.gather(*[self.inference.detect(image, min_confidence, name=name) for image in images])
         
         # Make list of unique objects
-        detections = [obj.lower() for obj in set(detections)]
+        detections = [obj.lower() for obj in set(sum(results, []))]
         return detections
     
     
@@ -345,70 +752,42 @@ class NotificationRecorder(threading.Thread):
         #except Exception as ex:
         #    logger.exception(ex)
 
+    async def save_rtsp_with_frames(self, url, output, frames_dir, length = '4', width='640', frame_width='1280', fps='10', sample_fps=0):
+        '''
+        Record the RTSP feed once and split the decoded video into the 
+        width px H.264 recording (output) and JPEG frames of frame_width px 
+        for object detection, sample_fps frames per second (0 for all), 
+        written to frames_dir.
+        '''
+        frames_filter = f'fps={str(sample_fps)},' if sample_fps else ''
+        ffmpeg = (FFmpeg()
+                    .option('y')
+                    .option('an')  
+                    .input(str(url),
+                           rtsp_transport='tcp',
+                           timeout='5000000',
+                           rtsp_flags='prefer_tcp',
+                           t=str(length)                      
+                           )
+                    .option('filter_complex', f'[0:v]fps={str(fps)},split=2[rec][det];'
+                                              f'[rec]scale={str(width)}:-2[video];'
+                                              f'[det]{frames_filter}scale={str(frame_width)}:-2[frames]')
+                    .output(str(output),
+                            {'map' : '[video]', 'c:v' : 'libx264'})
+                    .output(os.path.join(frames_dir, '%04d.jpg'),
+                            {'map' : '[frames]', 'q:v' : '3'}))
+        await ffmpeg.execute()
             
     def get_deepstack_filter_profile(self, notification):
-        # Check for individual camera name rules
-        if notification['CAMERA_NAME'].lower() in self.config['DEEPSTACK']['CAMERA_NAME_INDEX'].keys():
-            profile_keys = self.config['DEEPSTACK']['CAMERA_NAME_INDEX'][notification['CAMERA_NAME'].lower()]
-            logger.debug(f'[Recorder]         {str(notification["CAMERA_NAME"])}: using profile {str(profile_keys)}')
-            for key in profile_keys:
-                profile = self.config['DEEPSTACK']['CAMERA_PROFILES'][key]
-                #Check channel names
-                if profile['CHANNEL_NAMES']:
-                    if notification['CHANNEL_NAME'].lower() not in profile['CHANNEL_NAMES']:
-                        continue
-                #Check channel numbers
-                if profile['CHANNEL_NUMBERS']:
-                    if notification['CHANNEL_NUMBER'].lower() not in profile['CHANNEL_NUMBERS']:
-                        continue
-                #Check weekday
-                if not profile[day_name[notification['EVENT_TIME'].weekday()].upper()]:
-                    continue
-                #Check time slot
-                if profile['TIME_START'] > profile['TIME_STOP']:
-                    if notification['EVENT_TIME'].time() < profile['TIME_STOP'] or notification['EVENT_TIME'].time() >= profile['TIME_START']:
-                        return profile['MIN_CONFIDENCE']
-                elif profile['TIME_START'] < profile['TIME_STOP']:
-                    if notification['EVENT_TIME'].time() < profile['TIME_STOP'] and notification['EVENT_TIME'].time() >= profile['TIME_START']:
-                        return profile['MIN_CONFIDENCE']
-                else:
-                    return profile['MIN_CONFIDENCE']
-    
-        # Check for rules that apply to all camera (wildcard *)
-        #   Note: keys in DEEPSTACK_ALL_CAMERAS_INDEX are also the keys in 
-        #   DEEPSTACK_CAMERA_PROFILES. The values in DEEPSTACK_ALL_CAMERAS_INDEX
-        #   are a list of camera names to ignore.
-        for key in self.config['DEEPSTACK']['ALL_CAMERAS_INDEX'].keys():
-            #Check if camera name is excluded from wildcard
-            if notification['CAMERA_NAME'].lower() in self.config['DEEPSTACK']['ALL_CAMERAS_INDEX'][key]:
-                continue
-            
-            profile = self.config['DEEPSTACK']['CAMERA_PROFILES'][key]
-            #Check channel names
-            if profile['CHANNEL_NAMES']:
-                if notification['CHANNEL_NAME'].lower() not in profile['CHANNEL_NAMES']:
-                    continue
-            #Check channel numbers
-            if profile['CHANNEL_NUMBERS']:
-                if notification['CHANNEL_NUMBER'].lower() not in profile['CHANNEL_NUMBERS']:
-                    continue
-            #Check weekday
-            if not profile[day_name[notification['EVENT_TIME'].weekday()].upper()]:
-                continue
-            #Check time slot
-            if profile['TIME_START'] > profile['TIME_STOP']:
-                if notification['EVENT_TIME'].time() < profile['TIME_STOP'] or notification['EVENT_TIME'].time() >= profile['TIME_START']:
-                    logger.debug('[Recorder]         '+str(notification['CAMERA_NAME']) + ': using Deepstack profile ' + str(key))
-                    return profile['MIN_CONFIDENCE']
-            elif profile['TIME_START'] < profile['TIME_STOP']:
-                if notification['EVENT_TIME'].time() < profile['TIME_STOP'] and notification['EVENT_TIME'].time() >= profile['TIME_START']:
-                    logger.debug('[Recorder]         '+str(notification['CAMERA_NAME']) + ': using Deepstack profile ' + str(key))
-                    return profile['MIN_CONFIDENCE']
-            else:
-                logger.debug('[Recorder]         '+str(notification['CAMERA_NAME']) + ': using Deepstack profile ' + str(key))
-                return profile['MIN_CONFIDENCE']
-            
-        return None        
+        resolved = self.config['DEEPSTACK']['PROFILE_RESOLVER'].resolve(camera_name    = notification['CAMERA_NAME'],
+                                                                        channel_name   = notification['CHANNEL_NAME'],
+                                                                        channel_number = notification['CHANNEL_NUMBER'],
+                                                                        event_time     = notification['EVENT_TIME'])
+        if resolved is None:
+            return None
+        key, profile = resolved
+        logger.debug('[Recorder]         '+str(notification['CAMERA_NAME']) + ': using Deepstack profile ' + str(key))
+        return profile['MIN_CONFIDENCE']
             
     
     async def generate_file_subpath(self, camera_name, channel_number, event_time, images_save_path, file_extention, count=None):
@@ -426,6 +805,36 @@ class NotificationRecorder(threading.Thread):
             path = os.path.join(sub_dir, filename+file_extention)
         return path
         
+    async def loop_video_file(self, file_fullpath, loops=3, codec='mp4v'):
+        '''
+        Repeat the video loops times by looping the input and copying the 
+        encoded stream. With codec 'h264' the video is transcoded to H.264 
+        once before it is looped.
+        '''
+        if codec == 'h264':
+            await self.remux_video_file(file_fullpath, {'c:v' : 'libx264', 'pix_fmt' : 'yuv420p'})
+        if loops > 1:
+            await self.remux_video_file(file_fullpath, {'c' : 'copy'}, stream_loop=str(loops-1))
+    
+    async def remux_video_file(self, file_fullpath, output_options, **input_options):
+        temp_file = os.path.splitext(file_fullpath)[0]+'_temp.mp4'
+        ffmpeg = (FFmpeg()
+                    .option('y')
+                    .input(file_fullpath, **input_options)
+                    .output(temp_file,
+                            output_options,
+                            movflags='+faststart'))
+        try:
+            await ffmpeg.execute()
+        except Exception as ex:
+            logger.exception(ex)
+        else:
+            try:
+                await aiofiles.os.remove(file_fullpath)
+                await aiofiles.os.rename(temp_file, file_fullpath)
+            except Exception as ex2:
+                logger.exception(ex2)
+        
     async def resize_video_file(self, file_fullpath, width='640', height='-1'):
         temp_file = os.path.splitext(file_fullpath)[0]+'_temp.mp4'
         ffmpeg = (FFmpeg()
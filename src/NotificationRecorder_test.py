@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""NotificationRecorder test routines."""
+
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from sqlite3worker import Sqlite3Worker
+
+from NotificationRecorder import DataBaseManager, NotificationRecorder
+
+
+class RetentionTests(unittest.TestCase):
+    """Test out the selection of the images to delete."""
+
+    def setUp(self):  # pylint:disable=D0102
+        self.tmp_dir = tempfile.mkdtemp(prefix='onpatrol_test_')
+        self.images_path = os.path.join(self.tmp_dir, 'images')
+        os.makedirs(self.images_path)
+        self.db_conn = Sqlite3Worker(os.path.join(self.tmp_dir, 'test.db'), row_factory=sqlite3.Row)
+        self.now = time.time()
+
+    def tearDown(self):  # pylint:disable=D0102
+        self.db_conn.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def run_async(self, func, *args):
+        async def run():
+            self.dbm = DataBaseManager(self.db_conn)
+            await self.dbm.setup_tables()
+            return await func(*args)
+        return asyncio.run(run())
+
+    async def add_images(self, images):
+        '''images: [(filename, age in seconds, camera_id, size)]'''
+        for filename, age, camera_id, size in images:
+            with open(os.path.join(self.images_path, filename), 'wb') as f:
+                f.write(b'\0'*size)
+            await self.dbm.add_image(filename, self.now-age, camera_id=camera_id, size=size)
+
+    async def image_filenames(self):
+        return [image['FILENAME'] for image in await self.dbm._execute('SELECT FILENAME FROM images', ())]
+
+    def test_image_dir(self):
+        """Test the CAMERA_DIR of images in and below the images folder."""
+        self.assertEqual(DataBaseManager.image_dir('garden/2023-04-01/clip.mp4'), 'garden/2023-04-01')
+        self.assertEqual(DataBaseManager.image_dir('clip.mp4'), '.')
+
+    def test_images_older_than(self):
+        """Test the oldest first selection and the excluded cameras."""
+        async def select():
+            await self.add_images([('a.jpg', 300, '1', 10),
+                                   ('b.jpg', 500, '2', 10),
+                                   ('c.jpg', 400, '', 10),
+                                   ('d.jpg', 100, '1', 10)])
+            return (await self.dbm.get_images_older_than(self.now-200),
+                    await self.dbm.get_images_older_than(self.now-200, limit=2),
+                    await self.dbm.get_images_older_than(self.now-200, exclude_camera_ids=['2']),
+                    await self.dbm.get_camera_images_older_than(1, self.now-200))
+        all_images, limited, excluded, camera = self.run_async(select)
+        self.assertEqual([image['FILENAME'] for image in all_images], ['b.jpg', 'c.jpg', 'a.jpg'])
+        self.assertEqual([image['FILENAME'] for image in limited], ['b.jpg', 'c.jpg'])
+        self.assertEqual([image['FILENAME'] for image in excluded], ['c.jpg', 'a.jpg'])
+        self.assertEqual([image['FILENAME'] for image in camera], ['a.jpg'])
+
+    def test_disk_usage(self):
+        """Test the per folder byte totals kept by the triggers."""
+        async def usage():
+            await self.dbm.add_camera_log_and_images(camera_id=1, event_type='[]', event_time=self.now, ipc_name='garden',
+                                                     ipc_sn='', channel_name='', channel_number='1', time=self.now,
+                                                     filenames=['garden/a.mp4', 'garden/b.mp4', 'c.jpg'], sizes=[100, 200, 50])
+            results = [await self.dbm.get_disk_usage()]
+            await self.dbm.delete_image('garden/a.mp4')
+            results.append(await self.dbm.get_disk_usage())
+            images = await self.dbm.get_oldest_camera_dir_images('.')
+            await self.dbm.set_image_dirs_and_sizes([('.', 70, images[0]['GUID'])])
+            results.append(await self.dbm.get_disk_usage())
+            return [[tuple(row) for row in result] for result in results]
+        inserted, deleted, updated = self.run_async(usage)
+        self.assertEqual(inserted, [('garden', 300), ('.', 50)])
+        self.assertEqual(deleted, [('garden', 200), ('.', 50)])
+        self.assertEqual(updated, [('garden', 200), ('.', 70)])
+
+    def test_sweep_expired_images(self):
+        """Test the camera and RECORDER IMAGES_KEEP_TIME of the retention sweep."""
+        config = {'PATHS'    : {'IMAGES_SAVE_PATH': self.images_path},
+                  'RECORDER' : {'IMAGES_KEEP_TIME'            : 1000,
+                                'RETENTION_BATCH_SIZE'        : 2,
+                                'RETENTION_UNLINK_BATCH_SIZE' : 2},
+                  'CAMERAS'  : {'CONFIGS': {1: {'IMAGES_KEEP_TIME': 200},
+                                            2: {'IMAGES_KEEP_TIME': 0}}}}
+        recorder = NotificationRecorder(incoming_queue=None, outgoing_queues={}, db_conn=self.db_conn, config=config)
+        async def sweep():
+            recorder.dbm = self.dbm
+            recorder.exit_flag = asyncio.Event()
+            await self.add_images([('camera_1_old.jpg'  , 300 , '1', 10),
+                                   ('camera_1_new.jpg'  , 100 , '1', 10),
+                                   ('camera_1_new2.jpg' , 150 , '1', 10),
+                                   ('camera_1_old2.jpg' , 250 , '1', 10),
+                                   ('camera_1_old3.jpg' , 5000, '1', 10),
+                                   ('camera_2_old.jpg'  , 2000, '2', 20),
+                                   ('camera_2_new.jpg'  , 300 , '2', 20),
+                                   ('no_camera_old.jpg' , 1500, '' , 30)])
+            removed = await recorder.sweep_expired_images()
+            left = await self.image_filenames()
+            return removed, left
+        (files, size), left = self.run_async(sweep)
+        self.assertEqual((files, size), (5, 80))
+        self.assertEqual(sorted(left), ['camera_1_new.jpg', 'camera_1_new2.jpg', 'camera_2_new.jpg'])
+        self.assertEqual(sorted(os.listdir(self.images_path)), sorted(left))
+
+
+if __name__ == "__main__":
+    unittest.main()
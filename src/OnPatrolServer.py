@@ -52,13 +52,13 @@ import asyncio#, platform
 # if platform.system()=='Windows':
 #     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-from TelegramNotifier import TelegramNotifier as TelegramNotifier_
+from TelegramNotifier import TelegramNotifier as TelegramNotifier_, CameraClusterIndex, TelegramBotRegistry
 from NotificationRecorder import NotificationRecorder as NotificationRecorder_
 
 import datetime
 from dateutil.parser import parse as datetime_parser
 
-import os, argparse, sys, psutil
+import os, argparse, sys, psutil, multiprocessing
 
 from psutil import AccessDenied, TimeoutExpired, NoSuchProcess
 
@@ -68,7 +68,6 @@ from aiogram.utils.exceptions import ChatNotFound, Unauthorized, NetworkError
 import aiogram
 if version.parse(aiogram.__version__).major > 2:
     raise('aiogram need to be v2.x') #aiogram v3.x implements bot context manager
-from aiogram import Bot as TelegramBot 
 
 
 import sqlite3
@@ -76,7 +75,9 @@ from sqlite3worker import Sqlite3Worker #Need to use own modified version
 
 from Common import xstr, str2bool, csv2list, time2seconds, \
                     TelegramFloodController, CustomQueueListener, \
-                    is_email_address, LocalQueueHandler, generate_code
+                    is_email_address, LocalQueueHandler, generate_code, \
+                    DeepStackProfileResolver, MediaAttachment, EmailTemplateExtractor, \
+                    StageQueue, MediaUploadCache
 
 
 from logging.handlers import TimedRotatingFileHandler
@@ -86,7 +87,6 @@ import queue
 import python_telegram_logger
 import copy
 import locale
-locale.setlocale(locale.LC_ALL, '')
 
 import logging
 import string
@@ -251,15 +251,19 @@ CONFIG = {
      'SERVER'               :{},
      'RECORDER'             :{},
      'HTTP'                 :{},
+     'DATABASE'             :{},
+     'QUEUES'               :{},
      'SMTP'                 :{
                               'EMAIL_TEMPLATES':{}
                               },
      'ISAPI'                :{},
      'TELEGRAM'             :{},
+     'NOTIFIER'             :{},
      'DEEPSTACK'            :{
                               'CAMERA_PROFILES'   : {},
                               'CAMERA_NAME_INDEX' : {},
-                              'ALL_CAMERAS_INDEX' : {}
+                              'ALL_CAMERAS_INDEX' : {},
+                              'PROFILE_RESOLVER'  : None
                               },
      'UNREGISTERED_CAMERAS'  :{
                               'EMAIL_INDEX':{}
@@ -271,12 +275,14 @@ CONFIG = {
                               },
      'NOTIFICATIONS'        :[],
      'CAMERA_CLUSTERS'      :{},
+     'CAMERA_CLUSTERS_INDEX':None,
      'PATHS'                :{
                               'EXE_PATH'             :'',
                               'DATA_PATH'            :'',
                               'CONFIG_PATH'          :'',
                               'CAMERA_CLUSTER_PATH'  :'',
-                              'IMAGES_SAVE_PATH'     :''
+                              'IMAGES_SAVE_PATH'     :'',
+                              'FRAMES_TEMP_PATH'     :''
                               }
          }
 
@@ -287,6 +293,7 @@ CAMERA_EMAIL_TEMPLATE = {
     'EVENT_DATETIME_RE'   : '',
     'EVENT_DATE_GROUP'    : 0 ,
     'EVENT_TIME_GROUP'    : 0 ,
+    'EVENT_DATETIME_FORMAT': '',
     'CAMERA_NAME_RE'      : '',
     'CAMERA_NAME_GROUP'   : 0 ,
     'SERIAL_NUMBER_RE'    : '',
@@ -328,7 +335,7 @@ CAMERA_CONFIG_TEMPLATE = {
     'LONGITUDE'                   : '',
     'CHANNEL_NUMBER'              : '1',
     'CHANNEL_STREAM_NUMBER'       : '1',
-    'IMAGES_KEEP_TIME'            : '00:01:00',
+    'IMAGES_KEEP_TIME'            : '',    #Blank for the RECORDER IMAGES_KEEP_TIME
     'EMAIL_ENABLED'               : False,                          
     'EMAIL_ADDRESS'               : 'my_camera_name@my_domain.com',
     'EMAIL_TEMPLATE'              : 'HIKVISION_DEFAULT',
@@ -340,6 +347,8 @@ CAMERA_CONFIG_TEMPLATE = {
     'RTSP_RECORDING_LENGTH_SEC'   : 4,
     'RTSP_URL_PATH'               : '/Streaming/Channels/101',   
     'RTSP_REC_ON_EVENT_TYPE'     : 'Intrusion Detection, Test Notification.',                  
+    'RTSP_PREROLL_ENABLED'        : False, #Keep the feed buffered so clips are cut without a new RTSP session
+    'RTSP_PREROLL_SEC'            : 2,     #Seconds before the notification added to the RTSP_RECORDING_LENGTH_SEC clip
     'ISAPI_ENABLED'               : False,
     'ISAPI_REPLY_TO_LOCAL_IP'     : False,                             
     'ISAPI_PORT'                  : 80,
@@ -400,8 +409,22 @@ SERVER_DETAILS_CONFIG_TEMPLATE = {
                                  }
 
 RECORDER_CONFIG_SECTION_TEMPLATE = {
-    'IMAGES_SAVE_PATH' : './images',
-    'IMAGES_KEEP_TIME' : '01:00:00'
+    'IMAGES_SAVE_PATH'      : './images',
+    'IMAGES_KEEP_TIME'      : '01:00:00',
+    'DISK_QUOTA_MB'         : 0,    #Max disk space used by images and videos, 0 for no limit
+    'RETENTION_BATCH_SIZE'  : 500,  #Expired images deleted per database round trip
+    'RETENTION_UNLINK_BATCH_SIZE' : 50, #Files removed per thread pool job
+    'VIDEO_SAMPLE_FPS'      : 2.0,  #Frames per second of RTSP video sent for object detection, 0 for all
+    'VIDEO_DEDUP_THRESHOLD' : 3.0,  #Skip frames that differ less than this (mean pixel difference 0-255), 0 to disable
+    'VIDEO_MAX_FRAMES'      : 20,   #Max frames per video sent for object detection, 0 for no limit
+    'SINGLE_PASS_CAPTURE'   : True, #Record the 640px video and the detection frames with one ffmpeg run
+    'DETECTION_FRAME_WIDTH' : 1280,
+    'FRAMES_TEMP_PATH'      : '',   #Blank for /dev/shm if available, else the system temp folder
+    'PREROLL_SEGMENT_SEC'   : 1,    #Length of the RTSP pre-roll buffer segments
+    'SLIDESHOW_LOOPS'       : 3,    #Times the video made from email images is repeated
+    'SLIDESHOW_CODEC'       : 'mp4v',#mp4v or h264
+    'MEDIA_PROCESS_POOL'    : True, #Encode videos and decode frames in worker processes
+    'MEDIA_WORKERS'         : 0     #0 for one less than the number of CPU cores
                                    }
     
 HTTP_STATUS_SERVER_CONFIG_SECTION_TEMPLATE = {
@@ -409,9 +432,18 @@ HTTP_STATUS_SERVER_CONFIG_SECTION_TEMPLATE = {
     'PORT'    : 80
                                              }
 
+DATABASE_CONFIG_SECTION_TEMPLATE = {
+    'WAL_MODE'       : False, #Write-ahead logging, lets readers run alongside the writer
+    'MMAP_SIZE_MB'   : 64,
+    'CACHE_SIZE_MB'  : 16,
+    'READ_POOL_SIZE' : 2      #Read-only connections, only used with WAL_MODE
+                                   }
+
 SMTP_CONFIG_SECTION_TEMPLATE = {
-    'ENABLED'      : False,
-    'PORT'         : 25
+    'ENABLED'                  : False,
+    'PORT'                     : 25,
+    'STREAM_ATTACHMENTS'       : True, #Decode attachments straight from the raw email data
+    'ATTACHMENT_SPOOL_SIZE_KB' : 1024  #Larger attachments are spooled to a temporary file
                                }
 
 
@@ -428,12 +460,32 @@ TELEGRAM_LOG_NOTIFIER_CONFIG_SECTION_TEMPLATE = {
     'SENDER_NAME'  : 'OnPatrolServer',
                                                 }
 
+NOTIFIER_CONFIG_SECTION_TEMPLATE = {
+    'CONNECTIONS_LIMIT'     : 16,   #Bot API connections shared by all bot tokens
+    'KEEPALIVE_TIMEOUT_SEC' : 60,
+    'REQUEST_TIMEOUT_SEC'   : 60,
+    'MEDIA_UPLOAD_CACHE_SIZE' : 1024, #Telegram file_ids kept so media is uploaded once per bot, 0 to disable
+    'RETRY_LIMIT'           : 5,
+    'RETRY_BASE_DELAY_SEC'  : 5,    #Doubled with each retry, up to RETRY_MAX_DELAY_SEC
+    'RETRY_MAX_DELAY_SEC'   : 300,
+    'MAX_PENDING_RETRIES'   : 1000
+                                   }
+
 DEEPSTACK_CONFIG_SECTION_TEMPLATE = {
     'ENABLED'          : False,
     'SERVER'           : '127.0.0.1',
     'PORT'             : '5000',
     #'API_PATH'         : '/v1/vision/detection',
-    'API_KEY'          : ''
+    'API_KEY'          : '',
+    'MAX_CONCURRENT_REQUESTS' : 4,  #Per DeepStack server
+    'CONNECTION_POOL_SIZE'    : 8,
+    'KEEPALIVE_TIMEOUT_SEC'   : 60,
+    'CONNECT_TIMEOUT_SEC'     : 10,
+    'REQUEST_TIMEOUT_SEC'     : 90,
+    'INFERENCE_BACKEND'       : 'deepstack', #deepstack | local (stand-in detector for offline testing)
+    'BATCH_WINDOW_MS'         : 20,
+    'BATCH_MAX_IMAGES'        : 8,
+    'INFERENCE_WORKERS'       : 4
                                     }
 
 UNREGISTERED_CAMERAS_EMAIL_CONFIG_SECTION_TEMPLATE = {
@@ -443,13 +495,25 @@ UNREGISTERED_CAMERAS_EMAIL_CONFIG_SECTION_TEMPLATE = {
     'DEEPSTACK_PREFILTER_ENABLED'             : False
                                                      }
 
+QUEUES_CONFIG_SECTION_TEMPLATE = {
+    # Queue policies: block | drop_oldest | reject (SMTP answers 421, camera retries later)
+    'RECORDER_QUEUE_SIZE'   : 200,
+    'RECORDER_QUEUE_POLICY' : 'reject',
+    'NOTIFIER_QUEUE_SIZE'   : 200,
+    'NOTIFIER_QUEUE_POLICY' : 'drop_oldest',
+    'PUT_TIMEOUT_SEC'       : 10     #Max time the block policy waits for space
+                                 }
+
 CONFIG_FILE_SECTION_TEMPLATES = {
     'SERVER'                : SERVER_DETAILS_CONFIG_TEMPLATE,
     'RECORDER'              : RECORDER_CONFIG_SECTION_TEMPLATE,
     'HTTP'                  : HTTP_STATUS_SERVER_CONFIG_SECTION_TEMPLATE,
+    'DATABASE'              : DATABASE_CONFIG_SECTION_TEMPLATE,
+    'QUEUES'                : QUEUES_CONFIG_SECTION_TEMPLATE,
     'SMTP'                  : SMTP_CONFIG_SECTION_TEMPLATE,
     'ISAPI'                 : ISAPI_CONFIG_SECTION_TEMPLATE,
     'TELEGRAM'              : TELEGRAM_LOG_NOTIFIER_CONFIG_SECTION_TEMPLATE,
+    'NOTIFIER'              : NOTIFIER_CONFIG_SECTION_TEMPLATE,
     'DEEPSTACK'             : DEEPSTACK_CONFIG_SECTION_TEMPLATE,
     'UNREGISTERED_CAMERAS'  : UNREGISTERED_CAMERAS_EMAIL_CONFIG_SECTION_TEMPLATE
                                 }
@@ -594,16 +658,39 @@ def load_config():
         logger.warning('Loading config.ini: minimum IMAGES_KEEP_TIME set to 00:00:05')
     CONFIG['RECORDER']['IMAGES_KEEP_TIME'] = keeptime
     
+    # Validate queue policies
+    for option in ['RECORDER_QUEUE_POLICY', 'NOTIFIER_QUEUE_POLICY']:
+        CONFIG['QUEUES'][option] = CONFIG['QUEUES'][option].strip().lower()
+        if CONFIG['QUEUES'][option] not in StageQueue.POLICIES:
+            logger.warning(f'Loading config.ini: invalid {option} "{CONFIG["QUEUES"][option]}", set to block')
+            CONFIG['QUEUES'][option] = 'block'
+    
     # Validate image path after loading it from config
     if CONFIG['RECORDER']['IMAGES_SAVE_PATH'].strip() == '':
         CONFIG['RECORDER']['IMAGES_SAVE_PATH'] = './images'
     if CONFIG['RECORDER']['IMAGES_SAVE_PATH'].strip().startswith('./'):
         CONFIG['PATHS']['IMAGES_SAVE_PATH'] = os.path.join(CONFIG['PATHS']['DATA_PATH'], CONFIG['RECORDER']['IMAGES_SAVE_PATH'][2:])    
     
+    # Detection frames of the single pass capture are written to a RAM disk where possible
+    if CONFIG['RECORDER']['FRAMES_TEMP_PATH'].strip():
+        CONFIG['PATHS']['FRAMES_TEMP_PATH'] = CONFIG['RECORDER']['FRAMES_TEMP_PATH'].strip()
+    elif os.path.isdir('/dev/shm'):
+        CONFIG['PATHS']['FRAMES_TEMP_PATH'] = '/dev/shm'
+    else:
+        CONFIG['PATHS']['FRAMES_TEMP_PATH'] = ''
+    
     CONFIG['DEEPSTACK']['URL'] = 'http://' + CONFIG['DEEPSTACK']['SERVER'].strip('/') + \
         ':' + str(CONFIG['DEEPSTACK']['PORT'])# + '/' + CONFIG['DEEPSTACK']['API_PATH'].strip('/')
     if not CONFIG['DEEPSTACK']['API_KEY']:
         CONFIG['DEEPSTACK']['API_KEY'] = None
+    CONFIG['RECORDER']['SLIDESHOW_CODEC'] = CONFIG['RECORDER']['SLIDESHOW_CODEC'].strip().lower()
+    if CONFIG['RECORDER']['SLIDESHOW_CODEC'] not in ['mp4v', 'h264']:
+        logger.warning(f'Loading config.ini: invalid SLIDESHOW_CODEC "{CONFIG["RECORDER"]["SLIDESHOW_CODEC"]}", set to mp4v')
+        CONFIG['RECORDER']['SLIDESHOW_CODEC'] = 'mp4v'
+    CONFIG['DEEPSTACK']['INFERENCE_BACKEND'] = CONFIG['DEEPSTACK']['INFERENCE_BACKEND'].strip().lower()
+    if CONFIG['DEEPSTACK']['INFERENCE_BACKEND'] not in ['deepstack', 'local']:
+        logger.warning(f'Loading config.ini: invalid INFERENCE_BACKEND "{CONFIG["DEEPSTACK"]["INFERENCE_BACKEND"]}", set to deepstack')
+        CONFIG['DEEPSTACK']['INFERENCE_BACKEND'] = 'deepstack'
 
     CONFIG['VERSION']   = __version__
     CONFIG['COPYRIGHT'] = __copyright__
@@ -638,6 +725,12 @@ def load_camera_config(online_reload=False):
         data  = {}
 
     
+    #The camera IMAGES_KEEP_TIME used to be ignored, drop its old default so
+    #it does not override the RECORDER IMAGES_KEEP_TIME
+    if config.get('DEFAULT', 'IMAGES_KEEP_TIME', fallback='').strip() == '00:01:00':
+        config.set('DEFAULT', 'IMAGES_KEEP_TIME', '')
+        logger.warning('[cameras.ini] DEFAULT IMAGES_KEEP_TIME 00:01:00 (the old unused default) cleared, cameras now use the config.ini RECORDER IMAGES_KEEP_TIME unless set per camera')
+    
     #Ensure DEFAULT section contains all options in CAMERA_CONFIG_TEMPLATE
     for option in CAMERA_CONFIG_TEMPLATE.keys():
         if not config.has_option('DEFAULT', option):
@@ -664,6 +757,9 @@ def load_camera_config(online_reload=False):
                 else:
                     new_camera[key] = config[section][key]
         new_camera['IMAGES_KEEP_TIME'] = time2seconds(new_camera['IMAGES_KEEP_TIME'])
+        if 0 < new_camera['IMAGES_KEEP_TIME'] < 300:
+            new_camera['IMAGES_KEEP_TIME'] = 300
+            logger.warning(f'[cameras.ini] Minimum IMAGES_KEEP_TIME set to 00:00:05 (D:H:M, 5 minutes) for CAMERA_NAME: {new_camera["CAMERA_NAME"]} in SECTION: {section}')
         new_camera['RTSP_REC_ON_EVENT_TYPE'] = csv2list(new_camera['RTSP_REC_ON_EVENT_TYPE'])
         
         if new_camera['RTSP_RECORDING_ENABLED']:
@@ -880,6 +976,7 @@ def load_DeepStackCameraProfiles(online_reload=False):
     CONFIG['DEEPSTACK']['CAMERA_PROFILES']   = camera_profiles.copy()
     CONFIG['DEEPSTACK']['CAMERA_NAME_INDEX'] = camera_name_index.copy()
     CONFIG['DEEPSTACK']['ALL_CAMERAS_INDEX'] = all_cameras_index.copy()
+    CONFIG['DEEPSTACK']['PROFILE_RESOLVER']  = DeepStackProfileResolver(camera_profiles, camera_name_index, all_cameras_index)
 
 
 def load_CameraClusterConfigs(online_reload=False):
@@ -945,6 +1042,7 @@ def load_CameraClusterConfigs(online_reload=False):
                 LoadCameraClusterConfigs[os.path.splitext(file)[0].lower()].append(new_camera)
     
     CONFIG['CAMERA_CLUSTERS'] = LoadCameraClusterConfigs.copy()
+    CONFIG['CAMERA_CLUSTERS_INDEX'] = CameraClusterIndex(CONFIG['CAMERA_CLUSTERS'])
 
 
 
@@ -992,6 +1090,11 @@ def load_email_templates(online_reload=False):
     if not config.has_option('DEFAULT','EVENT_TIME_GROUP'):
         config.set('DEFAULT', 'EVENT_TIME_GROUP', '2')
         config.set('DEFAULT', '    ')
+    if not config.has_option('DEFAULT','EVENT_DATETIME_FORMAT'):
+        config.set('DEFAULT', '; optional strptime format of the event date and time groups joined by a T, write % as %%')
+        config.set('DEFAULT', '; leave blank for iso 8601 dates, other dates fall back to a slower generic parser')
+        config.set('DEFAULT', 'EVENT_DATETIME_FORMAT', '')
+        config.set('DEFAULT', '     ')
 
     if not config.has_option('DEFAULT','CAMERA_NAME_RE'):
         config.set('DEFAULT', 'CAMERA_NAME_RE', r'([N|D]VR|IP[T|C]|IPDOME) NAME:\s*([A-Za-z0-9_\-\s\.]*)\s*[\r|\n]')
@@ -1084,6 +1187,7 @@ def load_email_templates(online_reload=False):
                     new_template[key] = int(config[section][key] or 0)        
                 else:
                     new_template[key] = str(config[section][key])
+        new_template['EXTRACTOR'] = EmailTemplateExtractor(new_template) #Compile the template regexes once
         email_templates.update({str(section).lower():new_template})            
                     
                     
@@ -1147,9 +1251,12 @@ def load_unregistered_camera_email_senders(online_reload=False):
         config.write(f)
     CONFIG['UNREGISTERED_CAMERAS']['EMAIL_INDEX'] = email_addesses.copy()
 
-async def get_bot_username(token):
+async def get_bot_username(token, bots=None):
+    own_bots = bots is None
+    if own_bots:
+        bots = TelegramBotRegistry()
     try:
-        bot = TelegramBot(token=token)
+        bot = bots.get(token)
         me = await bot.get_me()
         username = me['username']
                 
@@ -1158,20 +1265,26 @@ async def get_bot_username(token):
         logger.error(f'Error retrieving chat bot username. {str(ex)}')
         username = ''
     finally:
-        if bot._session:
-            await bot._session.close()
+        if own_bots:
+            await bots.close()
 
     return username
 
 async def verify_chat_ids(configs):
     checks = []
     flood_controller = TelegramFloodController(token_burst_limit=19)
+    bots = TelegramBotRegistry(connections_limit = CONFIG['NOTIFIER']['CONNECTIONS_LIMIT'],
+                               keepalive_timeout = CONFIG['NOTIFIER']['KEEPALIVE_TIMEOUT_SEC'],
+                               request_timeout   = CONFIG['NOTIFIER']['REQUEST_TIMEOUT_SEC'])
     for config in configs:
-        checks.append(verify_chat_id_worker(config, flood_controller))    
-    results = await asyncio.gather(*checks)
+        checks.append(verify_chat_id_worker(config, flood_controller, bots))    
+    try:
+        results = await asyncio.gather(*checks)
+    finally:
+        await bots.close()
     return results
 
-async def verify_chat_id_worker(conf, flood_controller):
+async def verify_chat_id_worker(conf, flood_controller, bots):
     verification = {'ACTIVE':False, 
                     'REASON':'',
                     'BOT_USERNAME':'', 
@@ -1179,18 +1292,20 @@ async def verify_chat_id_worker(conf, flood_controller):
                     }
     
     try:
-        bot = TelegramBot(token=conf['BOT_TOKEN'])
+        bot = bots.get(conf['BOT_TOKEN'])
         await flood_controller.delay(token=conf['BOT_TOKEN'], 
                                      chat_id=conf['BOT_CHAT_ID'], 
                                      is_group = False, 
-                                     api_only=True
+                                     api_only=True,
+                                     priority=flood_controller.HOUSEKEEPING
                                      )
         me = await bot.get_me()
         try:
             await flood_controller.delay(token=conf['BOT_TOKEN'], 
                                          chat_id=conf['BOT_CHAT_ID'], 
                                          is_group = False, 
-                                         api_only=True
+                                         api_only=True,
+                                         priority=flood_controller.HOUSEKEEPING
                                          )
             chat = await bot.get_chat(chat_id=conf['BOT_CHAT_ID'])
         except ChatNotFound:
@@ -1215,17 +1330,11 @@ async def verify_chat_id_worker(conf, flood_controller):
         verification['ACTIVE'] = True
         verification['REASON'] = 'Unknown error, loaded as ACTIVE'
         conf['LIVE_VERIFICATION'] = verification
-    finally:
-        try:
-            if bot._session:
-                await bot._session.close()
-        except:
-            pass
 
     conf['LIVE_VERIFICATION'] = verification
     return conf    
 
-def get_status_message(config, log_level):
+def get_status_message(config, log_level, stage_queues=[]):
     # status_msg  = 'SERVICES:\n'
     # status_msg += '-----------------'
     status_msg = ''
@@ -1250,6 +1359,10 @@ def get_status_message(config, log_level):
         status_msg += '\n[LOGGING] Debug: Off'
     else:
         status_msg += '\n[LOGGING] Debug: On'
+    
+    for stage_queue in stage_queues:
+        stats = stage_queue.stats()
+        status_msg += f'\n[ QUEUE ] {stage_queue.name}: {stats["DEPTH"]}/{stats["MAXSIZE"]} ({stats["POLICY"]}), peak {stats["HIGH_WATER"]}, dropped {stats["DROPPED"]}, rejected {stats["REJECTED"]}'
         
     return status_msg
 
@@ -1319,7 +1432,7 @@ def send_test_notification(listener, stream_handler, log_level, OutgoingQueues,
     try:
         with open(os.path.join(CONFIG['PATHS']['EXE_PATH'],'deepstack_test_image.jpg'),'rb') as f:
             image = f.read()
-        images = [{'type': '.jpg', 'payload': image}]
+        images = [{'type': '.jpg', 'payload': MediaAttachment(image)}]
     except:
         images = []
     default =  {'EVENT_TYPE'    :['Intrusion Detection'],
@@ -1379,7 +1492,10 @@ def send_test_notification(listener, stream_handler, log_level, OutgoingQueues,
             print('LIVE LOG OUTPUT [debug] - Press ESC to return\n')
             listener.addHandler(stream_handler)
             for q in OutgoingQueues.values():
-                q.put(copy.deepcopy(History))
+                try:
+                    q.put(copy.deepcopy(History))
+                except queue.Full:
+                    print(f'{q.name} is full, test notification not sent')
             try:
                 wait_for_esc()
             except KeyboardInterrupt:
@@ -1530,10 +1646,24 @@ def main():
             telegram_handler.setFormatter(telegram_formatter)
             listener.addHandler(telegram_handler)
         
-        RecorderInQueue         = queue.SimpleQueue()#maxsize=1000)
-        NotifierInQueue         = queue.SimpleQueue()#maxsize=1000)
+        RecorderInQueue         = StageQueue('RecorderInQueue', 
+                                             maxsize     = CONFIG['QUEUES']['RECORDER_QUEUE_SIZE'], 
+                                             policy      = CONFIG['QUEUES']['RECORDER_QUEUE_POLICY'],
+                                             put_timeout = CONFIG['QUEUES']['PUT_TIMEOUT_SEC'] or None)
+        NotifierInQueue         = StageQueue('NotifierInQueue', 
+                                             maxsize     = CONFIG['QUEUES']['NOTIFIER_QUEUE_SIZE'], 
+                                             policy      = CONFIG['QUEUES']['NOTIFIER_QUEUE_POLICY'],
+                                             put_timeout = CONFIG['QUEUES']['PUT_TIMEOUT_SEC'] or None)
+        stage_queues            = [RecorderInQueue, NotifierInQueue]
         threads                 = []
-        DBconn                  = Sqlite3Worker(DBFILE, row_factory=sqlite3.Row) #Starts a thread, need to .close() again
+        if CONFIG['DATABASE']['WAL_MODE']:
+            DBconn              = Sqlite3Worker(DBFILE, row_factory=sqlite3.Row, 
+                                                wal_mode       = True,
+                                                mmap_size      = CONFIG['DATABASE']['MMAP_SIZE_MB']*1024*1024,
+                                                cache_size     = CONFIG['DATABASE']['CACHE_SIZE_MB']*1024*1024,
+                                                read_pool_size = CONFIG['DATABASE']['READ_POOL_SIZE']) #Starts threads, need to .close() again
+        else:
+            DBconn              = Sqlite3Worker(DBFILE, row_factory=sqlite3.Row) #Starts a thread, need to .close() again
     
                    
         try:
@@ -1549,17 +1679,20 @@ def main():
            
             
             #Start Notification Recorder Service
+            MediaCache = MediaUploadCache(CONFIG['NOTIFIER']['MEDIA_UPLOAD_CACHE_SIZE'])
             NotificationRecorder_Thread = NotificationRecorder_(incoming_queue  = RecorderInQueue, 
                                                                 outgoing_queues = {'NotifierInQueue': NotifierInQueue}, 
                                                                 db_conn         = DBconn, 
-                                                                config          = CONFIG)
+                                                                config          = CONFIG,
+                                                                media_cache     = MediaCache)
             NotificationRecorder_Thread.start()
             threads.append(NotificationRecorder_Thread)
             
             #Start Telegram Notifier Service
             TelegramNotifier_Thread = TelegramNotifier_(config                    = CONFIG, 
                                                         db_conn                   = DBconn, 
-                                                        camera_notification_queue = NotifierInQueue)
+                                                        camera_notification_queue = NotifierInQueue,
+                                                        media_cache               = MediaCache)
             TelegramNotifier_Thread.start()
             threads.append(TelegramNotifier_Thread)
             
@@ -1578,7 +1711,7 @@ def main():
                 try:    
                     menu = ConsoleMenu(f'ON PATROL SERVER V{str(__version__)} BUILD:{__build__} (PID:{xstr(os.getpid())})', 
                                        f'Server Name: {CONFIG["SERVER"]["SERVER_LONG_NAME"]}',
-                                       prologue_text=(get_status_message(CONFIG, log_level)),
+                                       prologue_text=(get_status_message(CONFIG, log_level, stage_queues)),
                                        exit_option_text='Shutdown Server')
                     menu.append_item(ExitItem('Reload Config'))
                     menu.append_item(ExitItem('Send Test Notification'))
@@ -1638,4 +1771,9 @@ def main():
 
 
 if __name__ == '__main__':
+    #Spawned media workers import this module as __mp_main__, keep process wide 
+    #side effects here. The other module level imports only load modules, the 
+    #keyboard hooks and console menu are not started until main() uses them.
+    multiprocessing.freeze_support()
+    locale.setlocale(locale.LC_ALL, '')
     main()
\ No newline at end of file
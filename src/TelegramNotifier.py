@@ -1,12 +1,16 @@
-import os, time, datetime, json, re
-import asyncio, threading
+import os, time, datetime, json, re, heapq, itertools, random
+import asyncio, threading, collections
 
+import aiohttp
 from aiohttp import ClientError
 from Common import aioEvent_ts #a thread safe asyncio.Event class
-from Common import SyncCall, TelegramFloodController, TermToken, create_sqlite3_table
+from Common import SyncCall, TelegramFloodController, TermToken, create_sqlite3_table, WEEKDAY_NAMES, \
+                   aioSqlite3Worker, MediaUploadCache
 from aiogram import Bot as TelegramBot
+from aiogram import types as telegram_types
 
-from aiogram.utils.exceptions import NetworkError, RetryAfter, RestartingTelegram, Throttled, TelegramAPIError #, BadRequest, ConflictError, Unauthorized, MigrateToChat
+from aiogram.utils.exceptions import NetworkError, RetryAfter, RestartingTelegram, Throttled, TelegramAPIError, \
+                                     WrongFileIdentifier, WrongRemoteFileIdSpecified #, BadRequest, ConflictError, Unauthorized, MigrateToChat
 from aiofiles import os as aio_os
 aio_isdir  = aio_os.wrap(os.path.isdir)
 aio_isfile = aio_os.wrap(os.path.isfile)
@@ -14,6 +18,10 @@ aio_isfile = aio_os.wrap(os.path.isfile)
 import logging
 logger = logging.getLogger('on_patrol_server')
 
+MEDIA_GROUP_SIZE = 10 #Max items in a telegram media group
+VIDEO_EXTENSIONS = ['.mp4', '.avi']
+INVALID_FILE_ID_ERRORS = (WrongFileIdentifier, WrongRemoteFileIdSpecified) #A cached file_id was refused
+
 def telegram_message(bot_token,
                      chat_id,
                      msg_time=datetime.datetime.now().timestamp(), 
@@ -47,12 +55,10 @@ def telegram_message(bot_token,
 class DataBaseManager():
     def __init__(self, db_conn):
         self._db_conn = db_conn
-        self._lock = asyncio.Lock()
+        self._db = aioSqlite3Worker(db_conn)
 
     async def _execute(self, stmt, args):
-        async with self._lock:
-            result = await SyncCall(self._db_conn.execute, None, stmt, args)
-        return result
+        return await self._db.execute(stmt, args)
     
     async def get_all_users_patrol_active(self):
         stmt = 'SELECT * FROM users WHERE patrol_active = 1 AND camera_notifications_enabled = 1 AND user_active = 1 AND telegram_enabled = 1 AND chatid <> "" COLLATE NOCASE'
@@ -62,7 +68,7 @@ class DataBaseManager():
     async def add_telegram_sent_items(self, bot_token, chat_id, msg_id, exp_time):
         stmt = "INSERT INTO telegram_sent_items (bot_token, chat_id, msg_id, exp_time, deleted) VALUES (?, ?, ?, ?, ?)"
         args = (bot_token, str(chat_id), str(msg_id), int(exp_time), 0,)
-        return await self._execute(stmt, args) 
+        await self._db.insert(stmt, args)
 
     async def get_telegram_sent_items_expired(self):
         stmt = "SELECT * FROM telegram_sent_items WHERE exp_time <= (?) and deleted = 0"
@@ -79,6 +85,28 @@ class DataBaseManager():
         args = ()
         await self._execute(stmt, args)
 
+    async def add_telegram_retry(self, due_time, notification):
+        '''Returns the GUID of the stored retry'''
+        return await self._db.transaction(self._insert_telegram_retry, float(due_time), json.dumps(notification))
+
+    @staticmethod
+    def _insert_telegram_retry(cursor, due_time, notification):
+        cursor.execute('INSERT INTO telegram_retries (DUE_TIME, NOTIFICATION) VALUES (?,?)', (due_time, notification,))
+        return cursor.lastrowid
+
+    async def get_telegram_retries(self):
+        stmt = 'SELECT * FROM telegram_retries ORDER BY DUE_TIME'
+        args = ()
+        return await self._execute(stmt, args)
+
+    async def delete_telegram_retries(self, guids, chunk_size=900):
+        #Chunked to stay below the SQLite host parameter limit
+        guids = list(guids)
+        for i in range(0, len(guids), chunk_size):
+            chunk = guids[i:i+chunk_size]
+            stmt = f"DELETE FROM telegram_retries WHERE GUID IN ({','.join('?'*len(chunk))})"
+            await self._execute(stmt, tuple(chunk))
+
     async def setup_tables(self):     
         #Create sent_items table
         columns = [['BOT_TOKEN'  , 'text'], 
@@ -88,26 +116,76 @@ class DataBaseManager():
                    ['DELETED'    , 'integer']]
         indexs  = ['EXP_TIME', 'DELETED']
         await SyncCall(create_sqlite3_table, None, self._db_conn, 'telegram_sent_items', columns, indexs)
+        #Create retries table
+        columns = [['DUE_TIME'     , 'real'], 
+                   ['NOTIFICATION' , 'text']]
+        indexs  = ['DUE_TIME']
+        await SyncCall(create_sqlite3_table, None, self._db_conn, 'telegram_retries', columns, indexs)
         logger.debug('[TelegramNotifier] Tables set up')
 
 
    
 
+class TelegramBotRegistry():
+    '''
+    One aiogram Bot per token for the lifetime of the event loop. All bots 
+    share one aiohttp connector, so API calls reuse keep-alive connections 
+    to the Bot API instead of paying a TLS handshake per message.
+    '''
+    def __init__(self, connections_limit=16, keepalive_timeout=60, request_timeout=60):
+        self.connections_limit = connections_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout   = request_timeout
+        self._connector        = None
+        self._bots             = {}
+        
+    def get(self, token):
+        bot = self._bots.get(token, None)
+        if bot is None or bot._session is None or bot._session.closed:
+            bot = TelegramBot(token=token, timeout=self.request_timeout)
+            if self._connector is None or self._connector.closed:
+                self._connector = aiohttp.TCPConnector(limit             = self.connections_limit, 
+                                                       keepalive_timeout = self.keepalive_timeout,
+                                                       ssl               = bot._connector_init.get('ssl', None))
+            bot._session = aiohttp.ClientSession(connector       = self._connector, 
+                                                 connector_owner = False, 
+                                                 json_serialize  = json.dumps)
+            self._bots.update({token:bot})
+        return bot
+    
+    async def close(self):
+        for bot in self._bots.values():
+            if bot._session and not bot._session.closed:
+                await bot._session.close()
+        self._bots = {}
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+
+
 async def CameraNotificationScheduler(loop, incoming_queue, send_queue, dbm, config, exit_flag):
     while(True):
         try:
-            item = await SyncCall(incoming_queue.get, None)
+            item = await incoming_queue.aget()
             if isinstance(item, TermToken):
                 logger.debug('[TelegramNotifier] CameraNotificationScheduler TERMINATION REQUEST RECEIVED, terminating task')
                 await send_queue.put(TermToken())
                 break
             #Check if camera is scheduled for notification
-            matched_camera_clusters = match_camera_clusters(camera_clusters = config['CAMERA_CLUSTERS'],
-                                                            event_type      = item['EVENT_TYPE'],
-                                                            event_time      = item['EVENT_TIME'],
-                                                            ipc_name        = item['CAMERA_NAME'],
-                                                            channel_name    = item['CHANNEL_NAME'],
-                                                            channel_number  = item['CHANNEL_NUMBER'])
+            cluster_index = config.get('CAMERA_CLUSTERS_INDEX', None)
+            if cluster_index is not None:
+                matched_camera_clusters = cluster_index.match(event_type     = item['EVENT_TYPE'],
+                                                              event_time     = item['EVENT_TIME'],
+                                                              ipc_name       = item['CAMERA_NAME'],
+                                                              channel_name   = item['CHANNEL_NAME'],
+                                                              channel_number = item['CHANNEL_NUMBER'])
+            else:
+                matched_camera_clusters = match_camera_clusters(camera_clusters = config['CAMERA_CLUSTERS'],
+                                                                event_type      = item['EVENT_TYPE'],
+                                                                event_time      = item['EVENT_TIME'],
+                                                                ipc_name        = item['CAMERA_NAME'],
+                                                                channel_name    = item['CHANNEL_NAME'],
+                                                                channel_number  = item['CHANNEL_NUMBER'])
             #Process telegram notifications
             to_send =  process_group_notifications( item, matched_camera_clusters, config)
         
@@ -120,49 +198,178 @@ async def CameraNotificationScheduler(loop, incoming_queue, send_queue, dbm, con
         except Exception as ex:
             logger.error(f'[TelegramNotifier] {str(ex)}', exc_info=True)
 
-async def TelegramSendWorkerDispatcher(loop, send_queue, dbm, config, flood_controller, exit_flag, queue_flushed):
-    worker_limiter        = asyncio.Semaphore(30)  #Limit number of send workers (max telgram api calls 30/sec)   
-    retry_worker_limiter  = asyncio.Semaphore(1000) #Limit number of queued retry items
+class ChatSendScheduler():
+    '''
+    Notifications waiting to be sent, one FIFO per chat and lane. Live alerts
+    go first, retries only when no alert can be sent. Within a lane the chats 
+    take turns round robin, and a chat only gets a send worker when the flood 
+    controller has a slot for it now. A burst for one busy chat then no 
+    longer fills the workers with sleeping sends while other chats wait. One 
+    worker per chat at a time keeps the order of the chat. The dispatcher 
+    stops taking notifications from the send queue while max_pending wait 
+    here, so the bounded send queue still holds back the producers.
+    '''
+    LANES = (TelegramFloodController.ALERT, TelegramFloodController.RETRY)
+    
+    def __init__(self, flood_controller, max_workers=30, max_pending=1000):
+        self.flood_controller = flood_controller
+        self.max_workers      = max_workers
+        self.max_pending      = max_pending
+        self.workers          = 0
+        self.worker_done      = asyncio.Event()
+        self._chats           = {}    #(token, chat_id) -> deque of notifications per lane
+        self._ready           = [collections.deque() for lane in self.LANES] #Chats with notifications and no worker, per lane
+        self._in_ready        = [set() for lane in self.LANES]
+        self._busy            = set()
+        self._pending         = 0
+    
+    @staticmethod
+    def _key(notification):
+        return (notification['BOT_TOKEN'], notification['CHAT_ID'])
+    
+    @staticmethod
+    def lane(notification):
+        if notification.get('RETRY_COUNT', 0) > 0:
+            return TelegramFloodController.RETRY
+        return TelegramFloodController.ALERT
+    
+    def __len__(self):
+        return self._pending
+    
+    def full(self):
+        return self._pending >= self.max_pending
+    
+    def _set_ready(self, key, lane):
+        if key not in self._in_ready[lane]:
+            self._in_ready[lane].add(key)
+            self._ready[lane].append(key)
+    
+    def put(self, notification):
+        key  = self._key(notification)
+        lane = self.lane(notification)
+        if key not in self._chats:
+            self._chats[key] = [collections.deque() for lane_ in self.LANES]
+        self._chats[key][lane].append(notification)
+        self._pending += 1
+        if key not in self._busy:
+            self._set_ready(key, lane)
+    
+    def next(self):
+        '''
+        Returns (notification, 0) with the flood control slot of the 
+        notification taken, else (None, seconds until a chat may have a slot),
+        the seconds being None if only a new notification or worker can help.
+        '''
+        if self.workers >= self.max_workers:
+            return None, None
+        wait_time = None
+        for lane in self.LANES:
+            ready = self._ready[lane]
+            for _ in range(len(ready)):
+                key = ready[0]
+                if key in self._busy or not self._chats[key][lane]:
+                    #Dispatched from the other lane meanwhile
+                    ready.popleft()
+                    self._in_ready[lane].discard(key)
+                    continue
+                notification = self._chats[key][lane][0]
+                slot_wait = self.flood_controller.try_acquire(token=notification['BOT_TOKEN'], chat_id=notification['CHAT_ID'], is_group=notification['IS_GROUP'], priority=lane)
+                if slot_wait <= 0:
+                    ready.popleft()
+                    self._in_ready[lane].discard(key)
+                    self._chats[key][lane].popleft()
+                    self._busy.add(key)
+                    self._pending -= 1
+                    self.workers  += 1
+                    return notification, 0
+                ready.rotate(-1)
+                wait_time = slot_wait if wait_time is None else min(wait_time, slot_wait)
+        return None, wait_time
+    
+    def done(self, notification):
+        '''Called by the worker of the notification when it is finished'''
+        key = self._key(notification)
+        self.workers -= 1
+        self._busy.discard(key)
+        if any(self._chats[key]):
+            for lane in self.LANES:
+                if self._chats[key][lane]:
+                    self._set_ready(key, lane)
+        else:
+            del self._chats[key]
+        self.worker_done.set()
+
+
+async def TelegramSendWorkerDispatcher(loop, send_queue, dbm, config, flood_controller, bots, media_cache, retry_scheduler, exit_flag, queue_flushed):
+    scheduler   = ChatSendScheduler(flood_controller, max_workers=30, max_pending=1000) #Limit number of send workers (max telgram api calls 30/sec)
+    get_task    = None
+    terminating = False
 
     while True:
-        notification = await send_queue.get()
-        if isinstance(notification, TermToken):
+        notification, wait_time = scheduler.next()
+        if notification is not None:
+            loop.create_task(TelegramSendWorker(loop                 = loop,
+                                                notification         = notification,
+                                                send_queue           = send_queue,
+                                                flood_controller      = flood_controller,
+                                                bots                 = bots,
+                                                media_cache          = media_cache,
+                                                dbm                  = dbm,
+                                                ImagePath            = config['PATHS']['IMAGES_SAVE_PATH'],
+                                                exit_flag            = exit_flag,
+                                                scheduler            = scheduler,
+                                                retry_scheduler      = retry_scheduler,
+                                                slot_reserved        = True),
+                             name = 'TelegramSendWorker'
+                             )
+            continue
+        
+        if terminating and not scheduler:
             logger.debug('[TelegramSendWorkerDispatcher] TERMINATION REQUEST RECEIVED, queue flushed, terminating task')
             queue_flushed.set()
             break
- 
-        await worker_limiter.acquire()
-        loop.create_task(TelegramSendWorker(loop                 = loop,
-                                            notification         = notification,
-                                            send_queue           = send_queue,
-                                            flood_controller      = flood_controller,
-                                            dbm                  = dbm,
-                                            ImagePath            = config['PATHS']['IMAGES_SAVE_PATH'],
-                                            exit_flag            = exit_flag,
-                                            worker_limiter       = worker_limiter,
-                                            retry_worker_limiter = retry_worker_limiter),
-                         name = 'TelegramSendWorker'
-                         )
-
-async def TelegramSendWorker(loop, notification, send_queue, flood_controller, dbm, ImagePath, exit_flag, worker_limiter, retry_worker_limiter):
+        
+        #Wait for a new notification, a finished worker or a free flood control slot
+        if get_task is None and not terminating and not scheduler.full():
+            get_task = asyncio.ensure_future(send_queue.get())
+        scheduler.worker_done.clear()
+        done_wait = asyncio.ensure_future(scheduler.worker_done.wait())
+        await asyncio.wait([task for task in (get_task, done_wait) if task is not None], timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+        done_wait.cancel()
+        
+        if get_task is not None and get_task.done():
+            items = [get_task.result()]
+            get_task = None
+            while len(scheduler) + len(items) < scheduler.max_pending and not send_queue.empty():
+                items.append(send_queue.get_nowait())
+            for item in items:
+                if isinstance(item, TermToken):
+                    terminating = True
+                    retry_scheduler.stop()
+                else:
+                    scheduler.put(item)
+
+async def TelegramSendWorker(loop, notification, send_queue, flood_controller, bots, media_cache, dbm, ImagePath, exit_flag, scheduler, retry_scheduler, slot_reserved=False):
+    retry_guid = notification.pop('RETRY_GUID', None) #Stored retry, removed once handled
     try:
-        bot = TelegramBot(token=notification['BOT_TOKEN'])
+        bot = bots.get(notification['BOT_TOKEN'])
 
         num_files = len(notification['MEDIA_FILENAMES'])        
         if num_files == 0 and notification['MESSAGE']:
             try:
-                await flood_controller.delay(token=notification['BOT_TOKEN'], chat_id=notification['CHAT_ID'], is_group=notification['IS_GROUP'])
+                if not slot_reserved:
+                    await flood_controller.delay(token=notification['BOT_TOKEN'], chat_id=notification['CHAT_ID'], is_group=notification['IS_GROUP'])
                 msg_sent = await bot.send_message(chat_id=notification['CHAT_ID'], parse_mode='HTML', disable_web_page_preview = False, text = notification['MESSAGE'])
                 if int(notification['EXP_TIME']) > 0:
                     await dbm.add_telegram_sent_items(notification['BOT_TOKEN'], msg_sent.chat.id, msg_sent.message_id, int(notification['EXP_TIME'])+time.time() )
                 logger.info(f' [TelegramNotifier] {notification["CAMERA_NAME"]}: Text message sent to {str(notification["PHONE_NUMBER"])} : {str(notification["USER_NAME"])} ({str(notification["FULL_NAME"])} {str(notification["GROUP_NAME"])})')
             except (RetryAfter, NetworkError, RestartingTelegram, ClientError, Throttled) as ex:
                 #Retry Sending
-                await handle_telegram_exception_retry(loop, notification, retry_worker_limiter, send_queue, str(ex), exit_flag)
+                await handle_telegram_exception_retry(notification, retry_scheduler, ex)
             except TelegramAPIError as ex:
                 #Retry if Gateway Timeout exception (GatewayTimeoutError not implemented yet)
                 if str(ex).strip() == 'Gateway Timeout':
-                    await handle_telegram_exception_retry(loop, notification, retry_worker_limiter, send_queue, str(ex), exit_flag)
+                    await handle_telegram_exception_retry(notification, retry_scheduler, ex)
                 else:
                     logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Failed to send telegram notification. {str(ex)}')
                     pass
@@ -171,74 +378,216 @@ async def TelegramSendWorker(loop, notification, send_queue, flood_controller, d
                 logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Failed to send telegram notification. {str(ex)}')
                 pass
         elif num_files > 0:
+            media_nums = []
             for num in range(0,num_files):
-                if await aio_isfile(os.path.join(ImagePath, notification['MEDIA_FILENAMES'][num])):
-                    try:
-                        if os.path.splitext(notification['MEDIA_FILENAMES'][num])[1] in ['.mp4', '.avi']:
-                            await flood_controller.delay(token=notification['BOT_TOKEN'], chat_id=notification['CHAT_ID'], is_group=notification['IS_GROUP'])
-                            msg_sent = await bot.send_video(chat_id=notification['CHAT_ID'], video=open(os.path.join(ImagePath, notification['MEDIA_FILENAMES'][num]), 'rb'), caption = notification['MESSAGE'])
+                if notification['MEDIA_FILENAMES'][num] and await aio_isfile(os.path.join(ImagePath, notification['MEDIA_FILENAMES'][num])):
+                    media_nums.append(num)
+            #Send up to 10 files per request as an album, retry per album
+            for group in [media_nums[i:i+MEDIA_GROUP_SIZE] for i in range(0, len(media_nums), MEDIA_GROUP_SIZE)]:
+                try:
+                    #The dispatcher took the flood control slot of the first request
+                    if not slot_reserved:
+                        await flood_controller.delay(token=notification['BOT_TOKEN'], chat_id=notification['CHAT_ID'], is_group=notification['IS_GROUP'])
+                    slot_reserved = False
+                    if len(group) > 1:
+                        msgs_sent = await send_media_group(bot         = bot, 
+                                                           token       = notification['BOT_TOKEN'],
+                                                           chat_id     = notification['CHAT_ID'], 
+                                                           file_paths  = [os.path.join(ImagePath, notification['MEDIA_FILENAMES'][num]) for num in group], 
+                                                           caption     = notification['MESSAGE'], 
+                                                           media_cache = media_cache,
+                                                           flood_controller = flood_controller,
+                                                           is_group    = notification['IS_GROUP'])
+                        logger.info(f' [TelegramNotifier] {notification["CAMERA_NAME"]}: {len(group)} media files sent to {str(notification["PHONE_NUMBER"])} : {str(notification["USER_NAME"])} ({str(notification["FULL_NAME"])} {str(notification["GROUP_NAME"])})')
+                    else:
+                        num = group[0]
+                        file_path = os.path.join(ImagePath, notification['MEDIA_FILENAMES'][num])
+                        flood_delay = lambda: flood_controller.delay(token=notification['BOT_TOKEN'], chat_id=notification['CHAT_ID'], is_group=notification['IS_GROUP'])
+                        if os.path.splitext(notification['MEDIA_FILENAMES'][num])[1] in VIDEO_EXTENSIONS:
+                            send_media = lambda media: bot.send_video(chat_id=notification['CHAT_ID'], video=media, caption = notification['MESSAGE'])
+                            msgs_sent = [await media_cache.send(notification['BOT_TOKEN'], file_path, send_media, invalid_file_id=INVALID_FILE_ID_ERRORS, before_reupload=flood_delay)]
                             logger.info(f' [TelegramNotifier] {notification["CAMERA_NAME"]}: Video sent to {str(notification["PHONE_NUMBER"])} : {str(notification["USER_NAME"])} ({str(notification["FULL_NAME"])} {str(notification["GROUP_NAME"])})')
                         else:
-                            await flood_controller.delay(token=notification['BOT_TOKEN'], chat_id=notification['CHAT_ID'], is_group=notification['IS_GROUP'])
-                            msg_sent = await bot.send_photo(chat_id=notification['CHAT_ID'], photo=open(os.path.join(ImagePath, notification['MEDIA_FILENAMES'][num]), 'rb'), caption = f'({num+1}/{num_files}) '+ notification['MESSAGE'])
+                            send_media = lambda media: bot.send_photo(chat_id=notification['CHAT_ID'], photo=media, caption = f'({num+1}/{num_files}) '+ notification['MESSAGE'])
+                            msgs_sent = [await media_cache.send(notification['BOT_TOKEN'], file_path, send_media, invalid_file_id=INVALID_FILE_ID_ERRORS, before_reupload=flood_delay)]
                             logger.info(f' [TelegramNotifier] {notification["CAMERA_NAME"]}: Image sent to {str(notification["PHONE_NUMBER"])} : {str(notification["USER_NAME"])} ({str(notification["FULL_NAME"])} {str(notification["GROUP_NAME"])})')
-                        if int(notification['EXP_TIME']) > 0:
+                    if int(notification['EXP_TIME']) > 0:
+                        for msg_sent in msgs_sent:
                             await dbm.add_telegram_sent_items(notification['BOT_TOKEN'], msg_sent.chat.id, msg_sent.message_id, int(notification['EXP_TIME'])+time.time() )
+                    for num in group:
                         notification['MEDIA_FILENAMES'][num] = ''
-                    except (RetryAfter, NetworkError, RestartingTelegram, ClientError, Throttled) as ex:
-                        #Retry Sending
-                        await handle_telegram_exception_retry(loop, notification, retry_worker_limiter, send_queue, str(ex), exit_flag)
-                    except TelegramAPIError as ex:
-                        #Gateway Timeout exception is not implemented in aiogram yet, so manually test for it here
-                        if str(ex).strip() == 'Gateway Timeout':
-                            await handle_telegram_exception_retry(loop, notification, retry_worker_limiter, send_queue, str(ex), exit_flag)
-                        else:
-                            logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Failed to send telegram notification. {str(ex)}')
-                            pass                        
-                    except Exception as exp:
-                        logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Failed to send telegram notification. {str(exp)}')
-                        pass
+                except (RetryAfter, NetworkError, RestartingTelegram, ClientError, Throttled) as ex:
+                    #Retry Sending, the retry carries the files not sent yet
+                    await handle_telegram_exception_retry(notification, retry_scheduler, ex)
+                    break
+                except TelegramAPIError as ex:
+                    #Gateway Timeout exception is not implemented in aiogram yet, so manually test for it here
+                    if str(ex).strip() == 'Gateway Timeout':
+                        await handle_telegram_exception_retry(notification, retry_scheduler, ex)
+                        break
+                    else:
+                        logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Failed to send telegram notification. {str(ex)}')
+                        pass                        
+                except Exception as exp:
+                    logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Failed to send telegram notification. {str(exp)}')
+                    pass
     except Exception as exxx:
         logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: {str(exxx)}')
     finally:
-        if bot._session:
-            await bot._session.close()
-        worker_limiter.release()
+        scheduler.done(notification)
+        if retry_guid is not None:
+            try:
+                await dbm.delete_telegram_retries([retry_guid])
+            except Exception as ex:
+                logger.error(f'[TelegramNotifier] Failed to remove sent telegram retry. {str(ex)}')
+
+async def send_media_group(bot, token, chat_id, file_paths, caption, media_cache, flood_controller, is_group=False, use_cache=True):
+    '''
+    Send the files as one album with the caption on the first item. Cached 
+    file_ids are sent instead of files already uploaded by this bot, and 
+    the file_ids of the uploaded files are cached. Returns the messages.
+    The caller waits for flood control before the first request, an upload
+    after a refused file_id waits again.
+    '''
+    media_group = telegram_types.MediaGroup()
+    opened = []
+    cached = []
+    try:
+        for i, file_path in enumerate(file_paths):
+            media = media_cache.get(token, file_path) if use_cache else None
+            if media is None:
+                media = open(file_path, 'rb')
+                opened.append(media)
+            else:
+                cached.append(file_path)
+            if os.path.splitext(file_path)[1] in VIDEO_EXTENSIONS:
+                media_group.attach_video(media, caption = caption if i == 0 else None)
+            else:
+                media_group.attach_photo(media, caption = caption if i == 0 else None)
+        msgs_sent = await bot.send_media_group(chat_id=chat_id, media=media_group)
+    except INVALID_FILE_ID_ERRORS:
+        if not cached:
+            raise
+        #A cached file_id was refused, upload all files instead
+        media_cache.evict_paths(cached)
+        use_cache = False
+    finally:
+        for media in opened:
+            media.close()
+    if not use_cache and cached:
+        await flood_controller.delay(token=token, chat_id=chat_id, is_group=is_group)
+        return await send_media_group(bot, token, chat_id, file_paths, caption, media_cache, flood_controller, is_group, use_cache=False)
+    for file_path, msg_sent in zip(file_paths, msgs_sent):
+        media_cache.put(token, file_path, msg_sent)
+    return msgs_sent
 
-async def handle_telegram_exception_retry(loop, notification, retry_worker_limiter, send_queue, ex_str, exit_flag):
-    retry_limit = 5
-    notification['RETRY_COUNT'] += 1
-    
-    if notification['RETRY_COUNT'] > retry_limit:
-        logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Telegram send failed, retry limit exceeded. {ex_str}')
-        return
-
-    match = re.search('Retry in ([0-9]*) seconds', ex_str)
-    if match is not None:
-        delay = int(match[1]) 
-    elif notification['RETRY_COUNT'] > 1:
-        delay = 10
-    else:
-        delay = 5
-    
-    logger.info(f' [TelegramNotifier] {notification["CAMERA_NAME"]}: Telegram send failed, retry attempt {str(notification["RETRY_COUNT"])} in {str(delay)}s. {ex_str}')
+async def handle_telegram_exception_retry(notification, retry_scheduler, ex):
+    await retry_scheduler.schedule(notification, ex)
 
-    await retry_worker_limiter.acquire()
-    loop.create_task(queue_after_delay(item         = notification,
-                                       delay        = delay,
-                                       queue        = send_queue,
-                                       task_limiter = retry_worker_limiter,
-                                       exit_flag    = exit_flag))
 
-async def queue_after_delay(item, delay, queue, task_limiter, exit_flag):
-    try:
+class RetryScheduler():
+    '''
+    Pending telegram retries kept in a min-heap on due time. One task moves
+    the retries that are due to the send queue, instead of one sleeping task
+    per retry. Retries are also stored in the telegram_retries table and 
+    loaded again after a restart. A stored retry is only removed by the send 
+    worker once the retry has been handled (RETRY_GUID in the notification), 
+    so retries still queued at shutdown are sent after the restart.
+    
+    The delay doubles with each attempt from base_delay up to max_delay, 
+    with jitter, unless telegram asks for a delay with RetryAfter.
+    '''
+    def __init__(self, send_queue, dbm, retry_limit=5, base_delay=5, max_delay=300, max_pending=1000):
+        self.send_queue  = send_queue
+        self.dbm         = dbm
+        self.retry_limit = retry_limit
+        self.base_delay  = base_delay
+        self.max_delay   = max_delay
+        self.max_pending = max_pending
+        self._heap       = []
+        self._seq        = itertools.count()
+        self._wake       = asyncio.Event()
+        self._stopping   = asyncio.Event()
+    
+    def __len__(self):
+        return len(self._heap)
+    
+    def stop(self):
+        '''Stop moving retries to the send queue, they stay stored for the next start'''
+        self._stopping.set()
+    
+    def retry_delay(self, retry_count, ex=None):
+        if isinstance(ex, RetryAfter):
+            return ex.timeout
+        match = re.search('Retry in ([0-9]*) seconds', str(ex))
+        if match is not None and match[1]:
+            return int(match[1])
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry_count - 1))
+        return delay/2 + random.uniform(0, delay/2)
+    
+    async def schedule(self, notification, ex=None):
+        '''Returns False if the notification is dropped'''
+        notification['RETRY_COUNT'] += 1
+        if notification['RETRY_COUNT'] > self.retry_limit:
+            logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Telegram send failed, retry limit exceeded. {str(ex)}')
+            return False
+        if len(self._heap) >= self.max_pending:
+            logger.error(f'[TelegramNotifier] {notification["CAMERA_NAME"]}: Telegram send failed, too many pending retries. {str(ex)}')
+            return False
+        
+        delay = self.retry_delay(notification['RETRY_COUNT'], ex)
+        logger.info(f' [TelegramNotifier] {notification["CAMERA_NAME"]}: Telegram send failed, retry attempt {str(notification["RETRY_COUNT"])} in {delay:.0f}s. {str(ex)}')
+        due_time = time.time() + delay
         try:
-            await asyncio.wait_for(exit_flag.wait(), timeout=delay)
-        except asyncio.TimeoutError:
-            pass 
-        await queue.put(item)
-    finally:
-        task_limiter.release()
+            guid = await self.dbm.add_telegram_retry(due_time, notification)
+        except Exception as db_ex:
+            logger.error(f'[TelegramNotifier] Failed to store telegram retry. {str(db_ex)}')
+            guid = None
+        self._push(due_time, guid, notification)
+        return True
+    
+    def _push(self, due_time, guid, notification):
+        heapq.heappush(self._heap, (due_time, next(self._seq), guid, notification))
+        self._wake.set()
+    
+    async def load(self):
+        '''Schedule the retries stored before the last shutdown'''
+        for row in await self.dbm.get_telegram_retries():
+            try:
+                self._push(row['DUE_TIME'], row['GUID'], json.loads(row['NOTIFICATION']))
+            except Exception as ex:
+                logger.error(f'[TelegramNotifier] Failed to load telegram retry. {str(ex)}')
+                await self.dbm.delete_telegram_retries([row['GUID']])
+        if self._heap:
+            logger.info(f' [TelegramNotifier] {len(self._heap)} pending telegram retries loaded')
+    
+    async def run(self, exit_flag):
+        exit_wait = asyncio.ensure_future(exit_flag.wait())
+        stop_wait = asyncio.ensure_future(self._stopping.wait())
+        try:
+            while not exit_flag.is_set() and not self._stopping.is_set():
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    due_time, seq, guid, notification = self._heap[0]
+                    if guid is not None:
+                        notification['RETRY_GUID'] = guid
+                    put = asyncio.ensure_future(self.send_queue.put(notification))
+                    await asyncio.wait([put, exit_wait, stop_wait], return_when=asyncio.FIRST_COMPLETED)
+                    if not put.done():
+                        #Shutting down, the retry stays stored
+                        put.cancel()
+                        break
+                    heapq.heappop(self._heap)
+                    continue
+                self._wake.clear()
+                wake_wait = asyncio.ensure_future(self._wake.wait())
+                timeout = self._heap[0][0] - now if self._heap else None
+                await asyncio.wait([wake_wait, exit_wait, stop_wait], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                wake_wait.cancel()
+        finally:
+            exit_wait.cancel()
+            stop_wait.cancel()
+        logger.debug('[TelegramNotifier] RetryScheduler terminated')
         
 def process_group_notifications(item, matched_camera_clusters, config):
     '''
@@ -328,15 +677,140 @@ def match_name(name, name_list):
     else:
         return False
 
-async def SentItemsCleanupWorker(dbm, flood_controller, exit_flag):
+
+class CameraClusterIndex():
+    '''
+    Compiled form of CONFIG['CAMERA_CLUSTERS'], built once by 
+    load_CameraClusterConfigs(). match() returns the same list of camera 
+    cluster keys as match_camera_clusters(), but only tests the cluster
+    entries that can match the IPC name of the event:
+      -> exact IPC names are looked up in a dict
+      -> "name*" IPC name patterns are looked up in a prefix trie
+      -> event types and weekdays are tested as bitmasks
+    '''
+    _TRIE_ENTRIES = None #Trie node key holding the entries of a prefix
+
+    def __init__(self, camera_clusters):
+        self.cluster_keys     = list(camera_clusters.keys())
+        self._any_ipc_name    = []  #Entries that match any IPC name
+        self._ipc_name_index  = {}  #Key->IPC name:Value->list of entries
+        self._ipc_prefix_trie = {}  #Nested dicts, one level per character
+        self._event_type_bits = {}  #Key->event type:Value->bit
+
+        for cluster_idx, key in enumerate(self.cluster_keys):
+            for cam in camera_clusters[key]:
+                if not cam['ENABLED']:
+                    continue
+                entry = self._compile_entry(cluster_idx, cam)
+                if self._match_any_name(cam['IPC_NAMES']):
+                    self._any_ipc_name.append(entry)
+                    continue
+                for name in set(cam['IPC_NAMES']):
+                    if name.endswith('*'):
+                        self._add_prefix(name[:-1], entry)
+                    else:
+                        self._ipc_name_index.setdefault(name, []).append(entry)
+
+    @staticmethod
+    def _match_any_name(name_list):
+        return name_list == [] or '*' in name_list
+
+    def _compile_entry(self, cluster_idx, cam):
+        #Channel names are matched the same way as match_name()
+        if self._match_any_name(cam['CHANNEL_NAMES']):
+            channel_names = None
+        else:
+            channel_names = (frozenset(cam['CHANNEL_NAMES']),
+                             tuple(x[:-1] for x in cam['CHANNEL_NAMES'] if x.endswith('*')))
+
+        channel_numbers = frozenset(cam['CHANNEL_NUMBERS']) if cam['CHANNEL_NUMBERS'] != [] else None
+
+        event_mask = 0
+        for event_type in cam['EVENT_TYPES']:
+            if event_type not in self._event_type_bits:
+                self._event_type_bits[event_type] = 1 << len(self._event_type_bits)
+            event_mask |= self._event_type_bits[event_type]
+
+        weekday_mask = 0
+        for bit, day in enumerate(WEEKDAY_NAMES):
+            if cam[day]:
+                weekday_mask |= 1 << bit
+
+        return (cluster_idx,
+                channel_names,
+                channel_numbers,
+                cam['EVENT_TYPES'] == [],
+                event_mask,
+                weekday_mask,
+                cam['TIME_START'],
+                cam['TIME_STOP'])
+
+    def _add_prefix(self, prefix, entry):
+        node = self._ipc_prefix_trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(self._TRIE_ENTRIES, []).append(entry)
+
+    def _prefix_entries(self, name):
+        entries = []
+        node = self._ipc_prefix_trie
+        for char in name:
+            entries.extend(node.get(self._TRIE_ENTRIES, ()))
+            node = node.get(char)
+            if node is None:
+                return entries
+        entries.extend(node.get(self._TRIE_ENTRIES, ()))
+        return entries
+
+    def match(self, event_type, event_time, ipc_name, channel_name, channel_number):
+        ipc_name = ipc_name.lower()
+        candidates = self._any_ipc_name + self._ipc_name_index.get(ipc_name, []) + self._prefix_entries(ipc_name)
+        if not candidates:
+            return []
+
+        channel_name = channel_name.lower()
+        if 'Test Notification.' in event_type:
+            event_mask = -1 #Test notifications match all event types
+        else:
+            event_mask = 0
+            for x in event_type:
+                event_mask |= self._event_type_bits.get(x.lower(), 0)
+        weekday_bit = 1 << event_time.weekday()
+        t = event_time.time()
+
+        matched = set()
+        for cluster_idx, channel_names, channel_numbers, any_event_type, entry_event_mask, weekday_mask, time_start, time_stop in candidates:
+            if cluster_idx in matched:
+                continue
+            if channel_names is not None:
+                if channel_name not in channel_names[0] and \
+                    not any(channel_name.startswith(x) for x in channel_names[1]):
+                    continue
+            if channel_numbers is not None and channel_number not in channel_numbers:
+                continue
+            if not (any_event_type or entry_event_mask & event_mask):
+                continue
+            if not weekday_mask & weekday_bit:
+                continue
+            if time_start > time_stop:
+                if not (t < time_stop or t > time_start):
+                    continue
+            elif time_start < time_stop:
+                if not (t > time_start and t < time_stop):
+                    continue
+            matched.add(cluster_idx)
+
+        return [self.cluster_keys[idx] for idx in sorted(matched)]
+
+async def SentItemsCleanupWorker(dbm, flood_controller, bots, exit_flag):
     while not exit_flag.is_set():
         try:
             items = await dbm.get_telegram_sent_items_expired()
             for item in items:
                 if exit_flag.is_set():
                     break
-                await flood_controller.delay(token=item['BOT_TOKEN'], chat_id=item['CHAT_ID'], is_group = True, api_only=True)
-                bot = TelegramBot(token=item['BOT_TOKEN'])
+                await flood_controller.delay(token=item['BOT_TOKEN'], chat_id=item['CHAT_ID'], is_group = True, api_only=True, priority=flood_controller.HOUSEKEEPING)
+                bot = bots.get(item['BOT_TOKEN'])
                 try:    
                     await bot.delete_message(chat_id=item['CHAT_ID'], message_id=item['MSG_ID'])
                 except (RetryAfter, NetworkError, RestartingTelegram, ClientError, Throttled):
@@ -346,9 +820,6 @@ async def SentItemsCleanupWorker(dbm, flood_controller, exit_flag):
                         continue
                 except:
                     pass
-                finally:
-                    if bot._session:
-                        await bot._session.close()
                 try:
                     await dbm.set_telegram_sent_item_deleted(item['GUID'])
                 except:
@@ -362,7 +833,7 @@ async def SentItemsCleanupWorker(dbm, flood_controller, exit_flag):
             pass
         
         
-async def TelegramNotifierMain(config, db_conn, camera_notification_queue, exit_flags):
+async def TelegramNotifierMain(config, db_conn, camera_notification_queue, exit_flags, media_cache=None):
     try:
         loop=asyncio.get_running_loop()
     except:
@@ -375,10 +846,24 @@ async def TelegramNotifierMain(config, db_conn, camera_notification_queue, exit_
     await dbm.setup_tables()
     flood_controller = TelegramFloodController(token_burst_limit=29)
     send_queue = asyncio.Queue(1000)
+    bots = TelegramBotRegistry(connections_limit = config['NOTIFIER']['CONNECTIONS_LIMIT'],
+                               keepalive_timeout = config['NOTIFIER']['KEEPALIVE_TIMEOUT_SEC'],
+                               request_timeout   = config['NOTIFIER']['REQUEST_TIMEOUT_SEC'])
+    if media_cache is None:
+        media_cache = MediaUploadCache(config['NOTIFIER']['MEDIA_UPLOAD_CACHE_SIZE'])
+    retry_scheduler = RetryScheduler(send_queue  = send_queue, 
+                                     dbm         = dbm,
+                                     retry_limit = config['NOTIFIER']['RETRY_LIMIT'],
+                                     base_delay  = config['NOTIFIER']['RETRY_BASE_DELAY_SEC'],
+                                     max_delay   = config['NOTIFIER']['RETRY_MAX_DELAY_SEC'],
+                                     max_pending = config['NOTIFIER']['MAX_PENDING_RETRIES'])
+    await retry_scheduler.load()
+    loop.create_task(retry_scheduler.run(exit_flag))
 
 
     loop.create_task(SentItemsCleanupWorker(dbm              = dbm, 
                                             flood_controller = flood_controller,
+                                            bots             = bots,
                                             exit_flag        = exit_flag))
 
     
@@ -394,6 +879,9 @@ async def TelegramNotifierMain(config, db_conn, camera_notification_queue, exit_
                                             dbm              = dbm,
                                             config           = config,
                                             flood_controller = flood_controller,
+                                            bots             = bots,
+                                            media_cache      = media_cache,
+                                            retry_scheduler  = retry_scheduler,
                                             exit_flag        = exit_flag,
                                             queue_flushed    = queue_flushed))
     
@@ -401,15 +889,17 @@ async def TelegramNotifierMain(config, db_conn, camera_notification_queue, exit_
     #Shutdown sequence: allow queues to flush through and finish up first
     tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
     await asyncio.gather(*tasks)
+    await bots.close()
   
     
 class TelegramNotifier(threading.Thread):
-    def __init__(self, config, db_conn, camera_notification_queue):  
+    def __init__(self, config, db_conn, camera_notification_queue, media_cache=None):  
         threading.Thread.__init__(self)
         self.name = 'TelegramNotifier'
         self.config = config
         self.db_conn = db_conn
         self.camera_notification_queue = camera_notification_queue
+        self.media_cache = media_cache
         self.exit_flags = []
 
     def run(self):
@@ -418,7 +908,8 @@ class TelegramNotifier(threading.Thread):
         asyncio.run(TelegramNotifierMain(config                    = self.config,
                                          db_conn                   = self.db_conn,
                                          camera_notification_queue = self.camera_notification_queue,
-                                         exit_flags                = self.exit_flags))
+                                         exit_flags                = self.exit_flags,
+                                         media_cache               = self.media_cache))
     
     def stop(self):
         for flag in self.exit_flags:
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""TelegramNotifier test routines."""
+
+import datetime
+import itertools
+import unittest
+
+from TelegramNotifier import CameraClusterIndex, match_camera_clusters
+
+
+def cluster_camera(ipc_names=[], channel_names=[], channel_numbers=[], event_types=[], start='00:00', stop='00:00', days=None, enabled=True):
+    camera = {'IPC_NAMES'       : ipc_names,
+              'CHANNEL_NAMES'   : channel_names,
+              'CHANNEL_NUMBERS' : channel_numbers,
+              'EVENT_TYPES'     : event_types,
+              'ENABLED'         : enabled,
+              'TIME_START'      : datetime.datetime.strptime(start, '%H:%M').time(),
+              'TIME_STOP'       : datetime.datetime.strptime(stop, '%H:%M').time()}
+    for day in ('MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY', 'SATURDAY', 'SUNDAY'):
+        camera[day] = days is None or day in days
+    return camera
+
+
+#Loaded the same way as load_CameraClusterConfigs(): names and event types lower case
+CAMERA_CLUSTERS = {
+    'garden'   : [cluster_camera(ipc_names=['garden'], event_types=['intrusion detection', 'person'], start='21:00', stop='06:00')],
+    'gates'    : [cluster_camera(ipc_names=['gate*'], channel_names=['back*', 'front gate'], channel_numbers=['1', '2']),
+                  cluster_camera(ipc_names=['garden'], channel_names=['back gate'])],
+    'weekend'  : [cluster_camera(ipc_names=['*'], event_types=['motion'], days=('SATURDAY', 'SUNDAY'))],
+    'office'   : [cluster_camera(ipc_names=['office', 'office annex'], start='08:00', stop='18:00')],
+    'disabled' : [cluster_camera(enabled=False)],
+    'everyone' : [cluster_camera(event_types=['line crossing'])]}
+
+MONDAY_NIGHT   = datetime.datetime(2023, 4, 3, 23, 30)
+MONDAY_NOON    = datetime.datetime(2023, 4, 3, 12, 0)
+SUNDAY_MORNING = datetime.datetime(2023, 4, 9, 7, 0)
+
+
+class CameraClusterIndexTests(unittest.TestCase):
+    """Test out the compiled camera cluster matching."""
+
+    def setUp(self):  # pylint:disable=D0102
+        self.index = CameraClusterIndex(CAMERA_CLUSTERS)
+
+    def match(self, event_type, event_time, ipc_name, channel_name='', channel_number=''):
+        matched = self.index.match(event_type, event_time, ipc_name, channel_name, channel_number)
+        self.assertEqual(matched, match_camera_clusters(CAMERA_CLUSTERS, event_type, event_time, ipc_name, channel_name, channel_number))
+        return matched
+
+    def test_exact_ipc_name_and_time_window(self):
+        """Test an exact IPC name with an overnight time window."""
+        self.assertEqual(self.match(['Intrusion Detection'], MONDAY_NIGHT, 'Garden'), ['garden'])
+        self.assertEqual(self.match(['Intrusion Detection'], MONDAY_NOON, 'Garden'), [])
+        self.assertEqual(self.match(['Motion'], MONDAY_NIGHT, 'Garden'), [])
+
+    def test_ipc_name_prefix_and_channel_names(self):
+        """Test "name*" patterns for IPC and channel names."""
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Gate North', 'Back Yard', '1'), ['gates'])
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Gate North', 'Front Gate', '2'), ['gates'])
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Gate North', 'Front Door', '2'), [])
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Gate North', 'Back Yard', '3'), [])
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Gat', 'Back Yard', '1'), [])
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Garden', 'Back Gate', '5'), ['gates'])
+
+    def test_wildcard_ipc_name_and_weekdays(self):
+        """Test wildcard clusters limited to some days."""
+        self.assertEqual(self.match(['Motion'], SUNDAY_MORNING, 'Street'), ['weekend'])
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Street'), [])
+        self.assertEqual(self.match(['Line Crossing'], MONDAY_NOON, 'Street'), ['everyone'])
+
+    def test_cluster_matched_once(self):
+        """Test that each cluster key is returned once, in config order."""
+        self.assertEqual(self.match(['Intrusion Detection', 'Motion', 'Line Crossing'], SUNDAY_MORNING, 'Garden', 'Back Gate', '1'),
+                         ['gates', 'weekend', 'everyone'])
+        self.assertEqual(self.match(['Motion'], MONDAY_NOON, 'Office Annex'), ['office'])
+
+    def test_test_notification(self):
+        """Test that test notifications match all event types."""
+        self.assertEqual(self.match(['Test Notification.'], MONDAY_NOON, 'Street'), ['everyone'])
+        self.assertEqual(self.match(['Test Notification.'], MONDAY_NIGHT, 'Garden', 'Back Gate'), ['garden', 'gates', 'everyone'])
+
+    def test_same_as_match_camera_clusters(self):
+        """Test that match() returns the same as match_camera_clusters() for all combinations."""
+        event_types   = (['Intrusion Detection'], ['Motion'], ['Person', 'Line Crossing'], ['Test Notification.'], [])
+        event_times   = (MONDAY_NIGHT, MONDAY_NOON, SUNDAY_MORNING, datetime.datetime(2023, 4, 3, 21, 0))
+        ipc_names     = ('Garden', 'GATE 7', 'Gate', 'Office', 'Office Annex', 'Street', '')
+        channel_names = ('Back Gate', 'Front Gate', 'Backyard', '')
+        for event_type, event_time, ipc_name, channel_name, channel_number in \
+            itertools.product(event_types, event_times, ipc_names, channel_names, ('1', '3', '')):
+            self.match(event_type, event_time, ipc_name, channel_name, channel_number)
+
+
+if __name__ == "__main__":
+    unittest.main()